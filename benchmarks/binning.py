@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Microbenchmark of ROI binning.
+
+Compares the former per-BAM path of ``plotDataLine`` (bin centers from
+``statistics.mean`` pairs, then one ``scipy.stats.binned_statistic`` call
+per BAM) with one ``countsfile.binMatrix`` call over the ROI x BAM matrix::
+
+	$ python benchmarks/binning.py [--length 100000] [--bams 12] [--binsize 50]
+"""
+import argparse
+import os
+import statistics
+import sys
+import timeit
+
+import numpy as np
+import scipy.stats as stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mobamplot"))
+import countsfile
+
+# per-BAM binning as plotDataLine used to do it
+def binPerBAM(matrix, chromStart, chromEnd, binsize):
+	x_data = np.arange(chromStart, chromEnd)
+	x_data_binned = np.append(np.arange(chromStart, chromEnd, binsize), chromEnd-1)
+	x_data_binned_mean = [statistics.mean([x_data_binned[i], x_data_binned[i+1]]) for i in range(0, len(x_data_binned)-1)]
+	countAvg = [stats.binned_statistic(x_data, counts, statistic='mean', bins=x_data_binned)[0] for counts in matrix]
+	return x_data_binned_mean, countAvg
+
+# one kernel call for all BAMs
+def binVectorized(matrix, chromStart, chromEnd, binsize, statistic="mean"):
+	return countsfile.binCenters(chromStart, chromEnd, binsize), countsfile.binMatrix(matrix, binsize, statistic)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--length", type=int, default=100000, help="ROI length in bp. Default: 100000.")
+	parser.add_argument("--bams", type=int, default=12, help="Number of BAMs. Default: 12.")
+	parser.add_argument("--binsize", type=int, default=50, help="Bin size. Default: 50.")
+	parser.add_argument("--repeat", type=int, default=5, help="Timing repeats, best is reported. Default: 5.")
+	args = parser.parse_args()
+
+	chromStart = 1000000
+	chromEnd = chromStart + args.length
+	matrix = np.random.RandomState(0).poisson(3, (args.bams, args.length)).astype(np.float64)
+
+	# both paths agree on the bin means
+	old = np.array(binPerBAM(matrix, chromStart, chromEnd, args.binsize)[1])
+	new = binVectorized(matrix, chromStart, chromEnd, args.binsize)[1]
+	print("max |difference| of bin means: {0:.3g}".format(np.nanmax(np.abs(old - new))))
+
+	timings = [("per-BAM binned_statistic (mean)", lambda: binPerBAM(matrix, chromStart, chromEnd, args.binsize))]
+	for statistic in countsfile.STATISTICS:
+		timings.append(("binMatrix ({0})".format(statistic),
+						lambda statistic=statistic: binVectorized(matrix, chromStart, chromEnd, args.binsize, statistic)))
+
+	print("{0} BAMs x {1} bp, bin size {2}".format(args.bams, args.length, args.binsize))
+	for label, function in timings:
+		seconds = min(timeit.repeat(function, number=1, repeat=args.repeat))
+		print("{0:<34} {1:>10.2f} ms".format(label, seconds * 1000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Benchmark and profile of per-ROI figure building.
+
+Bins every ROI of a counts file (the demo file by default) once at every
+slider bin size, outside the timed code, then builds its histogram figure
+from those same arrays in three ways:
+
+	make_subplots + setLayout
+		the former way: ``tls.make_subplots`` and a layout rebuilt from
+		scratch per ROI that reads ``countsMax`` back from the traces
+	layout template
+		``histFigure``, which patches a layout template built once per
+		number of BAMs
+	graph_objs traces
+		``histFigure`` with every trace validated through ``go.Bar`` as
+		``make_trace_hist`` used to build them
+
+Profiling the figure building showed about 80% of its time in plotly's
+graph_objs validation of the traces, not in the layout. ``make_trace_hist``
+and ``make_trace_line`` therefore build plain plotly.js dicts, and the last
+row shows what the validation costs. With ``--profile`` the ``histFigure``
+runs are profiled and the most expensive functions are printed::
+
+	$ python benchmarks/figure_layout.py [--hdf5 demo/sample.hdf5] [--binsize 200] [--profile]
+"""
+import argparse
+import cProfile
+import math
+import os
+import pstats
+import sys
+import timeit
+
+import h5py
+import plotly.graph_objs as go
+import plotly.tools as tls
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mobamplot"))
+import countsfile
+import mobamplot
+
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo", "sample.hdf5")
+
+# per-ROI layout as setLayout used to build it
+def formerLayout(fig, chrom, chromStart, chromEnd, subplots, ROI_name):
+	xLay = dict(range=[chromStart-300, chromEnd+300], showline=True, tickmode="array",
+				tickvals=[chromStart, chromEnd],
+				ticktext=[str(chrom) + ": " + str(chromStart), str(chrom) + ": " + str(chromEnd)],
+				ticks="outside", zeroline=True, zerolinewidth=2, mirror=True)
+	countsMax = max([max(fig.data.get_data()[i]['y']) for i in range(0, subplots[-1])])
+	y_range_max = 0.5 * math.ceil(2 * countsMax)
+	yLay = dict(title="Reads", range=[0, y_range_max], tick0=0, dtick=(y_range_max/20), ticks="outside",
+				showgrid=False, showline=True, zeroline=True, zerolinewidth=2, mirror=True)
+	for splt in subplots:
+		fig["layout"].update({"xaxis{}".format(splt): xLay})
+		fig["layout"].update({"yaxis{}".format(splt): yLay})
+		fig["layout"].update(legend=dict(bordercolor="rgba(0,0,0,1)", orientation="h"))
+		fig["layout"]["shapes"].append(dict(type="rect", layer="above", xref="x{}".format(splt),
+											yref="y{}".format(splt), x0=chromEnd-1000, x1=chromEnd,
+											y0=y_range_max*(0.903), y1=y_range_max*(0.923),
+											fillcolor="rgba(0,0,0,1)"))
+		fig["layout"]["annotations"].append(go.Annotation(text="1kb", x=chromEnd-500, y=y_range_max*(.923),
+														  xref="x{}".format(splt), yref="y{}".format(splt),
+														  showarrow=False, xanchor="center", yanchor="bottom"))
+	fig["layout"].update(title="Gene: " + ROI_name, titlefont=dict(size=18), showlegend=False, autosize=True)
+	return fig
+
+# coordinates, BAM IDs and binned counts of one ROI at every slider bin size, binned once for all runs
+def prebin(roi, binsize):
+	chrom, chromStart, chromEnd = countsfile.roiCoordinates(roi)
+	bamIDs = countsfile.roiBamIDs(roi)
+	binner = countsfile.columnBinner(roi, bamIDs)
+	slider_binsizes = sorted(set(mobamplot.SLIDER_BINSIZES + [binsize]))
+	binned = [binner(step_binsize) for step_binsize in slider_binsizes]
+	return chrom, chromStart, chromEnd, bamIDs, binned, slider_binsizes
+
+# histogram figure of one ROI as it used to be built
+def formerHist(ID, binsize, chrom, chromStart, chromEnd, bamIDs, binned, slider_binsizes):
+	subplots = list(range(1, len(bamIDs)+1))
+	fig = tls.make_subplots(rows=len(subplots), subplot_titles=bamIDs, vertical_spacing=0.05, print_grid=False)
+	traces = []
+	for step_binsize, countAvg in zip(slider_binsizes, binned):
+		traces += [mobamplot.make_trace_hist(chromStart, chromEnd, countAvg[index-1], BAM, step_binsize, index,
+											 visible=(step_binsize == binsize))
+				   for index, BAM in enumerate(bamIDs, start=1)]
+	fig['data'] = go.Data(traces)
+	fig = formerLayout(fig, chrom, chromStart, chromEnd, subplots, ID)
+	return mobamplot.addSlider(fig, slider_binsizes, len(bamIDs), slider_binsizes.index(binsize))
+
+# histogram figure of one ROI as plotBinned builds it
+def templateHist(ID, binsize, chrom, chromStart, chromEnd, bamIDs, binned, slider_binsizes):
+	return mobamplot.histFigure(chrom, chromStart, chromEnd, ID, bamIDs, binned, slider_binsizes, binsize)
+
+# histogram figure of one ROI with graph_objs traces, as make_trace_hist used to return them
+def validatedHist(ID, binsize, chrom, chromStart, chromEnd, bamIDs, binned, slider_binsizes):
+	fig = templateHist(ID, binsize, chrom, chromStart, chromEnd, bamIDs, binned, slider_binsizes)
+	fig["data"] = [go.Bar(**dict((key, value) for key, value in trace.items() if key != "type"))
+				   for trace in fig["data"]]
+	return fig
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--hdf5", default=DEMO, help="Counts file. Default: the demo file.")
+	parser.add_argument("--binsize", type=int, default=200, help="Bin size. Default: 200.")
+	parser.add_argument("--repeat", type=int, default=3, help="Timing repeats, best is reported. Default: 3.")
+	parser.add_argument("--profile", action="store_true", default=False,
+						help="Print the functions histFigure spends most time in.")
+	args = parser.parse_args()
+
+	# every way builds from the same binned arrays, so only figure building is timed
+	with h5py.File(args.hdf5, "r") as f:
+		rois = [(ID, prebin(f[ID], args.binsize)) for ID in countsfile.roiNames(f)]
+
+	def timed(build):
+		return lambda: [build(ID, args.binsize, *binned) for ID, binned in rois]
+
+	print("{0} ROIs, bin size {1}".format(len(rois), args.binsize))
+	for label, build in [("make_subplots + setLayout", formerHist), ("layout template", templateHist),
+						 ("graph_objs traces", validatedHist)]:
+		seconds = min(timeit.repeat(timed(build), number=1, repeat=args.repeat))
+		print("{0:<28} {1:>10.2f} ms per ROI".format(label, seconds * 1000 / max(len(rois), 1)))
+
+	if args.profile:
+		profile = cProfile.Profile()
+		profile.runcall(timed(templateHist))
+		pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Benchmark HDF5 codecs for count datasets.
+
+Rewrites every ROI of a counts file (the demo file by default) with each
+codec offered by ``getcountvectordata.py --compression`` and reports write
+time, read time and file size::
+
+	$ python benchmarks/hdf5_compression.py [counts.hdf5] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mobamplot"))
+import countsfile
+
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo", "sample.hdf5")
+
+# (label, compression, level)
+CODECS = [("none", "none", None), ("lzf", "lzf", None),
+		  ("gzip-1", "gzip", 1), ("gzip-4", "gzip", 4), ("gzip-9", "gzip", 9)]
+
+# write all ROIs with one codec, return seconds
+def writeCounts(rois, filename, compression, level, chunkLength):
+	start = time.time()
+	with h5py.File(filename, "w") as f:
+		countsfile.initLayout(f)
+		for name, coordinates, bamIDs, columns in rois:
+			countsfile.writeROI(f, name, *coordinates, bamIDs=bamIDs, columns=columns,
+								compression=compression, compressionLevel=level, chunkLength=chunkLength)
+	return time.time() - start
+
+# read every BAM column of every ROI, return seconds
+def readCounts(filename):
+	start = time.time()
+	with h5py.File(filename, "r") as f:
+		for name in countsfile.roiNames(f):
+			for counts in countsfile.readColumns(f[name]):
+				counts.sum()
+	return time.time() - start
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("hdf5", nargs="?", default=DEMO, help="Counts file to rewrite. Default: demo data.")
+	parser.add_argument("--repeat", type=int, default=5, help="Timing repeats, best is reported. Default: 5.")
+	parser.add_argument("--chunk-length", dest="chunkLength", type=int, default=16384)
+	args = parser.parse_args()
+
+	with h5py.File(args.hdf5, "r") as f:
+		rois = [(name, countsfile.roiCoordinates(f[name]), countsfile.roiBamIDs(f[name]),
+				 countsfile.readColumns(f[name])) for name in countsfile.roiNames(f)]
+
+	print("{0:<8} {1:>10} {2:>10} {3:>12}".format("codec", "write (s)", "read (s)", "size (kB)"))
+	tmpdir = tempfile.mkdtemp()
+	for label, compression, level in CODECS:
+		filename = os.path.join(tmpdir, label + ".hdf5")
+		writeTime = min(writeCounts(rois, filename, compression, level, args.chunkLength) for i in range(args.repeat))
+		readTime = min(readCounts(filename) for i in range(args.repeat))
+		size = os.path.getsize(filename) / 1024.0
+		print("{0:<8} {1:>10.4f} {2:>10.4f} {3:>12.1f}".format(label, writeTime, readTime, size))
+		os.remove(filename)
+	os.rmdir(tmpdir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,689 @@
+#!/usr/bin/env python
+"""Read and write the HDF5 counts files made by getcountvectordata.py.
+
+Layout
+------
+Each ROI is a group named after the ROI, holding one contiguous 1-D dataset
+per BAM. Plotting k of N samples therefore reads k datasets. The group
+attributes hold the ROI coordinates (``ID``, ``chrom``, ``chromStart``,
+``chromEnd``), the BAM IDs in plotting order (``bamIDs``) and the completion
+marker (``complete``). Names starting with an underscore are file metadata,
+not ROIs. The file attribute ``layout`` is ``"columns"``.
+
+Each BAM dataset uses the narrowest dtype that holds its values (uint8,
+uint16 or uint32 for whole counts, float32 for fractional counts). The dtype
+is recorded in its ``dtype`` attribute, and the readers return float64.
+A column that is mostly zero or constant runs is stored run-length encoded
+when that is smaller. It is then a group holding ``ends`` (exclusive end of
+each run) and ``values`` (value of each run), with the attributes
+``encoding`` (``"rle"``) and ``length``.
+
+The ``_index`` table lists every ROI's chrom, start, end and name sorted by
+position, so the ROIs overlapping a region are found by binary search. It is
+written once all ROIs are, and dropped whenever a ROI is rewritten.
+
+A ROI may also hold a bin pyramid in its ``_pyramid`` group: for each bin
+size, one dataset per BAM with the ``mean``, ``max`` and ``sum`` of every bin.
+Binned reads at a bin size that is a multiple of a stored level are served
+from the pyramid instead of the per-nucleotide counts.
+
+Older files store each ROI as one compound dataset with a field per BAM.
+The readers below accept both layouts. Running this module as a script
+converts an old file to the column layout, adds a bin pyramid to an
+existing file, or (re)writes its interval index::
+
+	$ python countsfile.py convert old.hdf5 new.hdf5
+	$ python countsfile.py build-pyramid counts.hdf5 --binsizes 50 200
+	$ python countsfile.py index counts.hdf5
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import re
+import sys
+import h5py
+import numpy as np
+
+# value of the "layout" file attribute for one-dataset-per-BAM files
+LAYOUT = "columns"
+
+# HDF5 compression codecs for the count datasets
+COMPRESSIONS = ["none", "gzip", "lzf"]
+
+# h5py create_dataset keyword arguments for a count dataset of length nucleotides
+def datasetOptions(length, compression="gzip", compressionLevel=4, chunkLength=16384):
+	"""Return chunking and compression options for :meth:`h5py.Group.create_dataset`
+
+	Each ROI is read sequentially as a whole, so chunks are contiguous
+	stretches of `chunkLength` nucleotides, capped at the ROI length.
+	"""
+	if compression not in COMPRESSIONS:
+		raise ValueError("Unknown compression '{0}', choose from {1}.".format(compression, COMPRESSIONS))
+	if compression == "gzip" and compressionLevel not in range(10):
+		raise ValueError("gzip compression level must be 0-9, got {0}.".format(compressionLevel))
+	if compression == "none":
+		return {}
+	options = dict(chunks=(max(min(chunkLength, length), 1),),
+				   compression=compression,
+				   shuffle=True)		# byte shuffling groups the mostly-zero high bytes
+	if compression == "gzip":
+		options["compression_opts"] = compressionLevel
+	return options
+
+# storage dtypes for count columns, "auto" picks the narrowest safe one per column
+DTYPES = ["auto", "float32", "float64"]
+
+# unsigned integer dtypes tried in order for whole-number columns
+_UINTS = [np.uint8, np.uint16, np.uint32]
+
+# choose the storage dtype of one count column
+def compactDtype(counts, dtype="auto"):
+	"""Return the numpy dtype used to store `counts`
+
+	With ``"auto"``, non-negative whole numbers get the narrowest unsigned
+	integer that holds their maximum, and other values get float32. Values
+	that would overflow every candidate are stored as float64.
+	"""
+	if dtype not in DTYPES:
+		raise ValueError("Unknown count dtype '{0}', choose from {1}.".format(dtype, DTYPES))
+	if dtype != "auto":
+		return np.dtype(dtype)
+
+	counts = np.asarray(counts)
+	if len(counts) == 0:
+		return np.dtype(np.uint8)
+	if np.all(np.isfinite(counts)) and counts.min() >= 0 and np.array_equal(counts, np.floor(counts)):
+		maximum = counts.max()
+		for candidate in _UINTS:
+			if maximum <= np.iinfo(candidate).max:
+				return np.dtype(candidate)
+	elif np.all(np.abs(counts[np.isfinite(counts)]) <= np.finfo(np.float32).max):
+		return np.dtype(np.float32)
+
+	# overflow, keep full precision
+	print("Count column exceeds compact dtypes, stored as float64.")
+	return np.dtype(np.float64)
+
+# column encodings, "auto" run-length encodes a column when that is smaller
+ENCODINGS = ["auto", "dense", "rle"]
+
+# split a count vector into runs of equal values
+def runLengthEncode(counts):
+	"""Return (ends, values): the exclusive end position and value of each run"""
+	counts = np.asarray(counts)
+	if len(counts) == 0:
+		return np.zeros(0, dtype=np.int64), counts[:0]
+	ends = np.append(np.flatnonzero(counts[1:] != counts[:-1]) + 1, len(counts))
+	return ends, counts[ends - 1]
+
+# expand runs back into a count vector
+def runLengthDecode(ends, values):
+	return np.repeat(values, np.diff(np.concatenate(([0], ends))))
+
+# sums of run-length encoded counts over bins, without decoding
+def binRunSums(ends, values, edges):
+	"""Sum the counts of each bin ``[edges[i], edges[i+1])`` straight from runs
+
+	The running total of the counts is linear inside a run, so interpolating
+	it at the bin edges is exact.
+	"""
+	boundaries = np.concatenate(([0], ends))
+	totals = np.concatenate(([0.0], np.cumsum(np.asarray(values, dtype=np.float64) * np.diff(boundaries))))
+	return np.diff(np.interp(edges, boundaries, totals))
+
+# narrowest unsigned dtype for run end positions up to length
+def _positionDtype(length):
+	for candidate in _UINTS + [np.uint64]:
+		if length <= np.iinfo(candidate).max:
+			return np.dtype(candidate)
+
+# write one BAM column into a ROI group with its compact dtype and encoding
+def _writeColumn(roi, bamID, counts, dtype, compression, compressionLevel, chunkLength, encoding="auto"):
+	if encoding not in ENCODINGS:
+		raise ValueError("Unknown column encoding '{0}', choose from {1}.".format(encoding, ENCODINGS))
+	storedDtype = compactDtype(counts, dtype)
+	counts = np.asarray(counts).astype(storedDtype)
+
+	if encoding != "dense":
+		ends, values = runLengthEncode(counts)
+		positionDtype = _positionDtype(len(counts))
+		if encoding == "rle" or len(ends) * (positionDtype.itemsize + storedDtype.itemsize) < counts.nbytes:
+			column = roi.create_group(bamID)
+			column.create_dataset("ends", data=ends.astype(positionDtype),
+								  **datasetOptions(len(ends), compression, compressionLevel, chunkLength))
+			column.create_dataset("values", data=values,
+								  **datasetOptions(len(values), compression, compressionLevel, chunkLength))
+			column.attrs["encoding"] = np.string_("rle")
+			column.attrs["length"] = len(counts)
+			column.attrs["dtype"] = np.string_(storedDtype.name)
+			return column
+
+	column = roi.create_dataset(bamID, data=counts,
+								**datasetOptions(len(counts), compression, compressionLevel, chunkLength))
+	column.attrs["dtype"] = np.string_(storedDtype.name)
+	return column
+
+# count vector of one BAM of a ROI group, decoded and upcast to float64
+def readColumn(roi, bamID):
+	column = roi[bamID]
+	if isinstance(column, h5py.Group):
+		return runLengthDecode(column["ends"][...], column["values"][...].astype(np.float64))
+	return column[...].astype(np.float64)
+
+# statistics the binning kernel supports
+STATISTICS = ["mean", "max", "sum", "median"]
+
+_REDUCERS = dict(mean=np.mean, max=np.max, sum=np.sum, median=np.median)
+
+# bin every row of a ROI x position (or BAM x position) matrix at once
+def binMatrix(matrix, binsize, statistic="mean"):
+	"""Apply `statistic` to bins of `binsize` positions along the last axis
+
+	All full bins are reduced in one call on a (rows, bins, binsize) view of
+	the matrix. The ragged last bin, when the length is not a multiple of
+	`binsize`, is reduced separately and appended.
+
+	Parameters
+	----------
+	matrix : array-like
+		1-D count vector or 2-D array with one count vector per row
+
+	binsize : int
+		Bin width in positions, bins start at position 0
+
+	statistic : str, optional
+		One of :data:`STATISTICS` (Default: ``"mean"``)
+
+	Returns
+	-------
+	numpy.ndarray
+		float64 array of shape (rows, number of bins), or (number of bins,)
+		for a 1-D input
+	"""
+	if statistic not in STATISTICS:
+		raise ValueError("Unknown statistic '{0}', choose from {1}.".format(statistic, STATISTICS))
+	matrix = np.asarray(matrix, dtype=np.float64)
+	vector = matrix.ndim == 1
+	matrix = np.atleast_2d(matrix)
+	rows, length = matrix.shape
+	full = length // binsize
+	reduce = _REDUCERS[statistic]
+
+	binned = reduce(matrix[:, :full * binsize].reshape(rows, full, binsize), axis=2)
+	if length % binsize:
+		tail = reduce(matrix[:, full * binsize:], axis=1)
+		binned = np.concatenate([binned, tail[:, np.newaxis]], axis=1)
+	return binned[0] if vector else binned
+
+# mean counts of a dense count vector in bins of binsize nucleotides
+def binMeans(counts, binsize):
+	"""Return the mean count of each bin of `binsize` nucleotides from the
+	start of `counts`. The last bin holds the remainder."""
+	return binMatrix(counts, binsize, "mean")
+
+# genomic center of every bin of binsize from chromStart, the last bin holds the remainder
+def binCenters(chromStart, chromEnd, binsize):
+	edges = np.append(np.arange(chromStart, chromEnd, binsize), chromEnd)
+	return (edges[:-1] + edges[1:]) / 2.0
+
+# positions of the minimum and maximum of each of at most maxPoints/2 buckets, per row
+def minMaxIndices(matrix, maxPoints):
+	"""Return indices that decimate each row of `matrix` to at most `maxPoints`
+
+	Each row is split into consecutive buckets of equal size, and the
+	positions of the bucket's minimum and maximum are kept in position
+	order. Peaks and dips therefore survive decimation, unlike plain
+	subsampling or averaging.
+
+	Parameters
+	----------
+	matrix : array-like
+		1-D vector or 2-D array with one vector per row
+
+	maxPoints : int
+		Maximum number of indices per row, at least 2
+
+	Returns
+	-------
+	numpy.ndarray
+		Sorted int array of shape (rows, points), or (points,) for a 1-D
+		input. All positions are returned when the row is short enough.
+	"""
+	if maxPoints < 2:
+		raise ValueError("maxPoints must be at least 2, got {0}".format(maxPoints))
+	matrix = np.asarray(matrix, dtype=np.float64)
+	vector = matrix.ndim == 1
+	matrix = np.atleast_2d(matrix)
+	rows, length = matrix.shape
+	if length <= maxPoints:
+		indices = np.tile(np.arange(length), (rows, 1))
+		return indices[0] if vector else indices
+
+	# pad with the last value to whole buckets, padding never beats a real position
+	size = -(-length // (maxPoints // 2))
+	buckets = -(-length // size)
+	padded = np.concatenate([matrix, np.repeat(matrix[:, -1:], buckets * size - length, axis=1)], axis=1)
+	padded = padded.reshape(rows, buckets, size)
+	offsets = np.arange(buckets) * size
+	lowest = offsets + np.argmin(padded, axis=2)
+	highest = offsets + np.argmax(padded, axis=2)
+	indices = np.stack([np.minimum(lowest, highest), np.maximum(lowest, highest)], axis=2).reshape(rows, -1)
+	indices = np.minimum(indices, length - 1)
+	return indices[0] if vector else indices
+
+# name of the per-ROI group holding the bin pyramid
+PYRAMID = "_pyramid"
+
+# pyramid levels used when no bin sizes are given
+# 10 divides every slider step (10 to 190) and the usual bin sizes, the coarser levels serve long ROIs
+DEFAULT_LEVELS = [10, 50, 200, 1000, 5000]
+
+# mean, max and sum of one bin
+_SUMMARY = np.dtype([("mean", np.float32), ("max", np.float32), ("sum", np.float32)])
+
+# mean, max and sum of counts in bins of binsize nucleotides
+def binSummary(counts, binsize):
+	counts = np.asarray(counts, dtype=np.float64)
+	summary = np.zeros(-(-len(counts) // binsize), dtype=_SUMMARY)
+	for statistic in _SUMMARY.names:
+		summary[statistic] = binMatrix(counts, binsize, statistic)
+	return summary
+
+# store pyramid levels of the given columns in a ROI group
+def writePyramid(roi, bamIDs, columns, binsizes, compression="gzip", compressionLevel=4, chunkLength=16384):
+	pyramid = roi.require_group(PYRAMID)
+	for binsize in binsizes:
+		level = pyramid.require_group(str(binsize))
+		for bamID, counts in zip(bamIDs, columns):
+			if bamID in level:
+				del level[bamID]
+			summary = binSummary(counts, binsize)
+			level.create_dataset(bamID, data=summary,
+								 **datasetOptions(len(summary), compression, compressionLevel, chunkLength))
+
+# bin sizes of the pyramid levels stored for a ROI
+def pyramidLevels(roi):
+	if not isinstance(roi, h5py.Group) or PYRAMID not in roi:
+		return []
+	return sorted(int(binsize) for binsize in roi[PYRAMID].keys())
+
+# binned statistic of a ROI for bamIDs from its pyramid, None if no level fits
+def readPyramidColumns(roi, bamIDs, binsize, statistic="mean"):
+	"""Return one vector per BAM ID of the `statistic` (mean, max or sum) of
+	each bin, merged from the largest stored level that divides `binsize`.
+	Returns None when no stored level divides `binsize` for every BAM."""
+	if statistic not in _SUMMARY.names:
+		return None
+	levels = [level for level in pyramidLevels(roi)
+			  if binsize % level == 0 and all(bamID in roi[PYRAMID][str(level)] for bamID in bamIDs)]
+	if not levels:
+		return None
+	level = roi[PYRAMID][str(levels[-1])]
+	merge = binsize // levels[-1]
+
+	chrom, chromStart, chromEnd = roiCoordinates(roi)
+	length = chromEnd - chromStart
+	widths = np.diff(np.append(np.arange(0, length, binsize), length))
+
+	binned = []
+	for bamID in bamIDs:
+		summary = level[bamID][...]
+		starts = np.arange(0, len(summary), merge)
+		if statistic == "max":
+			binned.append(np.maximum.reduceat(summary["max"].astype(np.float64), starts))
+			continue
+		sums = np.add.reduceat(summary["sum"].astype(np.float64), starts)
+		binned.append(sums if statistic == "sum" else sums / widths)
+	return binned
+
+# add pyramid levels to every ROI of an existing counts file
+def buildPyramid(filename, binsizes=DEFAULT_LEVELS, compression="gzip", compressionLevel=4, chunkLength=16384):
+	with h5py.File(filename, "a") as file:
+		for name in roiNames(file):
+			roi = file[name]
+			if not isinstance(roi, h5py.Group):
+				raise ValueError("{0} uses the old compound layout, convert it first.".format(filename))
+			bamIDs = roiBamIDs(roi)
+			writePyramid(roi, bamIDs, readColumns(roi, bamIDs), binsizes,
+						 compression, compressionLevel, chunkLength)
+	print("Added pyramid levels {0} to {1}.".format(list(binsizes), filename))
+
+# binned statistic of a ROI for bamIDs, as binMatrix computes it
+def readBinnedColumns(roi, bamIDs, binsize, statistic="mean"):
+	"""Return one vector of binned `statistic` values per BAM ID
+
+	Bins are read from the pyramid when a stored level divides `binsize`
+	(mean, max and sum). Otherwise run-length encoded columns are binned
+	straight from their runs (mean and sum), without expanding them to one
+	value per nucleotide. All remaining columns are binned together in one
+	:func:`binMatrix` call.
+	"""
+	return columnBinner(roi, bamIDs, statistic)(binsize)
+
+# function binsize -> readBinnedColumns(roi, bamIDs, binsize, statistic), reading each column at most once
+def columnBinner(roi, bamIDs, statistic="mean"):
+	"""Return a function that bins the columns of `bamIDs` at any bin size
+
+	Bin sizes a pyramid level divides are read from the pyramid. For the
+	others, run-length encoded columns (mean and sum) keep their runs in
+	memory and the remaining columns are read into one matrix on first use,
+	so binning one ROI at many bin sizes decompresses every column once.
+	"""
+	runs = {}
+	dense = []
+	for bamID in bamIDs:
+		column = roi[bamID] if isinstance(roi, h5py.Group) else None
+		if isinstance(column, h5py.Group) and statistic in ("mean", "sum"):
+			runs[bamID] = None
+		else:
+			dense.append(bamID)
+	matrix = []
+
+	def binner(binsize):
+		if statistic in ("mean", "max", "sum"):
+			binned = readPyramidColumns(roi, bamIDs, binsize, statistic)
+			if binned is not None:
+				return binned
+
+		binned = {}
+		for bamID in runs:
+			if runs[bamID] is None:
+				column = roi[bamID]
+				runs[bamID] = (int(column.attrs["length"]), column["ends"][...], column["values"][...])
+			length, ends, values = runs[bamID]
+			edges = np.append(np.arange(0, length, binsize), length)
+			sums = binRunSums(ends, values, edges)
+			binned[bamID] = sums if statistic == "sum" else sums / np.diff(edges)
+
+		if dense:
+			if not matrix:
+				matrix.append(np.array(readColumns(roi, dense), dtype=np.float64))
+			for bamID, values in zip(dense, binMatrix(matrix[0], binsize, statistic)):
+				binned[bamID] = values
+		return [binned[bamID] for bamID in bamIDs]
+	return binner
+
+# decode a string attribute stored with np.string_
+def _text(value):
+	if isinstance(value, bytes):
+		return value.decode("utf-8")
+	return value
+
+# mark a new file as using the column layout
+def initLayout(file):
+	file.attrs["layout"] = np.string_(LAYOUT)
+
+# True for files in the column layout
+def isColumnar(file):
+	return _text(file.attrs.get("layout", b"")) == LAYOUT
+
+# True for files with ROIs in the old compound layout
+def isLegacy(file):
+	return not isColumnar(file) and len(roiNames(file)) > 0
+
+# names of the ROIs in a counts file
+def roiNames(file):
+	return [name for name in file.keys() if not name.startswith("_")]
+
+# (chrom, chromStart, chromEnd) of a ROI group or legacy dataset
+def roiCoordinates(roi):
+	return _text(roi.attrs["chrom"]), int(roi.attrs["chromStart"]), int(roi.attrs["chromEnd"])
+
+# BAM IDs of a ROI, in plotting order
+def roiBamIDs(roi):
+	if isinstance(roi, h5py.Group):
+		return json.loads(_text(roi.attrs["bamIDs"]))
+	return list(roi.dtype.names)
+
+# count vectors of a ROI for bamIDs (default: all BAMs), in the order given
+def readColumns(roi, bamIDs=None):
+	"""Return a list of count vectors, one per BAM ID
+
+	For the column layout only the requested BAM datasets are read, runs
+	are decoded and compact dtypes are upcast to float64. A legacy compound
+	dataset is read once and then split into its fields.
+	"""
+	if bamIDs is None:
+		bamIDs = roiBamIDs(roi)
+	if isinstance(roi, h5py.Group):
+		return [readColumn(roi, bamID) for bamID in bamIDs]
+	data = roi[...]
+	return [data[bamID] for bamID in bamIDs]
+
+# hex digest of a ROI's coordinates and the stored counts of bamIDs (default: all BAMs)
+def roiDigest(roi, bamIDs=None):
+	"""Return a SHA-1 hex digest that changes when the ROI's coordinates or
+	the stored counts of any of `bamIDs` change
+
+	The stored form is hashed as it is, so run-length encoded columns are not
+	decoded. Rewriting a column in another dtype or encoding therefore also
+	changes the digest.
+	"""
+	if bamIDs is None:
+		bamIDs = roiBamIDs(roi)
+	digest = hashlib.sha1(json.dumps([list(roiCoordinates(roi)), list(bamIDs)]).encode("utf-8"))
+	if not isinstance(roi, h5py.Group):
+		data = roi[...]
+		for bamID in bamIDs:
+			digest.update(np.ascontiguousarray(data[bamID]).tobytes())
+		return digest.hexdigest()
+	for bamID in bamIDs:
+		column = roi[bamID]
+		parts = [column["ends"], column["values"]] if isinstance(column, h5py.Group) else [column]
+		for part in parts:
+			values = part[...]
+			digest.update(values.dtype.str.encode("utf-8"))
+			digest.update(values.tobytes())
+	return digest.hexdigest()
+
+# write one ROI group with one dataset per BAM, its attributes and completion marker
+def writeROI(file, name, chrom, chromStart, chromEnd, bamIDs, columns,
+			 compression="gzip", compressionLevel=4, chunkLength=16384, dtype="auto",
+			 encoding="auto", pyramid=None):
+
+	# drop a partial ROI left behind by an interrupted run
+	if name in file:
+		del file[name]
+	# the interval index no longer matches, lookups scan until it is rebuilt
+	dropIndex(file)
+
+	roi = file.create_group(name)
+	for bamID, counts in zip(bamIDs, columns):
+		_writeColumn(roi, bamID, counts, dtype, compression, compressionLevel, chunkLength, encoding)
+	if pyramid:
+		writePyramid(roi, bamIDs, columns, pyramid, compression, compressionLevel, chunkLength)
+
+	roi.attrs["ID"] = np.string_(name)
+	roi.attrs["chrom"] = np.string_(chrom)
+	roi.attrs["chromStart"] = chromStart
+	roi.attrs["chromEnd"] = chromEnd
+	roi.attrs["bamIDs"] = np.string_(json.dumps(list(bamIDs)))
+
+	# completion marker, written last so interrupted ROIs are recounted on --resume
+	roi.attrs["complete"] = True
+	return roi
+
+# add or replace BAM datasets of an existing ROI group
+def addColumns(roi, bamIDs, columns, compression="gzip", compressionLevel=4, chunkLength=16384,
+			   dtype="auto", encoding="auto"):
+	for bamID, counts in zip(bamIDs, columns):
+		if bamID in roi:
+			del roi[bamID]
+		_writeColumn(roi, bamID, counts, dtype, compression, compressionLevel, chunkLength, encoding)
+
+	# keep existing pyramid levels in step with the new columns
+	levels = pyramidLevels(roi)
+	if levels:
+		writePyramid(roi, bamIDs, columns, levels, compression, compressionLevel, chunkLength)
+
+	# new columns only become visible once all of them are written
+	allIDs = roiBamIDs(roi)
+	roi.attrs["bamIDs"] = np.string_(json.dumps(allIDs + [bamID for bamID in bamIDs if bamID not in allIDs]))
+
+# names of the ROIs of an open counts file that --resume can keep
+def completedROIs(file, bamIDs):
+	"""Return the names of ROI groups carrying the completion marker whose
+	BAM columns are exactly `bamIDs`. Anything else is recounted."""
+	return set(name for name in roiNames(file)
+			   if isinstance(file[name], h5py.Group) and file[name].attrs.get("complete", False)
+			   and roiBamIDs(file[name]) == list(bamIDs))
+
+# name of the interval index table
+INDEX = "_index"
+
+# a region written as chrom:start-end, commas allowed in the coordinates
+_REGION = re.compile(r"^(?P<chrom>[^:]+):(?P<start>[\d,]+)-(?P<end>[\d,]+)$")
+
+# (chrom, start, end) of a region written as chrom:start-end
+def parseRegion(region):
+	match = _REGION.match(region.strip())
+	if match is None:
+		raise ValueError("Region '{0}' is not of the form chrom:start-end.".format(region))
+	start, end = int(match.group("start").replace(",", "")), int(match.group("end").replace(",", ""))
+	if end <= start:
+		raise ValueError("Region '{0}' ends before it starts.".format(region))
+	return match.group("chrom"), start, end
+
+# write the interval index of every ROI, replacing an existing one
+def writeIndex(file):
+	"""Write the ``_index`` table: one row per ROI with ``chrom``,
+	``chromStart``, ``chromEnd``, ``maxEnd`` and ``name``, sorted by chrom
+	and start
+
+	``maxEnd`` is the largest end of the rows of the same chrom up to and
+	including the row, so it never decreases within a chrom and bounds where
+	overlapping ROIs can start. Only ROI attributes are read.
+	"""
+	rows = sorted([(roiCoordinates(file[name]), name) for name in roiNames(file)])
+	chroms = [_text(coordinates[0]).encode("utf-8") for coordinates, name in rows]
+	names = [name.encode("utf-8") for coordinates, name in rows]
+	dtype = np.dtype([("chrom", "S{0}".format(max([len(chrom) for chrom in chroms] or [1]))),
+					  ("chromStart", np.int64), ("chromEnd", np.int64), ("maxEnd", np.int64),
+					  ("name", "S{0}".format(max([len(name) for name in names] or [1])))])
+	table = np.zeros(len(rows), dtype=dtype)
+	maxEnd, previous = 0, None
+	for row, ((chrom, chromStart, chromEnd), name) in enumerate(rows):
+		maxEnd = max(maxEnd, chromEnd) if chroms[row] == previous else chromEnd
+		previous = chroms[row]
+		table[row] = (chroms[row], chromStart, chromEnd, maxEnd, names[row])
+
+	dropIndex(file)
+	file.create_dataset(INDEX, data=table)
+	return table
+
+# remove the interval index, if there is one
+def dropIndex(file):
+	if INDEX in file:
+		del file[INDEX]
+
+def hasIndex(file):
+	return INDEX in file
+
+# one field of the index rows as a sequence bisect can search, read row by row
+class _IndexColumn(object):
+	def __init__(self, table, key):
+		self.table = table
+		self.key = key
+
+	def __len__(self):
+		return len(self.table)
+
+	def __getitem__(self, row):
+		return self.key(self.table[row])
+
+# names of the ROIs overlapping chrom:start-end (end exclusive), in genomic order
+def regionROIs(file, chrom, start, end):
+	"""Return the names of ROIs with ``chromStart < end`` and
+	``chromEnd > start`` on `chrom`
+
+	With an interval index, three binary searches on the table (chrom and
+	start, then ``maxEnd``) narrow the rows down to those that can overlap,
+	reading O(log n) rows before the matching ones. Without an index every
+	ROI's attributes are scanned.
+	"""
+	if not hasIndex(file):
+		rows = [(roiCoordinates(file[name]), name) for name in roiNames(file)]
+		return [name for (roiChrom, roiStart, roiEnd), name in sorted(rows)
+				if roiChrom == chrom and roiStart < end and roiEnd > start]
+
+	table = file[INDEX]
+	chrom = chrom.encode("utf-8")
+	keys = _IndexColumn(table, lambda row: (row["chrom"], int(row["chromStart"])))
+	first = bisect.bisect_left(keys, (chrom, -1))
+	last = bisect.bisect_left(keys, (chrom, end), first)
+	# rows before this one end at or before start, as do all rows of the chrom before them
+	first = bisect.bisect_right(_IndexColumn(table, lambda row: int(row["maxEnd"])), start, first, last)
+	if first >= last:
+		return []
+	candidates = table[first:last]
+	return [_text(row["name"]) for row in candidates if row["chromEnd"] > start]
+
+# rewrite a compound-layout counts file in the column layout
+def convertLegacy(source, destination, compression="gzip", compressionLevel=4, chunkLength=16384,
+				  dtype="auto", encoding="auto"):
+	with h5py.File(source, "r") as old, h5py.File(destination, "w") as new:
+		initLayout(new)
+		for key, value in old.attrs.items():
+			new.attrs[key] = value
+		for name in roiNames(old):
+			dset = old[name]
+			chrom, chromStart, chromEnd = roiCoordinates(dset)
+			bamIDs = roiBamIDs(dset)
+			writeROI(new, name, chrom, chromStart, chromEnd, bamIDs, readColumns(dset, bamIDs),
+					 compression, compressionLevel, chunkLength, dtype, encoding)
+		writeIndex(new)
+	print("Converted {0} to the column layout in {1}.".format(source, destination))
+
+def main(args=sys.argv[1:]):
+	"""Command-line program to convert legacy counts files and build bin pyramids
+
+	Parameters
+	----------
+	argv : list, optional
+		A list of command-line arguments, which will be processed
+		as if the script were called from the command line if
+		:func:`main` is called directly.
+
+		Default: `sys.argv[1:]`. The command-line arguments, if the script is
+		invoked from the command line
+	"""
+	parser = argparse.ArgumentParser(description=__doc__,
+									 formatter_class=argparse.RawDescriptionHelpFormatter)
+	commands = parser.add_subparsers(dest="command")
+
+	convert = commands.add_parser("convert", help="Rewrite a compound-layout file in the column layout.")
+	convert.add_argument("source", type=str, help="Counts file in the compound layout.")
+	convert.add_argument("destination", type=str, help="Counts file to write in the column layout.")
+	convert.add_argument("--compression", default="gzip", choices=COMPRESSIONS,
+						 help="Compression codec for the count datasets. Default: gzip.")
+	convert.add_argument("--dtype", default="auto", choices=DTYPES,
+						 help="Storage dtype of the count datasets. Default: auto (narrowest safe dtype).")
+	convert.add_argument("--encoding", default="auto", choices=ENCODINGS,
+						 help="Column encoding. Default: auto (run-length encode when smaller).")
+
+	build = commands.add_parser("build-pyramid", help="Add bin pyramid levels to a counts file.")
+	build.add_argument("hdf5", type=str, help="Counts file in the column layout.")
+	build.add_argument("--binsizes", type=int, nargs='+', default=DEFAULT_LEVELS,
+					   help="Bin sizes of the levels. Default: 10 50 200 1000 5000.")
+	build.add_argument("--compression", default="gzip", choices=COMPRESSIONS,
+					   help="Compression codec for the pyramid datasets. Default: gzip.")
+
+	index = commands.add_parser("index", help="Write the interval index of a counts file.")
+	index.add_argument("hdf5", type=str, help="Counts file in the column layout.")
+
+	args = parser.parse_args(args)
+	if args.command == "convert":
+		convertLegacy(args.source, args.destination, compression=args.compression, dtype=args.dtype,
+					  encoding=args.encoding)
+	elif args.command == "build-pyramid":
+		buildPyramid(args.hdf5, args.binsizes, compression=args.compression)
+	elif args.command == "index":
+		with h5py.File(args.hdf5, "a") as file:
+			table = writeIndex(file)
+		print("Indexed {0} ROIs of {1}.".format(len(table), args.hdf5))
+	else:
+		parser.print_help()
+
+if __name__ == "__main__":
+	main()
@@ -19,14 +19,26 @@ import sys
 import h5py
 import glob
 import numpy as np
+import json
+import collections
+import multiprocessing
+import multiprocessing.util
+import pysam
 
 from plastid.genomics.genome_array import BAMGenomeArray
+from plastid.genomics.map_factories import CenterMapFactory, FivePrimeMapFactory
 from plastid.util.io.openers import get_short_name
 from plastid.util.io.filters import NameDateWriter
 from plastid.util.scriptlib.help_formatters import format_module_docstring
-from plastid.genomics.roitools import SegmentChain
+from plastid.genomics.roitools import SegmentChain, GenomicSegment
 from plastid.readers.bed import BED_Reader
 
+try:
+	from . import countsfile
+except (ImportError, ValueError):
+	# run as a script from the mobamplot folder
+	import countsfile
+
 # ignore and do not print any occurences of matching warnings
 warnings.simplefilter("ignore")
 
@@ -34,63 +46,627 @@ warnings.simplefilter("ignore")
 # when printed in terminal, includes the script name, time & date
 printer = NameDateWriter(get_short_name(inspect.stack()[-1][1]))
 
-# create list of tuples [(SegmentChain, counts)]
-def getCountVectorData(bedfile, bamList, bamIDs):
-	
-	# read BED file to iterator of SegmentChain objects
-	bed_segmentChains = list(BED_Reader(open(bedfile)))
+# counting engines and the mapping rules each of them supports
+ENGINES = ["plastid", "pysam"]
+MAPPINGS = ["center", "fiveprime", "coverage"]
 
-	# create list of tuples (SegmentChain, [count_vectors/BAM])
-	countVectorData = []
+# mapping rules plastid can compute, the others need the pysam engine
+PLASTID_MAPPINGS = ["center", "fiveprime"]
 
-	# iterate through ROIs
-	for index,segment in enumerate(bed_segmentChains):
+# ROIs written between flushes of the hdf5 file, fixed so the file does not depend on --chunksize
+FLUSH_INTERVAL = 50
 
-		# prints in terminal progress every 100 ROIs processed
-		if index % 100 == 0:
-			#printer.write("Processed %s regions of interest" % index)
-			print("Processed %s regions of interest" % index)
+# count reads in [start, end) of chrom directly from a pysam handle
+def countRegion(alignmentFile, chrom, start, end, strand=".", mapping="center", extension=0):
+	"""Count reads at each nucleotide of a genomic region with pysam and NumPy.
 
-		# create generator of BAMGenomeArray objects
-		print(bamList)
-		BAM_al = (BAMGenomeArray(bamfile) for bamfile in bamList)
+	Reads are fetched once for the region and every read is reduced to one
+	or more weighted intervals, which are accumulated with a difference array
+	and :func:`numpy.add.at`.
 
-		# list of count vectors per BAM
-		count_vec = [segment.get_counts(al) for al in BAM_al]
+	Parameters
+	----------
+	alignmentFile : pysam.AlignmentFile
+		Open, indexed BAM file
+
+	chrom : str
+		Chromosome name
+
+	start, end : int
+		0-based, end-exclusive region coordinates
+
+	strand : str, optional
+		``"+"`` or ``"-"`` count only reads on that strand, ``"."`` counts
+		reads on both strands, as plastid does (Default: ``"."``)
+
+	mapping : str, optional
+		``"center"`` spreads each read evenly over its aligned positions
+		(plastid's default rule), ``"fiveprime"`` counts each read once at its
+		5' end and ``"coverage"`` adds 1 at every aligned position
+		(Default: ``"center"``)
+
+	extension : int, optional
+		With ``"coverage"``, extend every read from its 5' end to this
+		fragment length, as bamliquidator does. 0 uses the aligned blocks
+		(Default: 0)
+
+	Returns
+	-------
+	numpy.ndarray
+		float64 counts of length `end - start`, in genomic order
+	"""
+	length = end - start
+	blockStarts = []
+	blockEnds = []
+	weights = []
+
+	for read in alignmentFile.fetch(chrom, max(start - extension, 0), end + extension):
+
+		# keep only reads on the requested strand
+		if read.is_unmapped or (strand == "+" and read.is_reverse) or (strand == "-" and not read.is_reverse):
+			continue
+
+		if mapping == "fiveprime":
+			fivePrime = read.reference_end - 1 if read.is_reverse else read.reference_start
+			blockStarts.append(fivePrime)
+			blockEnds.append(fivePrime + 1)
+			weights.append(1.0)
+		elif extension > 0:
+			# fragment reaching extension bp downstream of the 5' end
+			if read.is_reverse:
+				blockStarts.append(read.reference_end - extension)
+				blockEnds.append(read.reference_end)
+			else:
+				blockStarts.append(read.reference_start)
+				blockEnds.append(read.reference_start + extension)
+			weights.append(1.0)
+		else:
+			# aligned blocks skip deletions and introns
+			blocks = read.get_blocks()
+			weight = 1.0
+			if mapping == "center":
+				weight = 1.0 / sum(blockEnd - blockStart for blockStart, blockEnd in blocks)
+			for blockStart, blockEnd in blocks:
+				blockStarts.append(blockStart)
+				blockEnds.append(blockEnd)
+				weights.append(weight)
+
+	# clip intervals to the region, intervals outside cancel out
+	blockStarts = np.clip(np.array(blockStarts, dtype=np.int64) - start, 0, length)
+	blockEnds = np.clip(np.array(blockEnds, dtype=np.int64) - start, 0, length)
+	weights = np.array(weights, dtype=np.float64)
+
+	# difference array: +weight where an interval opens, -weight where it closes
+	diff = np.zeros(length + 1)
+	np.add.at(diff, blockStarts, weights)
+	np.add.at(diff, blockEnds, -weights)
+	return np.cumsum(diff[:-1])
+
+# count reads along a SegmentChain, matching SegmentChain.get_counts
+def countSegmentChain(alignmentFile, segment, mapping="center", extension=0):
+	"""Count reads along every segment of `segment` with :func:`countRegion`
+
+	Counts are returned 5' to 3' along the chain, i.e. reversed for ROIs on
+	the minus strand, as :meth:`SegmentChain.get_counts` returns them.
+	"""
+	counts = np.concatenate([countRegion(alignmentFile, seg.chrom, seg.start, seg.end, seg.strand,
+										 mapping=mapping, extension=extension)
+							 for seg in segment.segments])
+	if segment.strand == "-":
+		counts = counts[::-1]
+	return counts
+
+# why engine, mapping and extension cannot be combined, None when they can
+def countOptionsError(engine, mapping, extension=0):
+	if engine not in ENGINES:
+		return "Unknown counting engine '{0}', choose from {1}.".format(engine, ENGINES)
+	if mapping not in MAPPINGS:
+		return "Unknown mapping rule '{0}', choose from {1}.".format(mapping, MAPPINGS)
+	if engine == "plastid" and (mapping not in PLASTID_MAPPINGS or extension > 0):
+		return "Coverage mapping and read extension require the pysam engine."
+	if extension > 0 and mapping != "coverage":
+		return "Read extension is only used with coverage mapping."
+	return None
+
+# keep one open handle per BAM for a whole run
+class BAMHandlePool(object):
+	"""Open each BAM file once and hand out the same handle for every ROI.
+
+	Opening a BAM re-parses its header and re-loads its index, so doing it
+	per ROI dominates runtime on large BED files. A pool opens each BAM lazily
+	on first use, keeps it open until :meth:`close` is called and counts how
+	many files were opened and how many count vectors were read.
+
+	Counting uses either plastid (``engine="plastid"``) or the NumPy counting
+	of :func:`countRegion` (``engine="pysam"``). Both share the open handles.
+
+	The pool is a context manager::
+
+		with BAMHandlePool(bamList) as pool:
+			counts = pool.getCounts(segment, bamList[0])
+	"""
 
-		# create recorded array, columns are count vectors
-		# MUST call by BAM name, NOT ind
-		count_array = np.core.records.fromarrays(count_vec, names=bamIDs)
+	def __init__(self, bamList, engine="plastid", mapping="center", extension=0):
+		error = countOptionsError(engine, mapping, extension)
+		if error:
+			raise ValueError(error)
+
+		self.bamList = list(bamList)
+		self.engine = engine
+		self.mapping = mapping
+		self.extension = extension
+		self.opens = 0		# number of BAM files opened
+		self.reads = 0		# number of count vectors fetched
+		self._alignmentFiles = {}
+		self._genomeArrays = {}
+
+	def alignmentFile(self, bamfile):
+		"""Return the open :class:`pysam.AlignmentFile` for `bamfile`"""
+		if bamfile not in self._alignmentFiles:
+			self._alignmentFiles[bamfile] = pysam.AlignmentFile(bamfile, "rb")
+			self.opens += 1
+		return self._alignmentFiles[bamfile]
+
+	def genomeArray(self, bamfile):
+		"""Return a :class:`BAMGenomeArray` wrapping the open handle for `bamfile`"""
+		if bamfile not in self._genomeArrays:
+			genomeArray = BAMGenomeArray(self.alignmentFile(bamfile))
+			if self.mapping == "fiveprime":
+				genomeArray.set_mapping(FivePrimeMapFactory())
+			else:
+				genomeArray.set_mapping(CenterMapFactory())
+			self._genomeArrays[bamfile] = genomeArray
+		return self._genomeArrays[bamfile]
+
+	def getCounts(self, segment, bamfile):
+		"""Return the count vector of `segment` in `bamfile`"""
+		self.reads += 1
+		if self.engine == "pysam":
+			return countSegmentChain(self.alignmentFile(bamfile), segment,
+									 mapping=self.mapping, extension=self.extension)
+		return segment.get_counts(self.genomeArray(bamfile))
+
+	def getRegionCounts(self, chrom, start, end, strand, bamfile):
+		"""Return the count vector of a genomic region in `bamfile`, in genomic order"""
+		self.reads += 1
+		if self.engine == "pysam":
+			return countRegion(self.alignmentFile(bamfile), chrom, start, end, strand,
+							   mapping=self.mapping, extension=self.extension)
+		counts = SegmentChain(GenomicSegment(chrom, start, end, strand)).get_counts(self.genomeArray(bamfile))
+		if strand == "-":
+			counts = counts[::-1]
+		return counts
+
+	def stats(self):
+		"""Return a one-line summary of opens and reads"""
+		return "Opened {0} BAM file(s), read {1} count vector(s).".format(self.opens, self.reads)
+
+	def close(self):
+		"""Close every open BAM handle"""
+		for alignmentFile in self._alignmentFiles.values():
+			alignmentFile.close()
+		self._alignmentFiles = {}
+		self._genomeArrays = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+# BAM pool of the current worker process, opened by _initWorker
+_workerPool = None
+
+# open the BAM handles of one worker process of the counting pool
+def _initWorker(bamList, engine, mapping, extension):
+	global _workerPool
+	_workerPool = BAMHandlePool(bamList, engine=engine, mapping=mapping, extension=extension)
+	# close the handles when the worker process shuts down
+	multiprocessing.util.Finalize(_workerPool, _workerPool.close, exitpriority=10)
+
+# count a cluster of ROIs in one BAM, returns one count vector per ROI
+def _countCluster(pool, segments, bamfile):
+	if len(segments) == 1:
+		return [pool.getCounts(segments[0], bamfile)]
+
+	# fetch and count the merged super-region once, then slice each ROI out
+	first = segments[0].segments[0]
+	superStart = min(segment.segments[0].start for segment in segments)
+	superEnd = max(segment.segments[0].end for segment in segments)
+	superCounts = pool.getRegionCounts(first.chrom, superStart, superEnd, first.strand, bamfile)
+
+	countVectors = []
+	for segment in segments:
+		roi = segment.segments[0]
+		counts = superCounts[roi.start - superStart:roi.end - superStart]
+		# 5' to 3' order, as SegmentChain.get_counts returns it
+		if roi.strand == "-":
+			counts = counts[::-1]
+		countVectors.append(counts.copy())
+	return countVectors
+
+# group ROIs into clusters sharing one fetch per BAM
+def _sweepClusters(indexedSegments, maxSpan):
+	"""Sort ROIs by chromosome, strand and start and merge overlapping or
+	adjacent single-segment ROIs into clusters spanning at most `maxSpan` bp.
+	ROIs made of several segments stay on their own.
+
+	Yields lists of (BED index, SegmentChain)
+	"""
+	singles = []
+	for index, segment in indexedSegments:
+		if len(segment.segments) == 1:
+			singles.append((index, segment))
+		else:
+			yield [(index, segment)]
+	singles.sort(key=lambda item: (item[1].chrom, item[1].strand, item[1].segments[0].start))
+
+	cluster = []
+	span = None		# (chrom, strand, start, end) of the current cluster
+	for index, segment in singles:
+		roi = segment.segments[0]
+		if (span is not None and (roi.chrom, roi.strand) == span[:2]
+				and roi.start <= span[3] and max(span[3], roi.end) - span[2] <= maxSpan):
+			cluster.append((index, segment))
+			span = span[:3] + (max(span[3], roi.end),)
+		else:
+			if cluster:
+				yield cluster
+			cluster = [(index, segment)]
+			span = (roi.chrom, roi.strand, roi.start, roi.end)
+	if cluster:
+		yield cluster
+
+# count one shard of work: a chunk of ROI clusters in a single BAM
+def _countTask(task):
+	clusters, bamfile = task
+	# ROIs travel between processes as BED lines and are rebuilt here
+	return [_countCluster(_workerPool, [SegmentChain.from_bed(line) for line in cluster], bamfile)
+			for cluster in clusters]
+
+# yield chunks of at most chunksize items from iterable
+def _chunks(iterable, chunksize):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == chunksize:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+# yield (BED index, SegmentChain, [count_vectors/BAM]) for every ROI of every cluster
+def _countSerial(clusters, bamList, pool):
+	for cluster in clusters:
+		segments = [segment for index, segment in cluster]
+		perBAM = [_countCluster(pool, segments, bamfile) for bamfile in bamList]
+		for position, (index, segment) in enumerate(cluster):
+			yield index, segment, [counts[position] for counts in perBAM]
+
+# same as _countSerial with the (cluster, BAM) work sharded across processes
+def _countParallel(clusters, bamList, workers, chunksize, engine, mapping, extension):
+	processPool = multiprocessing.Pool(workers, initializer=_initWorker,
+									   initargs=(bamList, engine, mapping, extension))
+
+	# chunks in flight, oldest first: (chunk, [AsyncResult/BAM])
+	# at most 2 chunks per worker are pending so memory stays bounded
+	pending = collections.deque()
+	try:
+		for chunk in _chunks(clusters, chunksize):
+			# ROIs travel between processes as BED lines
+			bedLines = [[segment.as_bed() for index, segment in cluster] for cluster in chunk]
+			pending.append((chunk, [processPool.apply_async(_countTask, ((bedLines, bamfile),))
+									for bamfile in bamList]))
+			# results are taken oldest first, so cluster order is preserved
+			if len(pending) >= 2 * workers:
+				for roi in _collectChunk(*pending.popleft()):
+					yield roi
+		while pending:
+			for roi in _collectChunk(*pending.popleft()):
+				yield roi
+		processPool.close()
+	except:
+		processPool.terminate()
+		raise
+	finally:
+		processPool.join()
+
+# wait for the per-BAM results of one chunk and yield them per ROI
+def _collectChunk(chunk, asyncResults):
+	perBAM = [result.get() for result in asyncResults]
+	for clusterIndex, cluster in enumerate(chunk):
+		for position, (index, segment) in enumerate(cluster):
+			yield index, segment, [counts[clusterIndex][position] for counts in perBAM]
+
+# re-emit (BED index, SegmentChain, counts) as (SegmentChain, counts) in BED order
+# holds every ROI counted ahead of its turn, with --sweep on an unsorted BED nearly all of them
+def _inBEDOrder(roiCounts):
+	buffered = {}
+	nextIndex = 0
+	for index, segment, counts in roiCounts:
+		buffered[index] = (segment, counts)
+		while nextIndex in buffered:
+			yield buffered.pop(nextIndex)
+			nextIndex += 1
+
+# yield tuples (SegmentChain, counts) one ROI at a time, in BED order unless ordered is False
+def iterCountVectorData(bedfile, bamList, bamIDs, pool=None, workers=1, chunksize=50,
+						engine="plastid", mapping="center", extension=0,
+						sweep=False, maxSpan=1000000, skipIDs=None, ordered=True):
+	"""Count every ROI of `bedfile` in every BAM of `bamList`
+
+	ROIs whose name is in `skipIDs` are left out, e.g. when resuming a run.
+
+	With `sweep`, ROIs are sorted and overlapping or adjacent ROIs are
+	counted from one merged super-region per BAM. The BED file is then read
+	completely up front. With `ordered`, results that finish ahead of their
+	turn are buffered until they can be yielded in BED order, which on a BED
+	file not sorted by position can hold nearly every ROI's counts. Without
+	`ordered`, ROIs are yielded as they are counted (sorted order under
+	`sweep`) and at most one cluster is held.
+
+	Yields
+	------
+	tuple
+		(SegmentChain, record array with one field per BAM ID)
+	"""
+	# read BED file lazily to iterator of (index, SegmentChain)
+	bed_segmentChains = BED_Reader(open(bedfile))
+	if skipIDs:
+		bed_segmentChains = (segment for segment in bed_segmentChains
+							 if str(segment.get_name()) not in skipIDs)
+	bed_segmentChains = enumerate(bed_segmentChains)
+
+	if sweep:
+		clusters = _sweepClusters(bed_segmentChains, maxSpan)
+	else:
+		clusters = ([item] for item in bed_segmentChains)
 
-		# add tuple to countVectorData list
-		countVectorData.append((segment, count_array))
+	# open a BAM pool for a serial run unless the caller shares one
+	ownPool = workers <= 1 and pool is None
+	if ownPool:
+		pool = BAMHandlePool(bamList, engine=engine, mapping=mapping, extension=extension)
+
+	if workers > 1:
+		roiCounts = _countParallel(clusters, bamList, workers, chunksize,
+								   engine, mapping, extension)
+	else:
+		# handles are reused across ROIs
+		roiCounts = _countSerial(clusters, bamList, pool)
+
+	try:
+		# iterate through ROIs
+		if ordered:
+			roiCounts = _inBEDOrder(roiCounts)
+		else:
+			roiCounts = ((segment, counts) for index, segment, counts in roiCounts)
+		for index, (segment, count_vec) in enumerate(roiCounts):
+
+			# prints in terminal progress every 100 ROIs processed
+			if index % 100 == 0:
+				#printer.write("Processed %s regions of interest" % index)
+				print("Processed %s regions of interest" % index)
+
+			# create recorded array, columns are count vectors
+			# MUST call by BAM name, NOT ind
+			count_array = np.core.records.fromarrays(count_vec, names=bamIDs)
+
+			yield segment, count_array
+	finally:
+		if ownPool:
+			pool.close()
 
 	#printer.write("Completed processing data.")
 	print("Completed processing data.")
-	return countVectorData
-
-# save data to hdf5 file
-def saveHDF5(bedfile, bamList, bamIDs, outfolder):
-
-	countVectorData = getCountVectorData(bedfile, bamList, bamIDs)
-
-	# create h5py file in output folder
-	file = h5py.File(outfolder + "/" + os.path.splitext(os.path.basename(bedfile))[0] + ".hdf5", "w")
-
-	for segment, counts in countVectorData:
-
-		# create dataset
-		dset = file.create_dataset(str(segment.get_name()), data=counts)
+	if workers > 1:
+		print("Counted in {0} worker processes, each BAM opened once per worker.".format(workers))
+	else:
+		print(pool.stats())
 
-		# add segment chain information to dataset as attributes
-		dset.attrs["ID"] = np.string_(segment.get_name())
-		dset.attrs["chrom"] = np.string_(segment.chrom)
-		dset.attrs["chromStart"] = segment.segments[0].start
-		dset.attrs["chromEnd"] = segment.segments[0].end
+# create list of tuples [(SegmentChain, counts)]
+# holds every ROI in memory, saveHDF5 streams from iterCountVectorData instead
+def getCountVectorData(bedfile, bamList, bamIDs, pool=None, workers=1, chunksize=50,
+					   engine="plastid", mapping="center", extension=0,
+					   sweep=False, maxSpan=1000000):
+	return list(iterCountVectorData(bedfile, bamList, bamIDs, pool=pool,
+									workers=workers, chunksize=chunksize,
+									engine=engine, mapping=mapping, extension=extension,
+									sweep=sweep, maxSpan=maxSpan))
+
+# compare the pysam engine against plastid on every (ROI, BAM) of a BED file
+def validateEngines(bedfile, bamList, mapping="center", tolerance=1e-9):
+	"""Count every ROI with both engines and report vectors that differ
+
+	Returns
+	-------
+	int
+		Number of (ROI, BAM) pairs whose count vectors differ by more than
+		`tolerance` at any position
+	"""
+	if mapping not in PLASTID_MAPPINGS:
+		raise ValueError("plastid cannot count '{0}' mapping, validate with {1}.".format(mapping, PLASTID_MAPPINGS))
+	mismatches = 0
+	with BAMHandlePool(bamList, engine="plastid", mapping=mapping) as plastidPool, \
+		 BAMHandlePool(bamList, engine="pysam", mapping=mapping) as pysamPool:
+		for segment in BED_Reader(open(bedfile)):
+			for bamfile in bamList:
+				expected = plastidPool.getCounts(segment, bamfile)
+				observed = pysamPool.getCounts(segment, bamfile)
+				if len(expected) != len(observed) or not np.allclose(expected, observed, rtol=0, atol=tolerance):
+					mismatches += 1
+					print("Engine mismatch in {0} for {1}".format(segment.get_name(), bamfile))
+	print("Validated pysam engine against plastid: {0} mismatching vector(s).".format(mismatches))
+	return mismatches
+
+# write one ROI group, one dataset per BAM column of the record array counts
+def writeROI(file, segment, counts, compression="gzip", compressionLevel=4, chunkLength=16384,
+			 dtype="auto", encoding="auto", pyramid=None):
+	bamIDs = list(counts.dtype.names)
+	return countsfile.writeROI(file, str(segment.get_name()), segment.chrom,
+							   segment.segments[0].start, segment.segments[0].end,
+							   bamIDs, [counts[bamID] for bamID in bamIDs],
+							   compression, compressionLevel, chunkLength, dtype, encoding, pyramid)
+
+# refuse to modify a counts file still in the compound layout
+def _requireColumnar(file):
+	if countsfile.isLegacy(file):
+		raise ValueError("{0} uses the old compound layout, convert it with countsfile.py first.".format(file.filename))
+
+# identify the state of a BAM file so stale count columns can be detected
+def bamProvenance(bamfile):
+	return dict(path=os.path.abspath(bamfile),
+				size=os.path.getsize(bamfile),
+				mtime=os.path.getmtime(bamfile))
+
+# per-BAM provenance stored in a counts file, {bamID: {path, size, mtime}}
+def readProvenance(file):
+	if "bams" not in file.attrs:
+		return {}
+	return json.loads(file.attrs["bams"].decode("utf-8"))
+
+# record the provenance of bamList under bamIDs, keeping other BAMs' entries
+def writeProvenance(file, bamList, bamIDs):
+	provenance = readProvenance(file)
+	for bamfile, bamID in zip(bamList, bamIDs):
+		provenance[bamID] = bamProvenance(bamfile)
+	file.attrs["bams"] = np.string_(json.dumps(provenance, sort_keys=True))
+
+# counting options that change the values of a counts file, {engine, mapping, extension}
+def countSettings(engine="plastid", mapping="center", extension=0):
+	return dict(engine=engine, mapping=mapping, extension=extension)
+
+# counting options stored in a counts file, None for files written without them
+def readCountSettings(file):
+	if "countSettings" not in file.attrs:
+		return None
+	return json.loads(file.attrs["countSettings"].decode("utf-8"))
+
+def writeCountSettings(file, engine="plastid", mapping="center", extension=0):
+	file.attrs["countSettings"] = np.string_(json.dumps(countSettings(engine, mapping, extension), sort_keys=True))
+
+# counting options to add columns to a counts file with, the stored ones unless the file has none
+def storedCountSettings(file, engine=None, mapping=None, extension=None):
+	"""Return the {engine, mapping, extension} new columns of `file` are counted with.
+
+	Options left at None take the value the file was counted with. Options
+	that are given must match it, or a ValueError is raised. Files written
+	before the options were stored use the given options or the defaults.
+	"""
+	requested = dict((key, value) for key, value in (("engine", engine), ("mapping", mapping),
+													 ("extension", extension)) if value is not None)
+	stored = readCountSettings(file)
+	if stored is None:
+		return countSettings(**requested)
+	if any(stored[key] != value for key, value in requested.items()):
+		raise ValueError("{0} was counted with {1}, which conflicts with {2}.".format(file.filename, stored, requested))
+	return stored
+
+# why an existing counts file cannot be continued by this run, None if it can
+def resumeError(file, bamList, bamIDs, engine="plastid", mapping="center", extension=0):
+	recorded = readProvenance(file)
+	if sorted(recorded) != sorted(bamIDs):
+		return "{0} was counted from BAMs {1}, not {2}.".format(file.filename, sorted(recorded), sorted(bamIDs))
+	changed = [bamID for bamfile, bamID in zip(bamList, bamIDs) if bamProvenance(bamfile) != recorded[bamID]]
+	if changed:
+		return "BAM files of {0} differ from when it was counted: {1}.".format(file.filename, ", ".join(changed))
+	settings = countSettings(engine, mapping, extension)
+	if readCountSettings(file) != settings:
+		return "{0} was counted with {1}, not {2}.".format(file.filename, readCountSettings(file), settings)
+	return None
+
+# bamIDs whose BAM file has changed or disappeared since it was counted
+def staleBAMs(file):
+	stale = []
+	for bamID, recorded in sorted(readProvenance(file).items()):
+		if not os.path.exists(recorded["path"]) or bamProvenance(recorded["path"]) != recorded:
+			stale.append(bamID)
+	return stale
+
+# add (or replace) BAM columns of an existing counts file
+def appendBAMs(hdf5, bedfile, bamList, bamIDs, compression="gzip", compressionLevel=4,
+			   chunkLength=16384, dtype="auto", encoding="auto", **countOptions):
+	"""Count only `bamList` over the ROIs of `bedfile` and add the new
+	columns to the matching ROI groups of `hdf5`. Columns whose BAM ID
+	already exists are replaced, which is how stale columns are refreshed.
+	Remaining keyword arguments are passed to :func:`iterCountVectorData`.
+	``engine``, ``mapping`` and ``extension`` default to the ones the file
+	was counted with, see :func:`storedCountSettings`.
+	"""
+	file = h5py.File(hdf5, "a")
+	try:
+		_requireColumnar(file)
+		# new columns are counted like the existing ones
+		countOptions.update(storedCountSettings(file, countOptions.pop("engine", None),
+												countOptions.pop("mapping", None),
+												countOptions.pop("extension", None)))
+		# ROI groups are looked up by name, BED order is not needed
+		for segment, newCounts in iterCountVectorData(bedfile, bamList, bamIDs, ordered=False, **countOptions):
+			name = str(segment.get_name())
+			if name not in file:
+				print("ROI {0} is not in {1}, skipped.".format(name, hdf5))
+				continue
+
+			# each BAM is its own dataset, the other columns are untouched
+			countsfile.addColumns(file[name], bamIDs, [newCounts[bamID] for bamID in bamIDs],
+								  compression, compressionLevel, chunkLength, dtype, encoding)
+
+		writeProvenance(file, bamList, bamIDs)
+	finally:
+		file.close()
+	print("Added {0} BAM column(s) to {1}.".format(len(bamIDs), hdf5))
 
-	# record absolute filepath, then close file
-	filepath = os.path.abspath(file.filename)
-	file.close()
+# save data to hdf5 file
+def saveHDF5(bedfile, bamList, bamIDs, outfolder, pool=None, workers=1, chunksize=50,
+			 engine="plastid", mapping="center", extension=0,
+			 sweep=False, maxSpan=1000000,
+			 compression="gzip", compressionLevel=4, chunkLength=16384, dtype="auto",
+			 encoding="auto", pyramid=None, resume=False, flushInterval=FLUSH_INTERVAL):
+
+	filename = outfolder + "/" + os.path.splitext(os.path.basename(bedfile))[0] + ".hdf5"
+
+	# refuse unknown storage options before the file is opened or anything is counted
+	countsfile.datasetOptions(chunkLength, compression, compressionLevel, chunkLength)
+
+	resuming = resume and os.path.exists(filename)
+
+	# the file is closed, and every ROI written so far flushed, even if counting fails
+	with h5py.File(filename, "a" if resuming else "w") as file:
+		if resuming:
+			# keep complete ROIs of the previous run, count only the rest
+			_requireColumnar(file)
+			error = resumeError(file, bamList, bamIDs, engine, mapping, extension)
+			if error:
+				raise ValueError("Cannot resume: " + error)
+			countsfile.initLayout(file)
+			completeIDs = countsfile.completedROIs(file, bamIDs)
+			print("Resuming: {0} ROIs already complete.".format(len(completeIDs)))
+		else:
+			countsfile.initLayout(file)
+			# record where each BAM column comes from and how it is counted up front,
+			# so an interrupted run can be checked before it is resumed
+			writeProvenance(file, bamList, bamIDs)
+			writeCountSettings(file, engine, mapping, extension)
+			completeIDs = set()
+
+		# ROIs are written as soon as they are counted, so at most one ROI
+		# (or the chunks in flight when counting in parallel) is held in memory
+		countVectorData = iterCountVectorData(bedfile, bamList, bamIDs, pool=pool,
+											  workers=workers, chunksize=chunksize,
+											  engine=engine, mapping=mapping, extension=extension,
+											  sweep=sweep, maxSpan=maxSpan, skipIDs=completeIDs, ordered=False)
+
+		for index, (segment, counts) in enumerate(countVectorData, start=1):
+
+			writeROI(file, segment, counts, compression, compressionLevel, chunkLength, dtype, encoding, pyramid)
+
+			# push written ROIs to disk every flushInterval ROIs
+			if index % flushInterval == 0:
+				file.flush()
+
+		# sorted interval index for region lookups, once every ROI is written
+		countsfile.writeIndex(file)
+
+		filepath = os.path.abspath(file.filename)
 	#printer.write("Data successfully saved to .hdf5 file.")
 	print("Data successfully saved to .hdf5 file.")
 	return filepath
@@ -115,7 +691,7 @@ def main(args=sys.argv[1:]):
 
 	# required files
 	parser.add_argument('bedfile', type=str, help="Input BED file.")
-	group = parser.add_mutually_exclusive_group(required=True)
+	group = parser.add_mutually_exclusive_group(required=False)
 	group.add_argument('--bamfolder', help="Input folder containing BAM files.")
 	group.add_argument('--bamfiles', type=str, nargs='+', help="Input BAM files.")
 
@@ -125,8 +701,57 @@ def main(args=sys.argv[1:]):
 	# optinal args
 	parser.add_argument("--bamIDs", default=None, nargs='+',
 						help="Identification for each BAM.")
-
-	args = parser.parse_args()
+	parser.add_argument("--workers", type=int, default=1,
+						help="Number of processes counting (ROI, BAM) shards in parallel. Default: 1 (serial).")
+	parser.add_argument("--chunksize", type=int, default=50,
+						help="Number of ROIs per parallel work shard. Default: 50.")
+	parser.add_argument("--engine", default=None, choices=ENGINES,
+						help="Counting engine: plastid SegmentChain.get_counts or NumPy counting \
+						directly on pysam reads. Default: plastid, or the engine of the existing \
+						output file with --append-bam and --refresh-stale.")
+	parser.add_argument("--mapping", default=None, choices=MAPPINGS,
+						help="Mapping rule: center (reads spread over aligned positions), fiveprime \
+						(5' end) or coverage (whole read, pysam engine only). Default: center, or \
+						the mapping of the existing output file with --append-bam and --refresh-stale.")
+	parser.add_argument("--extension", type=int, default=None,
+						help="Extend reads from their 5' end to this fragment length \
+						(coverage mapping only). Default: 0 (no extension), or the extension of \
+						the existing output file with --append-bam and --refresh-stale.")
+	parser.add_argument("--sweep", default=False, action='store_true',
+						help="Sort ROIs and count overlapping or adjacent ROIs from one merged \
+						region per BAM. Output stays in BED order.")
+	parser.add_argument("--max-span", dest="maxSpan", type=int, default=1000000,
+						help="Largest merged region in bp when using --sweep. Default: 1000000.")
+	parser.add_argument("--compression", default="gzip", choices=countsfile.COMPRESSIONS,
+						help="Compression codec for the count datasets. Default: gzip.")
+	parser.add_argument("--compression-level", dest="compressionLevel", type=int, default=4,
+						choices=range(10), metavar="{0-9}",
+						help="gzip compression level. Default: 4.")
+	parser.add_argument("--chunk-length", dest="chunkLength", type=int, default=16384,
+						help="Nucleotides per HDF5 chunk of a count dataset. Default: 16384.")
+	parser.add_argument("--dtype", default="auto", choices=countsfile.DTYPES,
+						help="Storage dtype of the count datasets. auto picks the narrowest safe \
+						dtype per BAM: uint8/16/32 for whole counts, float32 otherwise. Default: auto.")
+	parser.add_argument("--encoding", default="auto", choices=countsfile.ENCODINGS,
+						help="Count column encoding. auto run-length encodes a column when that \
+						is smaller than storing every nucleotide. Default: auto.")
+	parser.add_argument("--pyramid", type=int, nargs='*', default=None, metavar="BINSIZE",
+						help="Also store mean/max/sum bin summaries at these bin sizes so plots \
+						don't re-bin the per-nucleotide counts. Without values, 10, 50, 200, \
+						1000 and 5000 are stored.")
+	parser.add_argument("--resume", default=False, action='store_true',
+						help="Continue an interrupted run: keep the complete ROIs of an existing \
+						output file and count only the remaining ones.")
+	parser.add_argument("--append-bam", dest="appendBam", default=False, action='store_true',
+						help="Count only the given BAMs and add them as new columns to the \
+						existing output file. Existing columns with the same BAM ID are replaced.")
+	parser.add_argument("--refresh-stale", dest="refreshStale", default=False, action='store_true',
+						help="Recount the columns of the existing output file whose BAM file \
+						changed since it was counted.")
+	parser.add_argument("--validate-engine", dest="validateEngine", default=False, action='store_true',
+						help="Check that the pysam engine matches plastid on every ROI, then exit.")
+
+	args = parser.parse_args(args)
 	
 	# parse args
 	bedfile = args.bedfile
@@ -135,8 +760,12 @@ def main(args=sys.argv[1:]):
 	# creates list of BAMs from folder or given files
 	if (args.bamfolder != None):
 		bamList = [file for file in glob.glob(os.path.join(args.bamfolder, "*.bam"))]
-	else:
+	elif (args.bamfiles != None):
 		bamList = args.bamfiles
+	elif args.refreshStale:
+		bamList = []
+	else:
+		parser.error("one of the arguments --bamfolder --bamfiles is required")
 
 	if (args.bamIDs != None) and (len(args.bamIDs) != len(bamList)):
 		print("InputError: Number of BAM_IDs MUST match number of BAMS. \n\
@@ -149,6 +778,30 @@ def main(args=sys.argv[1:]):
 	else:
 		bamIDs = args.bamIDs
 
+	hdf5 = os.path.join(outfolder or os.getcwd(), os.path.splitext(os.path.basename(bedfile))[0] + ".hdf5")
+
+	# columns added to, or recounted in, an existing output file are counted like the ones it has
+	if args.appendBam or args.refreshStale or (args.resume and os.path.exists(hdf5)):
+		if not os.path.exists(hdf5):
+			parser.error("{0} does not exist, count the BED file first".format(hdf5))
+		with h5py.File(hdf5, "r") as file:
+			try:
+				settings = storedCountSettings(file, args.engine, args.mapping, args.extension)
+			except ValueError as error:
+				parser.error(str(error))
+	else:
+		settings = countSettings(args.engine or "plastid", args.mapping or "center", args.extension or 0)
+
+	if args.validateEngine:
+		# the pysam engine is compared against plastid, so only plastid's mapping rules can be checked
+		if (settings["mapping"] not in PLASTID_MAPPINGS) or (settings["extension"] > 0):
+			parser.error("--validate-engine supports --mapping {0} without --extension".format(
+				" or ".join(PLASTID_MAPPINGS)))
+	else:
+		error = countOptionsError(**settings)
+		if error:
+			parser.error(error)
+
 	# if output folder not specified, use cwd
 	# if output folder doesn't exist, create it
 	# print output folder with path
@@ -157,12 +810,48 @@ def main(args=sys.argv[1:]):
 		print("No output folder specified.")
 	else:
 		if not os.path.isdir(outfolder):
-			os.mkdir(out_older)
+			os.mkdir(outfolder)
 			print("Output folder does not exist. Created folder.")
 	#printer.write("Saving counts data files to: {}".format(os.path.realpath(outfolder)))
 	print("Saving counts data files to: {}".format(os.path.realpath(outfolder)))
+	if args.validateEngine:
+		sys.exit(1 if validateEngines(bedfile, bamList, mapping=settings["mapping"]) else 0)
+
+	countOptions = dict(workers=args.workers, chunksize=args.chunksize,
+						sweep=args.sweep, maxSpan=args.maxSpan, **settings)
+
+	if args.refreshStale:
+		with h5py.File(hdf5, "r") as file:
+			provenance = readProvenance(file)
+			stale = staleBAMs(file)
+		missing = [bamID for bamID in stale if not os.path.exists(provenance[bamID]["path"])]
+		if missing:
+			print("Cannot refresh, BAM files are missing for: {0}".format(", ".join(missing)))
+			exit()
+		if not stale:
+			print("All BAM columns are up to date.")
+			return
+		print("Refreshing stale BAM columns: {0}".format(", ".join(stale)))
+		appendBAMs(hdf5, bedfile, [provenance[bamID]["path"] for bamID in stale], stale,
+				   compression=args.compression, compressionLevel=args.compressionLevel,
+				   chunkLength=args.chunkLength, dtype=args.dtype, encoding=args.encoding,
+				   **countOptions)
+		return
+
+	if args.appendBam:
+		appendBAMs(hdf5, bedfile, bamList, bamIDs, compression=args.compression,
+				   compressionLevel=args.compressionLevel, chunkLength=args.chunkLength,
+				   dtype=args.dtype, encoding=args.encoding, **countOptions)
+		return
+
 	# run saveHDF5
-	saveHDF5(bedfile, bamList, bamIDs, outfolder)
+	saveHDF5(bedfile, bamList, bamIDs, outfolder, workers=args.workers, chunksize=args.chunksize,
+			 engine=settings["engine"], mapping=settings["mapping"], extension=settings["extension"],
+			 sweep=args.sweep, maxSpan=args.maxSpan, compression=args.compression,
+			 compressionLevel=args.compressionLevel, chunkLength=args.chunkLength,
+			 dtype=args.dtype, encoding=args.encoding,
+			 pyramid=countsfile.DEFAULT_LEVELS if args.pyramid == [] else args.pyramid,
+			 resume=args.resume)
 
 
 if __name__ == "__main__":
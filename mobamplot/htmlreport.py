@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Write mobamplot figures as HTML that shares one copy of plotly.js.
+
+``plotly.offline.plot`` embeds the whole plotly.js library (several MB) in
+every HTML file it writes. The writers below put ``plotly.min.js`` in the
+output folder once and reference it from each figure instead.
+
+Output modes
+------------
+``standalone``
+	one self-contained HTML file per ROI, written by ``plotly.offline.plot``
+``shared``
+	one small HTML file per ROI loading the folder's ``plotly.min.js``
+``report``
+	one ``report.html`` listing every ROI in pages. Each ROI's figure is kept
+	in ``data/<ROI>.js`` and only loaded when its panel scrolls into view.
+"""
+import json
+import os
+
+import plotly
+from plotly.offline.offline import get_plotlyjs
+
+# output modes of the HTML writers
+HTML_MODES = ["standalone", "shared", "report"]
+
+# file name of the shared plotly.js bundle
+PLOTLYJS = "plotly.min.js"
+
+# folder of the report's per-ROI figure scripts, relative to the output folder
+REPORT_DATA = "data"
+
+# file name of the report page
+REPORT = "report.html"
+
+_FIGURE_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotlyjs}"></script>
+</head>
+<body>
+<div id="figure" style="width:100%;height:100vh;"></div>
+<script>
+var figure = {figure};
+Plotly.newPlot("figure", figure.data, figure.layout, {{showLink: false}});
+</script>
+</body>
+</html>
+"""
+
+_FIGURE_SCRIPT = """mobamplotReport.add({name}, {figure});
+"""
+
+_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotlyjs}"></script>
+<style>
+body {{ font-family: sans-serif; margin: 0 2em; }}
+nav {{ position: sticky; top: 0; background: white; padding: 0.5em 0; }}
+.roi {{ min-height: 600px; border-bottom: 1px solid #ddd; }}
+</style>
+</head>
+<body>
+<nav>
+<button id="previous">&lt;</button>
+<span id="page"></span>
+<button id="next">&gt;</button>
+</nav>
+<div id="rois"></div>
+<script>
+var mobamplotReport = (function () {{
+	var names = {names};
+	var pageSize = {pageSize};
+	var dataFolder = {dataFolder};
+	var page = 0;
+	var observer = new IntersectionObserver(function (entries) {{
+		entries.forEach(function (entry) {{
+			if (!entry.isIntersecting) {{ return; }}
+			observer.unobserve(entry.target);
+			// load the ROI's figure script, which calls add() when done
+			var script = document.createElement("script");
+			script.src = dataFolder + "/" + encodeURIComponent(entry.target.dataset.name) + ".js";
+			document.head.appendChild(script);
+		}});
+	}}, {{rootMargin: "600px"}});
+
+	function show(number) {{
+		var pages = Math.max(1, Math.ceil(names.length / pageSize));
+		page = Math.min(Math.max(number, 0), pages - 1);
+		var rois = document.getElementById("rois");
+		observer.disconnect();
+		while (rois.firstChild) {{
+			Plotly.purge(rois.firstChild);
+			rois.removeChild(rois.firstChild);
+		}}
+		names.slice(page * pageSize, (page + 1) * pageSize).forEach(function (name) {{
+			var div = document.createElement("div");
+			div.className = "roi";
+			div.id = "roi-" + name;
+			div.dataset.name = name;
+			rois.appendChild(div);
+			observer.observe(div);
+		}});
+		document.getElementById("page").textContent = "page " + (page + 1) + " of " + pages;
+		window.location.hash = page + 1;
+		window.scrollTo(0, 0);
+	}}
+
+	document.getElementById("previous").onclick = function () {{ show(page - 1); }};
+	document.getElementById("next").onclick = function () {{ show(page + 1); }};
+	window.addEventListener("load", function () {{
+		show((parseInt(window.location.hash.slice(1), 10) || 1) - 1);
+	}});
+
+	return {{
+		add: function (name, figure) {{
+			var div = document.getElementById("roi-" + name);
+			if (div) {{
+				Plotly.newPlot(div, figure.data, figure.layout, {{showLink: false}});
+			}}
+		}}
+	}};
+}})();
+</script>
+</body>
+</html>
+"""
+
+# JSON of a figure's data and layout, as plotly.offline.plot serializes them
+def figureJSON(fig):
+	return json.dumps({"data": fig.get("data", []), "layout": fig.get("layout", {})},
+					  cls=plotly.utils.PlotlyJSONEncoder)
+
+# JSON for inlining in a <script> element
+def _scriptJSON(value):
+	return value.replace("</", "<\\/")
+
+# write plotly.js to the output folder unless it is already there, returns its path
+def writePlotlyJS(outfolder):
+	path = os.path.join(outfolder, PLOTLYJS)
+	if not os.path.exists(path):
+		# written under a temporary name so parallel runs never see a partial file
+		temporary = "{0}.{1}.tmp".format(path, os.getpid())
+		with open(temporary, "w") as handle:
+			handle.write(get_plotlyjs())
+		os.rename(temporary, path)
+	return path
+
+# write one figure as an HTML page loading the shared plotly.js, returns its path
+def writeFigureHTML(fig, outfolder, name, title=None):
+	path = os.path.join(outfolder, name + ".html")
+	with open(path, "w") as handle:
+		handle.write(_FIGURE_PAGE.format(title=title or name, plotlyjs=PLOTLYJS,
+										 figure=_scriptJSON(figureJSON(fig))))
+	return path
+
+# write one figure as a report data script, returns its path
+def writeFigureData(fig, outfolder, name):
+	folder = os.path.join(outfolder, REPORT_DATA)
+	if not os.path.isdir(folder):
+		try:
+			os.makedirs(folder)
+		except OSError:
+			# made by another rendering process in the meantime
+			if not os.path.isdir(folder):
+				raise
+	path = os.path.join(folder, name + ".js")
+	with open(path, "w") as handle:
+		handle.write(_FIGURE_SCRIPT.format(name=json.dumps(name),
+										   figure=_scriptJSON(figureJSON(fig))))
+	return path
+
+# write the paginated report page listing names, pageSize ROIs per page, returns its path
+def writeReport(outfolder, names, pageSize=50, title="mobamplot report"):
+	if pageSize < 1:
+		raise ValueError("pageSize must be at least 1, got {0}".format(pageSize))
+	path = os.path.join(outfolder, REPORT)
+	with open(path, "w") as handle:
+		handle.write(_REPORT_PAGE.format(title=title, plotlyjs=PLOTLYJS,
+										 names=_scriptJSON(json.dumps(list(names))),
+										 pageSize=int(pageSize),
+										 dataFolder=json.dumps(REPORT_DATA)))
+	return path
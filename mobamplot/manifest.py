@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Track which figures in an output folder are up to date.
+
+The manifest is a JSON file in the output folder mapping each figure name to
+a digest of everything the figure was drawn from: the ROI's coordinates and
+stored counts, the plotted BAMs and the plot options. A rerun skips every
+figure whose digest is unchanged and whose output file still exists.
+"""
+import hashlib
+import json
+import os
+
+# file name of the manifest in the output folder
+MANIFEST = "mobamplot.manifest.json"
+
+# bumped when figures drawn from the same data and options would change
+VERSION = 1
+
+# figure name -> digest of the figures in outfolder, empty when there is no manifest
+def load(outfolder):
+	path = os.path.join(str(outfolder), MANIFEST)
+	if not os.path.exists(path):
+		return {}
+	with open(path) as handle:
+		try:
+			manifest = json.load(handle)
+		except ValueError:
+			# unreadable manifest, every figure is rebuilt
+			return {}
+	if manifest.get("version") != VERSION:
+		return {}
+	return dict(manifest.get("figures", {}))
+
+# write the figure name -> digest mapping to outfolder, replacing the manifest at once
+def save(outfolder, figures):
+	path = os.path.join(str(outfolder), MANIFEST)
+	temporary = "{0}.{1}.tmp".format(path, os.getpid())
+	with open(temporary, "w") as handle:
+		json.dump(dict(version=VERSION, figures=figures), handle, indent=0, sort_keys=True)
+	os.rename(temporary, path)
+	return path
+
+# digest of plot options, a dict of JSON-serializable values
+def optionsDigest(options):
+	return hashlib.sha1(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()
+
+# digest of one figure from its data digest and its options digest
+def figureDigest(dataDigest, optionsDigest):
+	return hashlib.sha1("{0}:{1}:{2}".format(VERSION, dataDigest, optionsDigest).encode("utf-8")).hexdigest()
+
+# whether a figure with digest is up to date: same digest as last time and its file still there
+# path = output file of the figure
+def upToDate(previous, digest, path):
+	return (previous == digest) and os.path.exists(path)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Aggregate the ROIs of a counts file into a metaplot in one streaming pass.
+
+Every ROI is turned into a profile of the same number of bins per BAM, in
+one of two modes:
+
+``scaled``
+	the whole ROI is rescaled to a fixed number of bins, so ROIs of any
+	length line up from start to end
+``center``
+	a window of fixed flanks around the ROI center is binned. The center is
+	position ``length // 2``: the middle nucleotide of an odd-length ROI and
+	the first nucleotide right of the midpoint of an even-length one, so
+	both halves of an even-length ROI are equally long. Position 0 of the
+	profile is the start of the center nucleotide. Bins outside a short ROI
+	are missing and left out of that bin's statistics.
+
+Profiles are in the orientation of the stored counts, so minus-strand ROIs
+already run 5' to 3'.
+
+The profiles are aggregated as they are read. Mean and variance per bin use
+Welford's online update. Median and quantile bands come from a uniform
+reservoir sample of at most ``reservoir`` ROI profiles, which is exact while
+the file holds fewer ROIs than that. Memory therefore does not grow with the
+number of ROIs.
+
+A heatmap reads the ROIs twice. The first pass sums every ROI's signal,
+which fixes the row order and so the output row each ROI is averaged into.
+The second pass adds each ROI's profile, downsampled to at most the
+requested number of columns, to its row. Memory is rows x BAMs x columns,
+whatever the number of ROIs.
+"""
+import warnings
+
+import numpy as np
+
+try:
+	from . import countsfile
+except (ImportError, ValueError):
+	# run as a script from the mobamplot folder
+	import countsfile
+
+# ways of lining up ROIs
+METAPLOT_MODES = ["scaled", "center"]
+
+# quantile band drawn around the median, as lower and upper quantile
+BAND = (0.25, 0.75)
+
+# rescale each row of a ROI x position matrix to nbins bins of equal width
+# bins are averages over fractional positions, so ROIs shorter than nbins work too
+def scaleProfile(matrix, nbins):
+	matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+	length = matrix.shape[1]
+	if length == 0:
+		return np.full((matrix.shape[0], nbins), np.nan)
+
+	# running total at every bin edge, linear within a position
+	cumulative = np.zeros((matrix.shape[0], length + 1))
+	np.cumsum(matrix, axis=1, out=cumulative[:, 1:])
+	edges = np.linspace(0, length, nbins + 1)
+	left = np.minimum(edges.astype(np.intp), length - 1)
+	fraction = edges - left
+	atEdges = cumulative[:, left] + fraction * (cumulative[:, left + 1] - cumulative[:, left])
+	return np.diff(atEdges, axis=1) / np.diff(edges)
+
+# bin a window of flank positions on either side of the ROI center, position length // 2
+# positions outside the ROI are NaN, bins without any position are NaN
+def centerProfile(matrix, flank, binsize):
+	matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+	length = matrix.shape[1]
+	nbins = -(-2 * flank // binsize)
+	window = np.full((matrix.shape[0], nbins * binsize), np.nan)
+
+	# window start relative to the ROI
+	start = length // 2 - flank
+	first, last = max(start, 0), min(start + nbins * binsize, length)
+	if last > first:
+		window[:, first - start:last - start] = matrix[:, first:last]
+
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore", RuntimeWarning)
+		return np.nanmean(window.reshape(matrix.shape[0], nbins, binsize), axis=2)
+
+# x coordinates of the profile bins: 0 to 100 % of the ROI, or bp from the start of the center position
+def profilePositions(mode, nbins=100, flank=2000, binsize=200):
+	if mode == "scaled":
+		return (np.arange(nbins) + 0.5) * 100.0 / nbins
+	return np.arange(-(-2 * flank // binsize)) * binsize - flank + binsize / 2.0
+
+# x coordinates of the heatmap columns: the profile bin centers, averaged as downsample groups the bins
+def heatmapPositions(mode, columns=200, flank=2000, binsize=200):
+	if mode == "scaled":
+		return profilePositions(mode, columns)
+	return downsample(profilePositions(mode, flank=flank, binsize=binsize)[np.newaxis], columns, axis=1)[0]
+
+class MetaAggregate(object):
+	"""Streaming per-bin statistics of BAM x bin profiles
+
+	Each call to ``add`` takes one ROI's profiles (one row per BAM, NaN for
+	missing bins) and updates the count, mean and sum of squared deviations
+	of every bin, and a reservoir sample of whole profiles for quantiles.
+	"""
+
+	def __init__(self, nBAMs, nbins, reservoir=1000, seed=0):
+		if reservoir < 1:
+			raise ValueError("reservoir must hold at least 1 profile, got {0}".format(reservoir))
+		self.count = np.zeros((nBAMs, nbins))
+		self.mean = np.zeros((nBAMs, nbins))
+		self._m2 = np.zeros((nBAMs, nbins))
+		self.rois = 0
+		self._sample = np.full((reservoir, nBAMs, nbins), np.nan)
+		self._random = np.random.RandomState(seed)
+
+	# add the profiles of one ROI
+	def add(self, profiles):
+		profiles = np.asarray(profiles, dtype=np.float64)
+		present = ~np.isnan(profiles)
+
+		# Welford update, only where the bin was observed
+		self.count += present
+		delta = np.where(present, profiles - self.mean, 0.0)
+		self.mean += np.where(present, delta / np.maximum(self.count, 1), 0.0)
+		self._m2 += np.where(present, delta * (profiles - self.mean), 0.0)
+
+		# reservoir sample of whole profiles (algorithm R)
+		if self.rois < len(self._sample):
+			self._sample[self.rois] = profiles
+		else:
+			slot = self._random.randint(0, self.rois + 1)
+			if slot < len(self._sample):
+				self._sample[slot] = profiles
+		self.rois += 1
+
+	# sample variance of every bin, NaN where fewer than 2 values were seen
+	def variance(self):
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return np.where(self.count > 1, self._m2 / (self.count - 1), np.nan)
+
+	# standard error of the mean of every bin
+	def standardError(self):
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return np.sqrt(self.variance() / self.count)
+
+	# quantile q (0 to 1) of every bin, from the reservoir sample
+	def quantile(self, q):
+		sample = self._sample[:min(self.rois, len(self._sample))]
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", RuntimeWarning)
+			return np.nanpercentile(sample, 100.0 * q, axis=0)
+
+	def median(self):
+		return self.quantile(0.5)
+
+# aggregate the ROIs IDs of an open counts file, reading one ROI at a time
+def aggregate(f, IDs, bamIDs, mode="scaled", nbins=100, flank=2000, binsize=200, reservoir=1000):
+	if mode not in METAPLOT_MODES:
+		raise ValueError("mode must be one of {0}, got {1!r}".format(METAPLOT_MODES, mode))
+	width = nbins if mode == "scaled" else len(profilePositions(mode, flank=flank, binsize=binsize))
+	meta = MetaAggregate(len(bamIDs), width, reservoir)
+	for ID in IDs:
+		matrix = np.array(countsfile.readColumns(f[ID], bamIDs), dtype=np.float64)
+		if mode == "scaled":
+			meta.add(scaleProfile(matrix, nbins))
+		else:
+			meta.add(centerProfile(matrix, flank, binsize))
+	return meta
+
+# average groups of consecutive entries along axis so at most size remain, NaNs are skipped
+def downsample(matrix, size, axis=0):
+	length = matrix.shape[axis]
+	if length <= size:
+		return matrix
+	starts = np.unique(np.linspace(0, length, size + 1).astype(np.intp)[:-1])
+	present = ~np.isnan(matrix)
+	sums = np.add.reduceat(np.where(present, matrix, 0), starts, axis=axis)
+	counts = np.add.reduceat(present.astype(np.intp), starts, axis=axis)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return (sums / counts).astype(matrix.dtype)
+
+# heatmap row of each of nROIs ROIs in row order, groups of consecutive ROIs as downsample makes them
+def heatmapRows(nROIs, rows):
+	if nROIs <= rows:
+		return np.arange(nROIs)
+	starts = np.unique(np.linspace(0, nROIs, rows + 1).astype(np.intp)[:-1])
+	return np.searchsorted(starts, np.arange(nROIs), side="right") - 1
+
+# BAM x row x column heatmaps of the ROIs IDs of an open counts file, reading one ROI at a time
+# returns the heatmaps, the ROI IDs in row order and their total signal
+def heatmapMatrix(f, IDs, bamIDs, mode="scaled", columns=200, flank=2000, binsize=200, rows=1000,
+				  sort=True):
+	if mode not in METAPLOT_MODES:
+		raise ValueError("mode must be one of {0}, got {1!r}".format(METAPLOT_MODES, mode))
+	width = columns if mode == "scaled" else len(profilePositions(mode, flank=flank, binsize=binsize))
+
+	# pass 1: total signal of every ROI, strongest ROIs first, ties in file order
+	totals = np.array([np.sum(countsfile.readColumns(f[ID], bamIDs)) for ID in IDs], dtype=np.float64)
+	order = np.argsort(-totals, kind="mergesort") if sort else np.arange(len(IDs))
+	rowOf = np.empty(len(IDs), dtype=np.intp)
+	rowOf[order] = heatmapRows(len(IDs), rows)
+
+	# pass 2: every profile is added to the row it is averaged into, NaN bins are skipped
+	sums = np.zeros((min(len(IDs), rows), len(bamIDs), min(width, columns)))
+	counts = np.zeros(sums.shape, dtype=np.intp)
+	for index, ID in enumerate(IDs):
+		matrix = np.array(countsfile.readColumns(f[ID], bamIDs), dtype=np.float64)
+		if mode == "scaled":
+			profile = scaleProfile(matrix, columns)
+		else:
+			profile = downsample(centerProfile(matrix, flank, binsize), columns, axis=1)
+		present = ~np.isnan(profile)
+		sums[rowOf[index]] += np.where(present, profile, 0.0)
+		counts[rowOf[index]] += present
+
+	with np.errstate(invalid="ignore", divide="ignore"):
+		heatmaps = (sums / counts).astype(np.float32)
+	return heatmaps.transpose(1, 0, 2), [IDs[row] for row in order], totals[order]
@@ -7,161 +7,548 @@ their respective BAM-associated count_vectors.
 Output files
 ------------
 HTML files save in a user-specified output folder or current working directoy as individual files 
-named after the ROI's chromosome and the binsize to which it corresponds.
+named after the ROI's ID (and the binsize for line plots). ROIs can be rendered
+in parallel with ``--jobs``.
 HTML files do not automatically open in current web browswer or open in new webpage with one ROI per tab.
 """
 import argparse
+import glob
+import hashlib
 import inspect
+import multiprocessing
+import multiprocessing.util
 import os
-import subprocess
+import re
 import warnings
 import sys
 import h5py
 import numpy as np
-import scipy.stats as stats
-import statistics
-import math
+import time
+import webbrowser
 
 import plotly
-import plotly.plotly as py
-import plotly.tools as tls
 import plotly.graph_objs as go
-import plotly.plotly as py
 
 from plastid.util.io.openers import get_short_name
 from plastid.util.io.filters import NameDateWriter
 from plastid.util.scriptlib.help_formatters import format_module_docstring
 
+try:
+	from . import countsfile
+	from . import htmlreport
+	from . import manifest
+	from . import metaplot
+	from . import staticplot
+except (ImportError, ValueError):
+	# run as a script from the mobamplot folder
+	import countsfile
+	import htmlreport
+	import manifest
+	import metaplot
+	import staticplot
+
+
+# bin sizes offered by the histogram slider, from 10 to 190 in step size of 10
+SLIDER_BINSIZES = list(range(10, 200, 10))
 
 # ignore and do not print any occurences of matching warnings
 warnings.simplefilter("ignore")
 # A stream to which stderr-like info can be written
 printer = NameDateWriter(get_short_name(inspect.stack()[-1][1]))
 
-# call getCoutVectorData to create hdf5 file with counts
-def callFunc(bedfile, bamList, bamIDs, outfolder):
-	printer.write("Calling getcountvectordata.py")
+# count the ROIs of bedfile and plot them in this process, options as for pipeline.run
+def callFunc(bedfile, bamList, bamIDs, outfolder, **options):
+	printer.write("Counting and plotting {0} in-process".format(bedfile))
+
+	# imported here, pipeline imports this module
+	try:
+		from . import pipeline
+	except (ImportError, ValueError):
+		import pipeline
+	return pipeline.run(bedfile, bamList, bamIDs, outfolder, **options)
+
+# file name of a ROI's figure, from its ROI ID so every ROI gets its own file
+# an ID that is changed to make it a file name gets a short hash of the ID, so "a b" and "a_b" differ
+def figureName(ID, suffix):
+	name = re.sub(r"[^\w.-]+", "_", ID).strip("_")
+	if name != ID:
+		name += "_" + hashlib.sha1(ID.encode("utf-8")).hexdigest()[:8]
+	return name + suffix
+
+# histogram figure from binned counts, binned = counts/bin per BAM for each of binsizes
+# only the traces of binsize are visible at first, a slider switches between bin sizes
+def histFigure(chrom, chromStart, chromEnd, ID, bamIDs, binned, binsizes, binsize, maxPoints=None, webgl=False):
+
+	# y-range from the arrays of every slider step, before any trace is built
+	y_range_max = staticplot.yRangeMax([counts for countAvg in binned for counts in countAvg])
+
+	traces = []
+	for step_binsize, countAvg in zip(binsizes, binned):
+		traces += [make_trace_hist(chromStart, chromEnd, countAvg[index-1], BAM, step_binsize, index,
+								   visible=(step_binsize == binsize), maxPoints=maxPoints, webgl=webgl)
+				   for index, BAM in enumerate(bamIDs, start=1)]
+
+	# a Bar object per slider step for every BAM to respective subplot
+	layout = roiLayout(layoutTemplate(len(bamIDs)), chrom, chromStart, chromEnd, ID, y_range_max, titles=bamIDs)
+	fig = dict(data=traces, layout=layout)
+	if len(binsizes) > 1:
+		fig = addSlider(fig, binsizes, len(bamIDs), binsizes.index(binsize))
+	return fig
 
-	# create list of arguments to feed into fxn as if calling from the terminal
-	args = ['python', '/home/monika/myBamPlot/bamPlotCode/getCountVectorData.py', bedfile, '--bamfiles'] + bamList + ['--outfolder', outfolder, '--bamIDs'] + bamIDs
-	
-	# call function
-	process = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
-	# print stdout messages of fxn
-	print(process.communicate()[0].encode('utf-8').decode('unicode_escape'))
+# line figure from binned counts, countAvg = counts/bin of binsize per BAM
+def lineFigure(chrom, chromStart, chromEnd, ID, bamIDs, countAvg, binsize, maxPoints=None, webgl=False):
+
+	### BINNING
+	# centers of bins of binsize from chromStart, the last bin holds the remainder
+	x_data_binned_mean = countsfile.binCenters(chromStart, chromEnd, binsize)
+
+	# a Scatter object for every BAM to respective subplot
+	layout = roiLayout(layoutTemplate(len(bamIDs)), chrom, chromStart, chromEnd, ID, staticplot.yRangeMax(countAvg))
+	traces = [make_trace_line(x_data_binned_mean, countAvg[index-1], BAM, index, maxPoints, webgl)
+			  for index, BAM in enumerate(bamIDs, start=1)]
+	return dict(data=traces, layout=layout)
+
+# save a plotly figure named name to outfolder as html, static images are drawn by staticplot
+def saveFigure(fig, name, title, outfolder, viewplot, html="standalone"):
+	if html == "shared":
+		# small HTML page loading the folder's plotly.js
+		path = htmlreport.writeFigureHTML(fig, outfolder, name, title=title)
+		if viewplot:
+			webbrowser.open("file://" + os.path.realpath(path))
+	elif html == "report":
+		# figure loaded by the report page when scrolled into view
+		htmlreport.writeFigureData(fig, outfolder, name)
+	else:
+		# traces and layout are plain plotly.js dicts, not validated through graph_objs again
+		plot_url = plotly.offline.plot(fig, filename=str(outfolder) + "/" + name,
+									   auto_open=viewplot, validate=False)
+
+# raise ValueError for names in rois that are not in f and for a region not written as chrom:start-end
+def checkSelection(f, rois=None, region=None):
+	missing = [name for name in (rois or []) if name not in f]
+	if missing:
+		raise ValueError("ROIs not in {0}: {1}".format(f.filename, ", ".join(missing)))
+	if region:
+		countsfile.parseRegion(region)
+
+# names of the ROIs to plot: those named in rois and those overlapping region (chrom:start-end)
+# all ROIs when neither is given
+def selectROIs(f, rois=None, region=None):
+	if not rois and not region:
+		return countsfile.roiNames(f)
+
+	checkSelection(f, rois, region)
+	IDs = list(rois or [])
+	if region:
+		if not countsfile.hasIndex(f):
+			printer.write("No interval index in {0}, scanning all ROIs. Run countsfile.py index to add one.".format(f.filename))
+		IDs += [name for name in countsfile.regionROIs(f, *countsfile.parseRegion(region)) if name not in IDs]
+	printer.write("Selected {0} ROIs.".format(len(IDs)))
+	return IDs
+
+# figure name of a ROI for the given plot options
+def figureFileName(ID, line, binsize, renderer="plotly"):
+	if renderer == "matplotlib":
+		# static images hold a single bin size
+		return figureName(ID, ".line.bin" + str(binsize) if line else ".hist.bin" + str(binsize))
+	if line == False:
+		return figureName(ID, ".hist")
+	return figureName(ID, ".line.bin" + str(binsize))
+
+# file a figure is saved to, static images are always drawn into outfolder by staticplot
+def figurePath(outfolder, name, filetype, html="standalone", renderer="plotly"):
+	if (renderer == "matplotlib") or (filetype != None):
+		return os.path.join(str(outfolder), name + "." + filetype)
+	if html == "report":
+		return os.path.join(str(outfolder), htmlreport.REPORT_DATA, name + ".js")
+	return os.path.join(str(outfolder), name + ".html")
+
+# render one ROI of an open hdf5 file, returns the figure name
+def plotROI(f, ID, line, filetype, outfolder, viewplot, binsize, samples=None, statistic="mean",
+			html="standalone", renderer="plotly", maxPoints=None, webgl=False):
+	roi = f[ID]
+	chrom, chromStart, chromEnd = countsfile.roiCoordinates(roi)	# chromosome, start & end coordinates
+	bamIDs = samples or countsfile.roiBamIDs(roi)	# only the requested samples are read
+
+	# counts/bin per BAM at any bin size, from the pyramid when it has the level, else from columns read once
+	binner = countsfile.columnBinner(roi, bamIDs, statistic)
+	return plotBinned(ID, chrom, chromStart, chromEnd, bamIDs, binner, line, filetype, outfolder, viewplot,
+					  binsize, html, renderer, maxPoints, webgl)
+
+# render one ROI whose counts come from binner(binsize) -> counts/bin per BAM, returns the figure name
+def plotBinned(ID, chrom, chromStart, chromEnd, bamIDs, binner, line, filetype, outfolder, viewplot, binsize,
+			   html="standalone", renderer="plotly", maxPoints=None, webgl=False):
+	name = figureFileName(ID, line, binsize, renderer)
+
+	if renderer == "matplotlib":
+		# headless image, no plotly figure is built
+		staticplot.renderROI(figurePath(outfolder, name, filetype, html, renderer), chrom, chromStart,
+							 chromEnd, bamIDs, binner(binsize), binsize, ID, line=line)
+		return name
+
+	# files saved to specified output folder and named by ROI
+	if line == False:
+		slider_binsizes = sorted(set(SLIDER_BINSIZES + [binsize]))
+		binned = [binner(step_binsize) for step_binsize in slider_binsizes]
+		fig = histFigure(chrom, chromStart, chromEnd, ID, bamIDs, binned, slider_binsizes, binsize, maxPoints, webgl)
+	else:
+		fig = lineFigure(chrom, chromStart, chromEnd, ID, bamIDs, binner(binsize), binsize, maxPoints, webgl)
+
+	saveFigure(fig, name, ID, outfolder, viewplot, html)
+	return name
+
+# hdf5 file of the current rendering worker process, opened by _initRenderer
+_renderFile = None
+
+# open the hdf5 file read-only in one rendering worker process
+def _initRenderer(hdf5):
+	global _renderFile
+	_renderFile = h5py.File(hdf5, "r")
+	multiprocessing.util.Finalize(_renderFile, _renderFile.close, exitpriority=10)
+
+# render one ROI unless its figure is up to date, returns (ID, figure name, seconds, digest)
+# seconds is None for a skipped ROI, previous = the figure's digest in the manifest
+def renderROI(f, ID, options, previous=None, optionsDigest="", force=False):
+	roi = f[ID]
+	bamIDs = options["samples"] or countsfile.roiBamIDs(roi)
+	digest = manifest.figureDigest(countsfile.roiDigest(roi, bamIDs), optionsDigest)
+	name = figureFileName(ID, options["line"], options["binsize"], options["renderer"])
+	path = figurePath(options["outfolder"], name, options["filetype"], options["html"], options["renderer"])
+	if (not force) and manifest.upToDate(previous, digest, path):
+		return ID, name, None, digest
+
+	start = time.time()
+	plotROI(f, ID, **options)
+	return ID, name, time.time() - start, digest
+
+# render one ROI in a worker
+def _renderTask(task):
+	ID, options, previous, optionsDigest, force = task
+	return renderROI(_renderFile, ID, options, previous, optionsDigest, force)
+
+# print how many ROIs were rendered or skipped and how long rendering took
+def reportRenderTimes(timings, slowest=5):
+	rendered = [timing for timing in timings if timing[2] is not None]
+	skipped = len(timings) - len(rendered)
+	if skipped:
+		printer.write("Skipped {0} ROIs whose figures are up to date.".format(skipped))
+	if not rendered:
+		printer.write("No ROIs rendered.")
+		return
+	seconds = [timing[2] for timing in rendered]
+	printer.write("Rendered {0} ROIs, {1:.2f} s in total, {2:.3f} s per ROI on average.".format(
+		len(rendered), sum(seconds), sum(seconds) / len(seconds)))
+	for timing in sorted(rendered, key=lambda item: (-item[2], item[0]))[:slowest]:
+		printer.write("  {0:.3f} s  {1}".format(timing[2], timing[1]))
+
+# check and complete the output options, returns (filetype, html, renderer)
+def outputOptions(filetype, html="standalone", renderer="plotly"):
+	if html not in htmlreport.HTML_MODES:
+		raise ValueError("html must be one of {0}, got {1!r}".format(htmlreport.HTML_MODES, html))
+	if filetype != None:
+		# plotly writes static images only through a web browser or its cloud service, matplotlib draws them
+		renderer = "matplotlib"
+	if renderer == "matplotlib":
+		filetype = filetype or "png"
+		if filetype not in staticplot.STATIC_FORMATS:
+			raise ValueError("matplotlib renders {0}, got {1!r}".format(staticplot.STATIC_FORMATS, filetype))
+		if not staticplot.available():
+			raise ImportError("matplotlib is required to write {0} images, install it or plot to html".format(filetype))
+		# an image per figure, no html
+		html = "standalone"
+	return filetype, html, renderer
+
+# render every ROI of an hdf5 file, in jobs worker processes when jobs > 1
+def plotData(hdf5, filetype, outfolder, viewplot, binsize, samples=None, statistic="mean",
+			 line=False, jobs=1, html="standalone", pageSize=50, renderer="plotly", maxPoints=None, webgl=False,
+			 force=False, rois=None, region=None):
+	filetype, html, renderer = outputOptions(filetype, html, renderer)
+	options = dict(line=line, filetype=filetype, outfolder=outfolder,
+				   viewplot=viewplot and (html != "report"), binsize=binsize,
+				   samples=samples, statistic=statistic, html=html, renderer=renderer,
+				   maxPoints=maxPoints, webgl=webgl)
+
+	# plotly.js is written once per output folder and shared by all figures
+	if html != "standalone":
+		htmlreport.writePlotlyJS(outfolder)
+
+	# figures drawn from the same data with the same options are skipped, viewplot changes no figure
+	figures = manifest.load(outfolder)
+	drawing = dict(options, viewplot=None, outfolder=None, slider=SLIDER_BINSIZES)
+	optionsDigest = manifest.optionsDigest(drawing)
 
-# open dsets in file, 38
-def plotDataHist(hdf5, filetype, outfolder, viewplot, binsize):
 	# open hdf5 file
 	f = h5py.File(hdf5, "r")
-
-	# extract data from file
-	for ID, dset in f.items():
-
-		chrom = dset.attrs["chrom"].decode("utf-8")		# chromosome
-		chromStart = dset.attrs["chromStart"]			# start coordinate
-		chromEnd = dset.attrs["chromEnd"]				# end coordinate
-		x_data = np.arange(chromStart, chromEnd)		# position np.array (end exclusive)
-
-		bamIDs = list(dset.dtype.names)					# list of bamIDs
-
-		subplots = list(range(1, len(dset.dtype)+1))	# list of subplot numbers
-
-		# create subplot
-		fig = tls.make_subplots(rows=len(subplots), subplot_titles = bamIDs,
-								vertical_spacing=0.05)
-
-		# Update 'data' key in fig with a Histogram object for every BAM to respective subplot
-		fig['data'] = go.Data([make_trace_hist(x_data, dset[BAM], BAM, binsize, index) for index, BAM in enumerate(bamIDs, start=1)])
-
-		# specify layout
-		fig = setLayout(fig, chrom, chromStart, chromEnd, subplots, ID)
-		fig = addSlider(fig)
-
-		# files saved to specified output folder and named by ROI
-		if filetype == None:
-			plot_url = plotly.offline.plot(fig, filename=str(outfolder) + "/" + str(chrom) + "_.hist", 
-										   auto_open=viewplot)
-		elif (filetype == 'svg') or (filetype == 'webp'):
-			# saves file types [png, jpeg, svg, webp] AND HTML, but must open plot in web browser
-			plot_url = plotly.offline.plot(fig, filename=str(outfolder) + "/" + str(chrom) + "_.hist",
-											image=filetype, image_filename=str(chrom) + "_.hist",
-											auto_open=viewplot)
+	IDs = selectROIs(f, rois, region)
+	names = dict((ID, figureFileName(ID, line, binsize, renderer)) for ID in IDs)
+	if len(set(names.values())) < len(names):
+		raise ValueError("ROI IDs of {0} give the same figure file name, rename them.".format(hdf5))
+
+	timings = []
+	try:
+		if jobs > 1:
+			# workers open their own read-only handle
+			f.close()
+			tasks = [(ID, options, figures.get(names[ID]), optionsDigest, force) for ID in IDs]
+			processPool = multiprocessing.Pool(jobs, initializer=_initRenderer, initargs=(hdf5,))
+			try:
+				for timing in processPool.imap_unordered(_renderTask, tasks):
+					timings.append(timing)
+				processPool.close()
+			except:
+				processPool.terminate()
+				raise
+			finally:
+				processPool.join()
 		else:
-			# automatically saves files of type [png, jpeg] without opening browser
-			# No HTML file saved
-			py.image.save_as(fig, filename=str(outfolder) + "/" + str(chrom) + "_.hist" + filetype)
-
-	f.close()
+			# extract data from file
+			for ID in IDs:
+				timings.append(renderROI(f, ID, options, figures.get(names[ID]), optionsDigest, force))
+	finally:
+		f.close()
+		# record every finished figure, also when rendering stopped early
+		figures.update((name, digest) for ID, name, seconds, digest in timings)
+		manifest.save(outfolder, figures)
+
+	if html == "report":
+		# ROIs listed in file order
+		path = htmlreport.writeReport(outfolder, [names[ID] for ID in IDs], pageSize)
+		printer.write("Report written to: {0}".format(path))
+		if viewplot:
+			webbrowser.open("file://" + os.path.realpath(path))
+
+	reportRenderTimes(timings)
 	printer.write("Figure completed.")
+	return sorted(timings)
 
-# plot data function
-def plotDataLine(hdf5, filetype, outfolder, viewplot, binsize):
+# open dsets in file, 38
+def plotDataHist(hdf5, filetype, outfolder, viewplot, binsize, samples=None, statistic="mean", jobs=1,
+				 html="standalone", pageSize=50, renderer="plotly", maxPoints=None, webgl=False, force=False,
+				 rois=None, region=None):
+	return plotData(hdf5, filetype, outfolder, viewplot, binsize, samples, statistic, line=False, jobs=jobs,
+					html=html, pageSize=pageSize, renderer=renderer, maxPoints=maxPoints, webgl=webgl,
+					force=force, rois=rois, region=region)
 
-	# open hdf5 file
+# plot data function
+def plotDataLine(hdf5, filetype, outfolder, viewplot, binsize, samples=None, statistic="mean", jobs=1,
+				 html="standalone", pageSize=50, renderer="plotly", maxPoints=None, webgl=False, force=False,
+				 rois=None, region=None):
+	return plotData(hdf5, filetype, outfolder, viewplot, binsize, samples, statistic, line=True, jobs=jobs,
+					html=html, pageSize=pageSize, renderer=renderer, maxPoints=maxPoints, webgl=webgl,
+					force=force, rois=rois, region=region)
+
+# x-axis of metaplots and heatmaps: (tick positions, tick labels), (left, right)
+def metaAxis(mode, flank=2000):
+	if mode == "scaled":
+		return ([0, 100], ["start", "end"]), (0, 100)
+	return ([-flank, 0, flank], ["-{0} bp".format(flank), "center", "+{0} bp".format(flank)]), (-flank, flank)
+
+# shared color range of heatmaps, the 99th percentile keeps single hot bins from washing out the rest
+def heatmapRange(heatmaps):
+	values = heatmaps[~np.isnan(heatmaps)]
+	return float(np.percentile(values, 99)) if len(values) else 1.0
+
+# metaplot figure of an aggregate: mean, median and quantile band per BAM
+# positions = x coordinates of the profile bins, from metaplot.profilePositions
+def figureMeta(meta, bamIDs, mode, positions, flank=2000):
+	lower, upper = meta.quantile(metaplot.BAND[0]), meta.quantile(metaplot.BAND[1])
+	median = meta.median()
+
+	traces = []
+	for index, BAM in enumerate(bamIDs, start=1):
+		axes = dict(xaxis="x{}".format(index), yaxis="y{}".format(index))	# references the respective subplot
+		traces += [
+			go.Scatter(x=positions, y=lower[index-1], mode="lines", line=dict(width=0),
+					   hoverinfo="skip", name=BAM + " q{0:g}".format(100 * metaplot.BAND[0]), **axes),
+			go.Scatter(x=positions, y=upper[index-1], mode="lines", line=dict(width=0),
+					   fill="tonexty", fillcolor="rgba(0,0,255,0.2)",	# band filled down to the lower quantile
+					   name=BAM + " q{0:g}".format(100 * metaplot.BAND[1]), **axes),
+			go.Scatter(x=positions, y=median[index-1], mode="lines",
+					   line=dict(color="0000ff", dash="dash"), name=BAM + " median", **axes),
+			go.Scatter(x=positions, y=meta.mean[index-1], mode="lines",
+					   line=dict(color="0000ff"), name=BAM + " mean", **axes)
+		]
+
+	# y-range from the arrays, bins without values count as 0
+	y_range_max = staticplot.yRangeMax([np.nan_to_num(upper), meta.mean])
+	(tickvals, ticktext), (left, right) = metaAxis(mode, flank)
+	xRange = dict(range=[left, right], tickvals=tickvals, ticktext=ticktext)
+
+	layout = dict(title="Metaplot: {0} ROIs".format(meta.rois), titlefont=TITLEFONT, showlegend=False,
+				  autosize=True, legend=LEGEND, annotations=[])
+	for index, subplot in enumerate(layoutTemplate(len(bamIDs))):
+		layout[subplot["xkey"]] = dict(subplot["xaxis"], **xRange)
+		layout[subplot["ykey"]] = dict(subplot["yaxis"], range=[0, y_range_max], dtick=(y_range_max/20))
+		layout["annotations"].append(dict(subplot["title"], text=bamIDs[index]))
+	return dict(data=traces, layout=layout)
+
+# write the per-bin statistics of an aggregate as a tab-separated table, returns its path
+def writeMetaTable(path, meta, bamIDs, positions):
+	lower, upper = meta.quantile(metaplot.BAND[0]), meta.quantile(metaplot.BAND[1])
+	median, sd = meta.median(), np.sqrt(meta.variance())
+	with open(path, "w") as handle:
+		handle.write("\t".join(["bamID", "position", "n", "mean", "sd", "median",
+								 "q{0:g}".format(100 * metaplot.BAND[0]),
+								 "q{0:g}".format(100 * metaplot.BAND[1])]) + "\n")
+		for row, BAM in enumerate(bamIDs):
+			for column, position in enumerate(positions):
+				values = [meta.count[row, column], meta.mean[row, column], sd[row, column],
+						  median[row, column], lower[row, column], upper[row, column]]
+				handle.write("\t".join([BAM, "{0:g}".format(position)] + ["{0:g}".format(value) for value in values]) + "\n")
+	return path
+
+# aggregate every ROI of an hdf5 file into one metaplot, streaming one ROI at a time
+def plotMeta(hdf5, filetype, outfolder, viewplot, binsize, samples=None, mode="scaled", nbins=100,
+			 flank=2000, reservoir=1000, html="standalone", rois=None, region=None, renderer="plotly"):
+	filetype, html, renderer = outputOptions(filetype, html, renderer)
 	f = h5py.File(hdf5, "r")
-
-	# extract data from file
-	for ID, dset in f.items():
-
-		chrom = dset.attrs["chrom"].decode("utf-8")		# chromosome
-		chromStart = dset.attrs["chromStart"]			# start coordinate
-		chromEnd = dset.attrs["chromEnd"]				# end coordinate
-		x_data = np.arange(chromStart, chromEnd)		# position np.array (end exclusive)
-
-		### BINNING
-		# create array of values of nbin spaces from chromstart to closest evenly divisible value to chromEnd
-		x_data_binned = np.arange(chromStart, chromEnd, binsize)
-		x_data_binned = np.append(x_data_binned, chromEnd-1)
-		# list x_data_binned centers for plotting
-		x_data_binned_mean = [statistics.mean([x_data_binned[i], x_data_binned[i+1]]) for i in range(0, len(x_data_binned)-1)]
-
-		bamIDs = list(dset.dtype.names)				# list of bamIDs
-
-		subplots = list(range(1, len(dset.dtype)+1))	# list of subplot numbers
-
-		# create subplot
-		fig = tls.make_subplots(rows=len(subplots), vertical_spacing=0.05) #subplot_titles = bamIDs,
-
-		# Update 'data' key in fig with a Histogram object for every BAM to respective subplot
-		fig['data'] = go.Data([make_trace_line(x_data, x_data_binned, x_data_binned_mean, dset[BAM], BAM, index) for index, BAM in enumerate(bamIDs, start=1)])
-
-		# specify layout
-		fig = setLayout(fig, chrom, chromStart, chromEnd, subplots, ID)
-
-		# files saved to specified output folder and named by ROI
-		if filetype == None:
-			plot_url = plotly.offline.plot(fig, filename=str(outfolder) + "/" + str(chrom) + "_.line.bin" + str(binsize), 
-										   auto_open=viewplot)
-		elif (filetype == 'svg') or (filetype == 'webp') or (filetype == 'png') or (filetype == 'jpeg'):
-			# saves file types [png, jpeg, svg, webp] AND HTML, but must open plot in web browser
-			plot_url = plotly.offline.plot(fig, filename=str(outfolder) + "/" + str(chrom) + "_.line.bin" + str(binsize),
-											image=filetype, image_filename=str(chrom) + "_.line.bin" + str(binsize),
-											auto_open=viewplot, image_height=1200, image_width=800)
-		else:
-			# automatically saves files of type [png, jpeg] without opening browser
-			# No HTML file saved
-			py.image.save_as(fig, filename=str(outfolder) + "/" + str(chrom) + "_.line.bin" + str(binsize) + filetype)
-
+	IDs = selectROIs(f, rois, region)
+	if not IDs:
+		f.close()
+		raise ValueError("{0} holds no ROIs".format(hdf5))
+	bamIDs = samples or countsfile.roiBamIDs(f[IDs[0]])
+
+	start = time.time()
+	meta = metaplot.aggregate(f, IDs, bamIDs, mode, nbins, flank, binsize, reservoir)
 	f.close()
+	printer.write("Aggregated {0} ROIs in {1:.2f} s.".format(meta.rois, time.time() - start))
+
+	positions = metaplot.profilePositions(mode, nbins, flank, binsize)
+	name = "metaplot." + mode
+	writeMetaTable(os.path.join(str(outfolder), name + ".txt"), meta, bamIDs, positions)
+
+	if renderer == "matplotlib":
+		# headless image, no plotly figure is built
+		staticplot.renderMeta(os.path.join(str(outfolder), name + "." + filetype), positions, bamIDs, meta.mean,
+							  meta.median(), meta.quantile(metaplot.BAND[0]), meta.quantile(metaplot.BAND[1]),
+							  "Metaplot: {0} ROIs".format(meta.rois), *metaAxis(mode, flank))
+		printer.write("Figure completed.")
+		return meta
+
+	if html != "standalone":
+		# a single figure, no report page needed
+		htmlreport.writePlotlyJS(outfolder)
+		html = "shared"
+	fig = figureMeta(meta, bamIDs, mode, positions, flank)
+	saveFigure(fig, name, "Metaplot", outfolder, viewplot, html)
 	printer.write("Figure completed.")
-
-		# finds the mean of the binned counts when ROI split into bin_size # of bins
-		# gets mean values for binned x_data, this is point that is used for plotting
-		#bin_means, bin_edges, binnumber = stats.binned_statistic(x_data, counts[BAM], statistic='mean', bins=binsize)
-		#x_data_binned_mean, xbin_edges, xbinnumber = stats.binned_statistic(x_data, x_data, statistic='mean', bins=binsize)
+	return meta
+
+# heatmap figure, one panel per BAM side by side, rows = ROIs in the given order
+# heatmaps = BAM x row x column arrays from metaplot.heatmapMatrix
+# positions = x coordinates of the columns, from metaplot.heatmapPositions
+def figureHeatmap(heatmaps, bamIDs, mode, nROIs, positions, flank=2000, horizontal_spacing=0.03):
+	zmax = heatmapRange(heatmaps)
+
+	nBAMs = len(bamIDs)
+	tickvals, ticktext = metaAxis(mode, flank)[0]
+	xRange = dict(tickvals=tickvals, ticktext=ticktext)
+
+	width = (1.0 - horizontal_spacing * (nBAMs - 1)) / nBAMs
+	layout = dict(title="Heatmap: {0} ROIs".format(nROIs), titlefont=TITLEFONT, showlegend=False,
+				  autosize=True, annotations=[])
+	traces = []
+	for index, BAM in enumerate(bamIDs, start=1):
+		left = (index - 1) * (width + horizontal_spacing)
+		traces.append(go.Heatmap(
+			z=heatmaps[index-1],
+			x=positions,						# column centers, as the metaplot bins
+			zmin=0, zmax=zmax,
+			colorscale=[[0, "rgb(255,255,255)"], [1, "rgb(0,0,255)"]],	# white to the trace blue
+			showscale=(index == nBAMs),			# one color bar for the shared range
+			name=BAM,
+			xaxis="x{}".format(index),			# references the respective panel
+			yaxis="y{}".format(index)
+		))
+		layout["xaxis{}".format(index)] = dict(xRange, domain=[left, left + width], anchor="y{}".format(index),
+											   tickmode="array", ticks="outside", showline=True, mirror=True)
+		# first row, the strongest ROI, on top
+		layout["yaxis{}".format(index)] = dict(anchor="x{}".format(index), autorange="reversed",
+											   showticklabels=False, ticks="", showline=True, mirror=True,
+											   title="ROIs" if index == 1 else "")
+		layout["annotations"].append(dict(text=BAM, x=left + width / 2.0, y=1.0, xref="paper", yref="paper",
+										  showarrow=False, xanchor="center", yanchor="bottom",
+										  font=dict(size=16)))
+	return dict(data=traces, layout=layout)
+
+# heatmap of every ROI of an hdf5 file, streaming one ROI at a time
+def plotHeatmap(hdf5, filetype, outfolder, viewplot, binsize, samples=None, mode="scaled", columns=200,
+				flank=2000, rows=1000, sort=True, html="standalone", rois=None, region=None, renderer="plotly"):
+	filetype, html, renderer = outputOptions(filetype, html, renderer)
+	f = h5py.File(hdf5, "r")
+	IDs = selectROIs(f, rois, region)
+	if not IDs:
+		f.close()
+		raise ValueError("{0} holds no ROIs".format(hdf5))
+	bamIDs = samples or countsfile.roiBamIDs(f[IDs[0]])
+
+	start = time.time()
+	heatmaps, order, totals = metaplot.heatmapMatrix(f, IDs, bamIDs, mode, columns, flank, binsize, rows, sort)
+	f.close()
+	printer.write("Binned {0} ROIs into {1} rows x {2} columns in {3:.2f} s.".format(
+		len(IDs), heatmaps.shape[1], heatmaps.shape[2], time.time() - start))
+
+	# ROIs in row order, rows hold len(IDs) / heatmaps.shape[1] ROIs each
+	name = "heatmap." + mode
+	with open(os.path.join(str(outfolder), name + ".rows.txt"), "w") as handle:
+		handle.write("ID\ttotal\n")
+		for ID, total in zip(order, totals):
+			handle.write("{0}\t{1:g}\n".format(ID, total))
+
+	if renderer == "matplotlib":
+		# headless image, no plotly figure is built
+		staticplot.renderHeatmap(os.path.join(str(outfolder), name + "." + filetype), heatmaps, bamIDs,
+								 heatmapRange(heatmaps), "Heatmap: {0} ROIs".format(len(IDs)), *metaAxis(mode, flank))
+		printer.write("Figure completed.")
+		return heatmaps, order
+
+	if html != "standalone":
+		# a single figure, no report page needed
+		htmlreport.writePlotlyJS(outfolder)
+		html = "shared"
+	fig = figureHeatmap(heatmaps, bamIDs, mode, len(IDs), metaplot.heatmapPositions(mode, columns, flank, binsize),
+						flank)
+	saveFigure(fig, name, "Heatmap", outfolder, viewplot, html)
+	printer.write("Figure completed.")
+	return heatmaps, order
 
 # histogram trace-generating function
-def make_trace_hist(x_data, counts, BAM, binsize, index):
-	trace = go.Histogram(
-				x=x_data,					# x-coords are same for graphs in a ROI
-				y=counts,					# y-coords are counts for specified BAM
-				histfunc="avg",				# specifies binning function, values from avg in bin
-				autobinx=False,				# disables x axis automatic binning
-				xbins=go.XBins(
-					start=x_data[0],		# set start value for bins
-					end=x_data[-1],			# set end value for bins (1 more than counts to include final point in calcs)
-					size=binsize),			# set step value in-between each bin
+# countAvg = binned count values, one per bin of binsize from chromStart
+def make_trace_hist(chromStart, chromEnd, countAvg, BAM, binsize, index, visible=True, maxPoints=None,
+					webgl=False):
+
+	# bin edges, the last bin holds the remainder
+	bin_edges = np.append(np.arange(chromStart, chromEnd, binsize), chromEnd)
+
+	# above maxPoints bars, merge neighboring bins into one bar as high as the highest of them
+	if maxPoints and (len(countAvg) > maxPoints):
+		group = -(-len(countAvg) // maxPoints)
+		countAvg = countsfile.binMatrix(countAvg, group, "max")
+		bin_edges = np.append(bin_edges[:-1][::group], chromEnd)
+
+	# plain plotly.js trace dicts, graph_objs validation costs more than building the whole layout
+	if webgl:
+		# WebGL has no bars, draw the bar outlines as one filled step line
+		return dict(
+				type="scattergl",
+				x=np.repeat(bin_edges, 2)[1:-1],	# left and right edge of every bin
+				y=np.repeat(countAvg, 2),			# bin height at both edges
+				fill="tozeroy",
+				fillcolor="0000ff",
+				mode="lines",
+				line=dict(color="0000ff", width=1),
+				visible=visible,
+				name=BAM,
+				xaxis="x{}".format(index),
+				yaxis="y{}".format(index)
+			)
+
+	trace = dict(
+				type="bar",
+				x=(bin_edges[:-1] + bin_edges[1:]) / 2.0,	# x-coords are bin centers
+				y=countAvg,					# y-coords are avg counts/bin for specified BAM
+				width=np.diff(bin_edges),	# bars span their whole bin
+				visible=visible,			# one slider step is shown at a time
 				name=BAM,					# set trace name to respective BAM
 				xaxis="x{}".format(index),	# references the respective subplot
 				yaxis="y{}".format(index),	# references the respective subplot
@@ -172,17 +559,22 @@ def make_trace_hist(x_data, counts, BAM, binsize, index):
 	return trace
 
 # line trace-generating function
-def make_trace_line(x_data, x_data_binned, x_data_binned_mean, counts, BAM, index):
+# countAvg = binned count values, from countsfile.readBinnedColumns
+def make_trace_line(x_data_binned_mean, countAvg, BAM, index, maxPoints=None, webgl=False):
 
-	# countAvg = binned count values, bin_edges = returns x_data binned edges, binnumber = ndarray of which bin each count value corresponds to
-	countAvg, bin_edges, binnumber = stats.binned_statistic(x_data, counts, statistic='mean', bins=x_data_binned)
+	# above maxPoints, keep the lowest and highest point of every stretch of the line
+	if maxPoints and (len(countAvg) > maxPoints):
+		kept = countsfile.minMaxIndices(countAvg, maxPoints)
+		x_data_binned_mean, countAvg = np.asarray(x_data_binned_mean)[kept], np.asarray(countAvg)[kept]
 
-	trace = go.Scatter(
+	# a plain plotly.js trace dict, as in make_trace_hist
+	trace = dict(
+				type="scattergl" if webgl else "scatter",
 				x=x_data_binned_mean,		# x-coords are same for graphs in a ROI
 				y=countAvg,					# y-coords are avg counts/bin for specified BAM
 				fill="tozeroy",				# color fill to y=0
 				fillcolor="0000ff",
-				mode="line",				# line plot
+				mode="lines",				# line plot
 				opacity=1,
 				line=dict(
 					color="0000ff",
@@ -194,103 +586,116 @@ def make_trace_line(x_data, x_data_binned, x_data_binned_mean, counts, BAM, inde
 			)
 	return trace
 
-# set Layout features of graph
-def setLayout(fig, chrom, chromStart, chromEnd, subplots, ROI_name):
-	# title specs
-	titlefont = dict(size=18)
-
-	# Define dictionary of subplot xaxis layout
-	xLay = dict(
-		range=[chromStart-300,chromEnd+300],			# graph range larger than ROI
-		showline=True,									# draw line bounding axes
-		tickmode="array",								# placement of ticks set w/ tickvals
-		tickvals=[chromStart,chromEnd],					# xaxis values of text
-		ticktext=[str(chrom) + ": " + str(chromStart), 	# values of text, coords at ROI start & end
-				  str(chrom) + ": " + str(chromEnd)],
-		ticks="outside",								# draw ticks outside axes
-		zeroline=True,									# draw line along 0 value of axis
-		zerolinewidth=2,								# set zero line width
-		mirror=True										# axis lines mirrored (also wide)
-	)
-	# max y-axis value of all subplots
-	countsMax = max([max(fig.data.get_data()[i]['y']) for i in range(0, subplots[-1])])
-
-	# round countsMax up to nearest 0.5 for yrange max
-	y_range_max = 0.5 * math.ceil(2 * countsMax)
-
-	# look @ BAM liquidator to see how it's getting counts
-	# difference in counts (read extension?)
-	# ceiling function, entire array, find max and then wrap all into ceiling function to closest highest integer to prevent fractional values as max
-
-	# Define dictionary of subplot yaxis layout
-	yLay = dict(
-		title="Reads",				# y-axis title "Reads"
-		range=[0, y_range_max],		# graph range
-		tick0=0,					# placement of first tick		
-		dtick=(y_range_max/20),					# step size between ticks
-		ticks="outside",			# draw ticks outside axes
-		showgrid=False,				# omit grid
-		showline=True,				# show line bounding axes
-		zeroline=True,				# draw line along y=o
-		zerolinewidth=2,			# set zero line width
-		mirror=True					# axis lines mirrored (also wide)
-	)
-
-	legend = dict(
-		bordercolor="rgba(0,0,0,1)",
-		#x=0.5,
-		#y=1,
-		orientation="h"	
+# title specs
+TITLEFONT = dict(size=18)
+
+# subplot xaxis layout, range and ticks are set per ROI
+XAXIS = dict(
+	showline=True,									# draw line bounding axes
+	tickmode="array",								# placement of ticks set w/ tickvals
+	ticks="outside",								# draw ticks outside axes
+	zeroline=True,									# draw line along 0 value of axis
+	zerolinewidth=2,								# set zero line width
+	mirror=True										# axis lines mirrored (also wide)
+)
+
+# subplot yaxis layout, range and tick step are set per ROI
+YAXIS = dict(
+	title="Reads",				# y-axis title "Reads"
+	tick0=0,					# placement of first tick
+	ticks="outside",			# draw ticks outside axes
+	showgrid=False,				# omit grid
+	showline=True,				# show line bounding axes
+	zeroline=True,				# draw line along y=o
+	zerolinewidth=2,			# set zero line width
+	mirror=True					# axis lines mirrored (also wide)
+)
+
+LEGEND = dict(
+	bordercolor="rgba(0,0,0,1)",
+	orientation="h"
+)
+
+# layout templates by number of BAMs, built by layoutTemplate
+_layoutTemplates = {}
+
+# parts of the layout shared by every ROI with nBAMs subplots, built once per nBAMs
+# subplots stacked top to bottom as tls.make_subplots(rows=nBAMs) does
+def layoutTemplate(nBAMs, vertical_spacing=0.05):
+	key = (nBAMs, vertical_spacing)
+	if key not in _layoutTemplates:
+		height = (1.0 - vertical_spacing * (nBAMs - 1)) / nBAMs
+		subplots = []
+		for splt in range(1, nBAMs + 1):
+			top = 1.0 - (splt - 1) * (height + vertical_spacing)
+			subplots.append(dict(
+				xkey="xaxis{}".format(splt),
+				ykey="yaxis{}".format(splt),
+				xaxis=dict(XAXIS, domain=[0.0, 1.0], anchor="y{}".format(splt)),
+				yaxis=dict(YAXIS, domain=[max(top - height, 0.0), top], anchor="x{}".format(splt)),
+				# scale bar, rectangle drawn above trace, filled black
+				bar=dict(type="rect", layer="above", xref="x{}".format(splt), yref="y{}".format(splt),
+						 fillcolor="rgba(0,0,0,1)"),
+				# text above scalebar, centered at x, bottom of box at y, no arrow
+				label=dict(text="1kb", xref="x{}".format(splt), yref="y{}".format(splt),
+						   showarrow=False, xanchor="center", yanchor="bottom"),
+				# subplot title, centered above the subplot
+				title=dict(x=0.5, y=top, xref="paper", yref="paper", showarrow=False,
+						   xanchor="center", yanchor="bottom", font=dict(size=16))
+			))
+		_layoutTemplates[key] = subplots
+	return _layoutTemplates[key]
+
+# patch a layout template with the coordinates, y-range and title of one ROI
+# titles = optional subplot titles, one per BAM
+def roiLayout(template, chrom, chromStart, chromEnd, ROI_name, y_range_max, titles=None):
+	# graph range larger than ROI, text at ROI start & end coords
+	xRange = dict(
+		range=[chromStart-300, chromEnd+300],
+		tickvals=[chromStart, chromEnd],
+		ticktext=[str(chrom) + ": " + str(chromStart), str(chrom) + ": " + str(chromEnd)]
 	)
-
-	for splt in subplots:
-		# Update x & y axis layout of all subplots
-		fig["layout"].update({"xaxis{}".format(splt): xLay})
-		fig["layout"].update({"yaxis{}".format(splt): yLay})
-		fig["layout"].update(legend=legend)
-
-		# create scale bar for each subplot
-		bar_labels = go.Annotation(text="1kb", 								# text above scalebar
-					   x=chromEnd-500, y=y_range_max*(.923), 				# x at center of bar, y in upper right corner
-					   xref="x{}".format(splt), yref="y{}".format(splt), 	# set subplot
-					   showarrow=False, 									# no arrow
-					   xanchor="center", yanchor="bottom") 					# text centered at x, bottom of box at y
-
-		bars = dict(type="rect", layer="above", 							# rectangle, shape drawn above trace
-				 xref="x{}".format(splt), yref="y{}".format(splt), 			# set subplot
-				 x0=chromEnd-1000, x1=chromEnd, 							# 1000 bp wide
-				 y0=y_range_max*(0.903), y1=y_range_max*(0.923), 			# height
-				 fillcolor="rgba(0,0,0,1)") 								# fill black
-
-		# update layout with scale bar
-		fig["layout"]["shapes"].append(bars)
-		fig["layout"]["annotations"].append(bar_labels)
-
-	# add graph title
-	fig["layout"].update(title="Gene: " + ROI_name, titlefont=titlefont, showlegend=False, autosize=True)
-	return fig
+	yRange = dict(range=[0, y_range_max], dtick=(y_range_max/20))
+
+	layout = dict(title="Gene: " + ROI_name, titlefont=TITLEFONT, showlegend=False, autosize=True,
+				  legend=LEGEND, shapes=[], annotations=[])
+	for index, subplot in enumerate(template):
+		layout[subplot["xkey"]] = dict(subplot["xaxis"], **xRange)
+		layout[subplot["ykey"]] = dict(subplot["yaxis"], **yRange)
+
+		# 1000 bp wide scale bar in the upper right corner
+		layout["shapes"].append(dict(subplot["bar"], x0=chromEnd-1000, x1=chromEnd,
+									 y0=y_range_max*(0.903), y1=y_range_max*(0.923)))
+		layout["annotations"].append(dict(subplot["label"], x=chromEnd-500, y=y_range_max*(.923)))
+		if titles != None:
+			layout["annotations"].append(dict(subplot["title"], text=titles[index]))
+	return layout
 
 # add slider option, only for hist
-def addSlider(fig):
+# traces are grouped per slider step, nBAMs traces per step
+def addSlider(fig, binsizes, nBAMs, active=0):
 
 	# create slider
 	steps = []
-	for i in np.arange(10, 200, 10): 	# from 10 to 200 in step size of 10
+	for stepIndex, i in enumerate(binsizes):
+		# show the nBAMs traces of this bin size, hide the others
+		visible = [traceIndex // nBAMs == stepIndex for traceIndex in range(len(binsizes) * nBAMs)]
 		step = dict(
 			method="restyle",			# "restyle": modifying data attribute
-			args = ['xbins.size', i],	# spec changing attribute, bin values
+			args = ['visible', visible],	# spec changing attribute, visible traces
 			label = str(i)				# label step as size
 		)
 		steps.append(step)
 
 	sliders = [dict(
+		active = active,							# step of the requested bin size
 		currentvalue = {"prefix": "Bin Size: "},	# prefix of current slider value label
 		pad = {"t": 15},								# 50 px along top of slider
 		steps = steps
 	)]
 
 	# add slider to layout
-	fig['layout'].update(sliders=sliders)
+	fig['layout']['sliders'] = sliders
 	return fig
 
 # determines color of plot
@@ -352,15 +757,64 @@ def main(args=sys.argv[1:]):
 	parser.add_argument('--plot', action='store_true', default=False, help="Plot data to figure.")
 	parser.add_argument('--viewplot', action='store_true', default=False, help="Open web browser to view plot.")
 	parser.add_argument('--binsize', type=int, default=200, help="Bin size.")
-	parser.add_argument("--format", default=None, type=str, choices=[None, 'png', 'svg', 'jpeg', 'webp'],
-						help="Format for static image file to be saved as.")
+	parser.add_argument("--format", default=None, type=str, choices=staticplot.STATIC_FORMATS,
+						help="Save static images of this format instead of html, drawn with matplotlib \
+						without a browser or network access.")
+	parser.add_argument("--renderer", default="plotly", choices=["plotly", "matplotlib"],
+						help="Figure renderer. plotly writes html, matplotlib writes static images \
+						(png unless --format is given). Default: plotly.")
+	parser.add_argument("--statistic", default="mean", choices=countsfile.STATISTICS,
+						help="Value plotted for each bin. Default: mean.")
+	parser.add_argument("--jobs", type=int, default=1,
+						help="Number of processes rendering ROIs in parallel. Default: 1.")
+	parser.add_argument("--html", default="standalone", choices=htmlreport.HTML_MODES,
+						help="HTML output: one self-contained file per ROI (standalone), one file per ROI \
+						sharing the folder's plotly.js (shared), or a paginated report loading ROIs lazily \
+						(report). Default: standalone.")
+	parser.add_argument("--page-size", type=int, default=50,
+						help="ROIs per page of the --html report. Default: 50.")
+	parser.add_argument("--max-points", type=int, default=4000,
+						help="Maximum points (bars for histograms) per trace. Longer traces keep the lowest \
+						and highest value of every stretch so peaks stay visible. 0 keeps every point. Default: 4000.")
+	parser.add_argument("--webgl", default=False, action='store_true',
+						help="Draw traces with WebGL (Scattergl) so large ROIs pan and zoom smoothly.")
+	parser.add_argument("--force", default=False, action='store_true',
+						help="Render every ROI, also those whose figures are up to date in the output folder's manifest.")
+	parser.add_argument("--roi", default=None, nargs='+',
+						help="Names of the ROIs to plot. Default: all ROIs.")
+	parser.add_argument("--region", default=None, type=str,
+						help="Plot only the ROIs overlapping a region written as chrom:start-end.")
 	parser.add_argument("--line", default=False, action='store_true', help="Plot as a filled line graph.")
 	parser.add_argument("--bamIDs", default=None, nargs='+',
 						help="Identification for each BAM that will displayed for its respective plot.")
-	parser.add_argument("--callFunc", default=False, action='store_true', help="Calls getCountVectorData.py.")
-	parser.add_argument("--metaplot", default=False, action='store_true', help="Create a metaplot.")
-
-	args = parser.parse_args()
+	parser.add_argument("--samples", default=None, nargs='+',
+						help="BAM IDs to plot from the hdf5 file. Default: all BAMs.")
+	parser.add_argument("--callFunc", default=False, action='store_true',
+						help="Count the ROIs of --bedfile in the BAMs and plot them directly, without an hdf5 file.")
+	parser.add_argument("--save-hdf5", default=False, action='store_true',
+						help="With --callFunc, also save the counts to <outfolder>/<bed name>.hdf5.")
+	parser.add_argument("--metaplot", default=False, action='store_true',
+						help="Create one metaplot of all ROIs instead of one figure per ROI.")
+	parser.add_argument("--heatmap", default=False, action='store_true',
+						help="Create one ROI x position heatmap per BAM instead of one figure per ROI.")
+	parser.add_argument("--heatmap-rows", type=int, default=1000,
+						help="Maximum heatmap rows, ROIs are averaged in groups above that. Default: 1000.")
+	parser.add_argument("--heatmap-columns", type=int, default=200,
+						help="Maximum heatmap columns. Default: 200.")
+	parser.add_argument("--unsorted", default=False, action='store_true',
+						help="Keep heatmap rows in file order instead of sorting by total signal.")
+	parser.add_argument("--meta-mode", default="scaled", choices=metaplot.METAPLOT_MODES,
+						help="Line ROIs up in a metaplot or heatmap by rescaling each to a fixed number of bins \
+						(scaled), or by a window of --flank bp around their center binned at --binsize (center). \
+						Default: scaled.")
+	parser.add_argument("--meta-bins", type=int, default=100,
+						help="Bins per ROI of a scaled metaplot. Default: 100.")
+	parser.add_argument("--flank", type=int, default=2000,
+						help="bp on either side of the ROI center of a center metaplot. Default: 2000.")
+	parser.add_argument("--reservoir", type=int, default=1000,
+						help="ROI profiles sampled for the metaplot median and quantile band. Default: 1000.")
+
+	args = parser.parse_args(args)
 
 	# parse args
 	bedfile = args.bedfile
@@ -371,6 +825,20 @@ def main(args=sys.argv[1:]):
 	binsize = args.binsize
 	filetype = args.format
 
+	# static images need matplotlib, refuse before any counts are read
+	try:
+		outputOptions(filetype, args.html, args.renderer)
+	except (ValueError, ImportError) as error:
+		parser.error(str(error))
+
+	# unknown --roi names and a malformed --region are usage errors, reported before anything is drawn
+	if (args.roi or args.region) and (hdf5 != None) and (args.callFunc == False):
+		try:
+			with h5py.File(hdf5, "r") as f:
+				checkSelection(f, args.roi, args.region)
+		except ValueError as error:
+			parser.error(str(error))
+
 	# creates list of BAMs from folder or given files
 	if (args.bamfolder != None):
 		bamList = [file for file in glob.glob(os.path.join(args.bamfolder, "*.bam*"))]
@@ -402,12 +870,33 @@ def main(args=sys.argv[1:]):
 	printer.write("Saving plot output files to: {}".format(os.path.realpath(outfolder)))	
 
 	if args.callFunc == True:
-		hdf5 = callFunc(bedfile, bamList, bamIDs, outfolder)
-
-	if args.line == False:
-		plotDataHist(hdf5, filetype, outfolder, viewplot, binsize)
+		if (bedfile == None) or (bamList == None):
+			parser.error("--callFunc requires --bedfile and --bamfiles or --bamfolder")
+		callFunc(bedfile, bamList, bamIDs, outfolder, binsize=binsize, line=args.line, filetype=filetype,
+				 viewplot=viewplot, statistic=args.statistic, html=args.html, pageSize=args.page_size,
+				 renderer=args.renderer, maxPoints=args.max_points or None, webgl=args.webgl,
+				 hdf5=args.save_hdf5)
+		return
+
+	if args.metaplot == True:
+		plotMeta(hdf5, filetype, outfolder, viewplot, binsize, samples=args.samples, mode=args.meta_mode,
+				 nbins=args.meta_bins, flank=args.flank, reservoir=args.reservoir, html=args.html,
+				 rois=args.roi, region=args.region, renderer=args.renderer)
+	elif args.heatmap == True:
+		plotHeatmap(hdf5, filetype, outfolder, viewplot, binsize, samples=args.samples, mode=args.meta_mode,
+					columns=args.heatmap_columns, flank=args.flank, rows=args.heatmap_rows,
+					sort=not args.unsorted, html=args.html, rois=args.roi, region=args.region,
+					renderer=args.renderer)
+	elif args.line == False:
+		plotDataHist(hdf5, filetype, outfolder, viewplot, binsize, samples=args.samples,
+					 statistic=args.statistic, jobs=args.jobs, html=args.html, pageSize=args.page_size,
+					 renderer=args.renderer, maxPoints=args.max_points or None, webgl=args.webgl,
+					 force=args.force, rois=args.roi, region=args.region)
 	else:
-		plotDataLine(hdf5, filetype, outfolder, viewplot, binsize)
+		plotDataLine(hdf5, filetype, outfolder, viewplot, binsize, samples=args.samples,
+					 statistic=args.statistic, jobs=args.jobs, html=args.html, pageSize=args.page_size,
+					 renderer=args.renderer, maxPoints=args.max_points or None, webgl=args.webgl,
+					 force=args.force, rois=args.roi, region=args.region)
 	return
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Count the ROIs of a BED file and plot them in one process.
+
+Each ROI's count vectors are handed from the counting code straight to the
+figure code. Nothing goes through a counts file in between, and no second
+interpreter is started. When a counts file is wanted as well, pass
+``hdf5=True`` and every ROI is also written as it is counted, with the
+same layout as ``getcountvectordata.py`` writes::
+
+	from mobamplot import pipeline
+	pipeline.run("peaks.bed", ["sample1.bam", "sample2.bam"], outfolder="figures", binsize=50)
+"""
+import os
+import time
+import webbrowser
+
+import h5py
+import numpy as np
+
+try:
+	from . import countsfile
+	from . import getcountvectordata
+	from . import htmlreport
+	from . import mobamplot
+except (ImportError, ValueError):
+	# run as a script from the mobamplot folder
+	import countsfile
+	import getcountvectordata
+	import htmlreport
+	import mobamplot
+
+# plot every (SegmentChain, record array) of countVectorData, as yielded by iterCountVectorData
+# writes each ROI to the open counts file f too unless f is None, returns the figure timings
+def plotCountVectorData(countVectorData, outfolder, binsize=200, line=False, filetype=None, viewplot=False,
+						statistic="mean", html="standalone", renderer="plotly", maxPoints=None, webgl=False,
+						f=None, storage=None):
+	timings = []
+	for segment, counts in countVectorData:
+		if f is not None:
+			getcountvectordata.writeROI(f, segment, counts, **(storage or {}))
+
+		# same name and coordinates as the ROI gets in a counts file
+		ID = str(segment.get_name())
+		bamIDs = list(counts.dtype.names)
+		matrix = np.array([counts[bamID] for bamID in bamIDs], dtype=np.float64)
+		binner = lambda step_binsize: countsfile.binMatrix(matrix, step_binsize, statistic)
+
+		start = time.time()
+		name = mobamplot.plotBinned(ID, segment.chrom, segment.segments[0].start, segment.segments[0].end,
+									bamIDs, binner, line, filetype, outfolder, viewplot, binsize, html,
+									renderer, maxPoints, webgl)
+		timings.append((ID, name, time.time() - start, None))
+	return timings
+
+def run(bedfile, bamList, bamIDs=None, outfolder=".", binsize=200, line=False, filetype=None, viewplot=False,
+		statistic="mean", html="standalone", pageSize=50, renderer="plotly", maxPoints=None, webgl=False,
+		hdf5=False, storage=None, **countOptions):
+	"""Count every ROI of `bedfile` in every BAM of `bamList` and plot it
+
+	Parameters
+	----------
+	bamIDs : list, optional
+		Names of the BAMs, by default their file names without extension
+	hdf5 : bool or str, optional
+		Also write the counts to this file, or to ``<outfolder>/<bed name>.hdf5``
+		when True. Default: no counts file.
+	storage : dict, optional
+		Keyword arguments of :func:`getcountvectordata.writeROI`, e.g.
+		``compression`` or ``pyramid``
+
+	The plot arguments are those of :func:`mobamplot.plotData`. Remaining
+	keyword arguments (``workers``, ``engine``, ``mapping``, ``extension``,
+	``sweep`` ...) are passed to :func:`getcountvectordata.iterCountVectorData`.
+
+	Returns
+	-------
+	list
+		(ROI ID, figure name, seconds) of every ROI, in BED order
+	"""
+	if bamIDs is None:
+		bamIDs = [os.path.splitext(os.path.basename(bamfile))[0] for bamfile in bamList]
+	filetype, html, renderer = mobamplot.outputOptions(filetype, html, renderer)
+	if html != "standalone":
+		htmlreport.writePlotlyJS(outfolder)
+
+	f = None
+	if hdf5:
+		if hdf5 is True:
+			hdf5 = os.path.join(str(outfolder), os.path.splitext(os.path.basename(bedfile))[0] + ".hdf5")
+		f = h5py.File(hdf5, "w")
+		countsfile.initLayout(f)
+		# the same provenance and counting options as getcountvectordata.py records
+		getcountvectordata.writeProvenance(f, bamList, bamIDs)
+		getcountvectordata.writeCountSettings(f, **dict((key, countOptions[key]) for key in
+														  ("engine", "mapping", "extension") if key in countOptions))
+
+	try:
+		countVectorData = getcountvectordata.iterCountVectorData(bedfile, bamList, bamIDs, **countOptions)
+		timings = plotCountVectorData(countVectorData, outfolder, binsize, line, filetype,
+									  viewplot and (html != "report"), statistic, html, renderer,
+									  maxPoints, webgl, f, storage)
+		if f is not None:
+			countsfile.writeIndex(f)
+	finally:
+		if f is not None:
+			f.close()
+
+	if f is not None:
+		mobamplot.printer.write("Counts saved to: {0}".format(os.path.realpath(hdf5)))
+	if html == "report":
+		path = htmlreport.writeReport(outfolder, [name for ID, name, seconds, digest in timings], pageSize)
+		mobamplot.printer.write("Report written to: {0}".format(path))
+		if viewplot:
+			webbrowser.open("file://" + os.path.realpath(path))
+
+	mobamplot.reportRenderTimes(timings)
+	return [(ID, name, seconds) for ID, name, seconds, digest in timings]
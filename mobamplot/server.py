@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""Serve binned counts of a fixed set of BAM files over HTTP for interactive
+browsing, without writing an .hdf5 file or html figures first.
+
+The BAM files are opened once when the server starts and stay open. Each
+request counts the region straight from them, bins it and answers. Recently
+requested regions are kept in an LRU cache, so going back to a locus or
+switching between line and histogram does not count it again::
+
+	$ python server.py --bamfiles a.bam b.bam --port 8050
+
+Then open http://localhost:8050/ in a browser.
+
+Endpoints
+---------
+``GET /``
+	page with a region box that draws the mobamplot figure of a locus
+``GET /counts?region=chr:start-end&bin=50``
+	binned counts per BAM. Optional ``statistic`` (mean, max, sum, median)
+	and ``format``: ``json`` (default) or ``binary``, little-endian float32
+	BAM x bin values with the BAM IDs, shape, first bin start and bin size in
+	the ``X-Bam-IDs``, ``X-Shape``, ``X-Bin-Start`` and ``X-Bin-Size``
+	headers. ``Accept: application/octet-stream`` also selects binary.
+``GET /figure?region=chr:start-end&bin=50``
+	plotly figure JSON with the layout of mobamplot.py. ``line=1`` draws a
+	line plot instead of a histogram.
+``GET /plotly.min.js``
+	the plotly.js library for the page
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import numpy as np
+
+try:
+	from . import countsfile
+	from . import htmlreport
+	from . import mobamplot
+	from .getcountvectordata import BAMHandlePool, ENGINES, MAPPINGS, countOptionsError
+except (ImportError, ValueError):
+	# run as a script from the mobamplot folder
+	import countsfile
+	import htmlreport
+	import mobamplot
+	from getcountvectordata import BAMHandlePool, ENGINES, MAPPINGS, countOptionsError
+
+_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>mobamplot</title>
+<script src="/plotly.min.js"></script>
+<style>
+body { font-family: sans-serif; margin: 0 2em; }
+form { padding: 0.5em 0; }
+#status { color: #666; margin-left: 1em; }
+</style>
+</head>
+<body>
+<form id="query">
+<input id="region" size="32" placeholder="chr1:1,000,000-1,050,000">
+bin <input id="bin" size="5" value="50">
+<label><input id="line" type="checkbox"> line</label>
+<button>Show</button>
+<span id="status"></span>
+</form>
+<div id="figure" style="width:100%;height:85vh;"></div>
+<script>
+var form = document.getElementById("query");
+function show() {
+	var region = document.getElementById("region").value.trim();
+	if (!region) { return; }
+	var query = "region=" + encodeURIComponent(region) +
+		"&bin=" + encodeURIComponent(document.getElementById("bin").value) +
+		(document.getElementById("line").checked ? "&line=1" : "");
+	var status = document.getElementById("status");
+	var start = performance.now();
+	status.textContent = "loading...";
+	history.replaceState(null, "", "?" + query);
+	fetch("/figure?" + query).then(function (response) {
+		return response.json().then(function (body) {
+			if (!response.ok) { throw new Error(body.error); }
+			return body;
+		});
+	}).then(function (figure) {
+		Plotly.purge("figure");
+		Plotly.newPlot("figure", figure.data, figure.layout, {showLink: false});
+		status.textContent = Math.round(performance.now() - start) + " ms";
+	}).catch(function (error) {
+		status.textContent = error.message;
+	});
+}
+form.onsubmit = function (event) { event.preventDefault(); show(); };
+var params = new URLSearchParams(window.location.search);
+if (params.get("region")) {
+	document.getElementById("region").value = params.get("region");
+	document.getElementById("bin").value = params.get("bin") || "50";
+	document.getElementById("line").checked = params.get("line") === "1";
+	show();
+}
+</script>
+</body>
+</html>
+"""
+
+_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+		   500: "Internal Server Error"}
+
+class RegionCache(object):
+	"""Least recently used cache of binned count matrices
+
+	Holds at most `capacity` entries. Looking an entry up makes it the most
+	recently used, and adding one beyond capacity evicts the least recently
+	used.
+	"""
+
+	def __init__(self, capacity=256):
+		self.capacity = capacity
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+
+	def get(self, key):
+		if key not in self._entries:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self._entries.move_to_end(key)
+		return self._entries[key]
+
+	def put(self, key, value):
+		self._entries[key] = value
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.capacity:
+			self._entries.popitem(last=False)
+
+	def __len__(self):
+		return len(self._entries)
+
+class CountServer(object):
+	"""Answer region queries from BAM handles that stay open
+
+	BAM handles are not thread safe, so all counting runs on one worker
+	thread, keeping the event loop free to accept requests. Concurrent
+	requests for the same uncached region share one count.
+	"""
+
+	def __init__(self, bamList, bamIDs=None, engine="plastid", mapping="center", extension=0,
+				 cacheSize=256, maxRegion=5000000, maxBins=100000):
+		self.bamList = list(bamList)
+		self.bamIDs = list(bamIDs or [os.path.splitext(os.path.basename(bamfile))[0] for bamfile in bamList])
+		if len(self.bamIDs) != len(self.bamList):
+			raise ValueError("Got {0} BAM IDs for {1} BAM files.".format(len(self.bamIDs), len(self.bamList)))
+		self.pool = BAMHandlePool(self.bamList, engine=engine, mapping=mapping, extension=extension)
+		self.cache = RegionCache(cacheSize)
+		self.maxRegion = maxRegion
+		self.maxBins = maxBins
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self._pending = {}
+		self._plotlyjs = None
+
+	# open every BAM now instead of on the first request
+	def warm(self):
+		for bamfile in self.bamList:
+			if self.pool.engine == "plastid":
+				self.pool.genomeArray(bamfile)
+			else:
+				self.pool.alignmentFile(bamfile)
+
+	def close(self):
+		self._executor.shutdown(wait=True)
+		self.pool.close()
+
+	# parse and check the region and bin size of a query
+	def parseQuery(self, query):
+		if "region" not in query:
+			raise ValueError("Missing region=chrom:start-end.")
+		chrom, start, end = countsfile.parseRegion(query["region"])
+		if end - start > self.maxRegion:
+			raise ValueError("Region is {0} bp, the limit is {1} bp.".format(end - start, self.maxRegion))
+		try:
+			binsize = int(query.get("bin", 50))
+		except ValueError:
+			raise ValueError("bin must be a whole number.")
+		if binsize < 1:
+			raise ValueError("bin must be at least 1.")
+		if -(-(end - start) // binsize) > self.maxBins:
+			raise ValueError("More than {0} bins, use a larger bin.".format(self.maxBins))
+		statistic = query.get("statistic", "mean")
+		if statistic not in countsfile.STATISTICS:
+			raise ValueError("statistic must be one of {0}.".format(", ".join(countsfile.STATISTICS)))
+		return chrom, start, end, binsize, statistic
+
+	# BAM x bin matrix of a region, counted on the worker thread
+	def _count(self, chrom, start, end, binsize, statistic):
+		matrix = np.array([self.pool.getRegionCounts(chrom, start, end, ".", bamfile) for bamfile in self.bamList],
+						  dtype=np.float64)
+		return countsfile.binMatrix(matrix, binsize, statistic)
+
+	# BAM x bin matrix of a region, from the cache when possible
+	async def binnedCounts(self, chrom, start, end, binsize, statistic="mean"):
+		key = (chrom, start, end, binsize, statistic)
+		binned = self.cache.get(key)
+		if binned is not None:
+			return binned
+		if key not in self._pending:
+			loop = asyncio.get_running_loop()
+			self._pending[key] = loop.run_in_executor(self._executor, self._count, chrom, start, end,
+													  binsize, statistic)
+		try:
+			binned = await asyncio.shield(self._pending[key])
+		finally:
+			self._pending.pop(key, None)
+		self.cache.put(key, binned)
+		return binned
+
+	async def counts(self, query, accept=""):
+		chrom, start, end, binsize, statistic = self.parseQuery(query)
+		binned = await self.binnedCounts(chrom, start, end, binsize, statistic)
+		if query.get("format", "binary" if "application/octet-stream" in accept else "json") == "binary":
+			headers = {"X-Bam-IDs": json.dumps(self.bamIDs), "X-Shape": "{0},{1}".format(*binned.shape),
+					   "X-Bin-Start": str(start), "X-Bin-Size": str(binsize)}
+			return 200, binned.astype("<f4").tobytes(), "application/octet-stream", headers
+		body = dict(chrom=chrom, start=start, end=end, bin=binsize, statistic=statistic, bamIDs=self.bamIDs,
+					centers=countsfile.binCenters(start, end, binsize).tolist(), counts=binned.tolist())
+		return 200, json.dumps(body).encode("utf-8"), "application/json", {}
+
+	async def figure(self, query):
+		chrom, start, end, binsize, statistic = self.parseQuery(query)
+		binned = await self.binnedCounts(chrom, start, end, binsize, statistic)
+		title = "{0}:{1}-{2}".format(chrom, start, end)
+		if query.get("line") == "1":
+			fig = mobamplot.lineFigure(chrom, start, end, title, self.bamIDs, binned, binsize, maxPoints=4000)
+		else:
+			fig = mobamplot.histFigure(chrom, start, end, title, self.bamIDs, [binned], [binsize], binsize,
+									   maxPoints=4000)
+		return 200, htmlreport.figureJSON(fig).encode("utf-8"), "application/json", {}
+
+	def plotlyjs(self):
+		if self._plotlyjs is None:
+			self._plotlyjs = htmlreport.get_plotlyjs().encode("utf-8")
+		return 200, self._plotlyjs, "application/javascript", {"Cache-Control": "max-age=86400"}
+
+	# answer one parsed request, returns (status, body, content type, extra headers)
+	async def route(self, method, target, headers):
+		if method != "GET":
+			return 405, b"", "text/plain", {}
+		url = urllib.parse.urlsplit(target)
+		query = dict(urllib.parse.parse_qsl(url.query))
+		try:
+			if url.path == "/":
+				return 200, _PAGE.encode("utf-8"), "text/html; charset=utf-8", {}
+			if url.path == "/plotly.min.js":
+				return self.plotlyjs()
+			if url.path == "/counts":
+				return await self.counts(query, headers.get("accept", ""))
+			if url.path == "/figure":
+				return await self.figure(query)
+		except ValueError as error:
+			return 400, json.dumps(dict(error=str(error))).encode("utf-8"), "application/json", {}
+		return 404, json.dumps(dict(error="Not found: " + url.path)).encode("utf-8"), "application/json", {}
+
+	# read one HTTP request from a connection and answer it
+	async def handle(self, reader, writer):
+		start = time.time()
+		try:
+			requestLine = (await reader.readline()).decode("latin-1").strip()
+			headers = {}
+			while True:
+				line = (await reader.readline()).decode("latin-1").strip()
+				if not line:
+					break
+				name, _, value = line.partition(":")
+				headers[name.strip().lower()] = value.strip()
+			parts = requestLine.split()
+			if len(parts) != 3:
+				status, body, contentType, extra = 400, b"", "text/plain", {}
+				parts = ["-", "-", "-"]
+			else:
+				try:
+					status, body, contentType, extra = await self.route(parts[0], parts[1], headers)
+				except Exception as error:
+					status, body, contentType, extra = (500, json.dumps(dict(error=str(error))).encode("utf-8"),
+														"application/json", {})
+
+			lines = ["HTTP/1.1 {0} {1}".format(status, _STATUS.get(status, "")),
+					 "Content-Type: " + contentType,
+					 "Content-Length: {0}".format(len(body)),
+					 "Connection: close"]
+			lines += ["{0}: {1}".format(name, value) for name, value in extra.items()]
+			writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+			await writer.drain()
+			print("{0} {1} {2} {3:.0f} ms".format(parts[0], parts[1], status, (time.time() - start) * 1000))
+		finally:
+			writer.close()
+
+async def serve(countServer, host="127.0.0.1", port=8050):
+	server = await asyncio.start_server(countServer.handle, host, port)
+	print("Serving {0} BAM(s) on http://{1}:{2}/".format(len(countServer.bamList), host, port))
+	async with server:
+		await server.serve_forever()
+
+def main(args=sys.argv[1:]):
+	"""Command-line program
+
+	Parameters
+	----------
+	argv : list, optional
+		A list of command-line arguments, which will be processed
+		as if the script were called from the command line if
+		:func:`main` is called directly.
+
+		Default: `sys.argv[1:]`. The command-line arguments, if the script is
+		invoked from the command line
+	"""
+	parser = argparse.ArgumentParser(description=__doc__,
+									 formatter_class=argparse.RawDescriptionHelpFormatter)
+	bamgroup = parser.add_mutually_exclusive_group(required=True)
+	bamgroup.add_argument('--bamfolder', help="Input folder containing BAM files.")
+	bamgroup.add_argument('--bamfiles', type=str, nargs='+', help="Input BAM files.")
+	parser.add_argument("--bamIDs", default=None, nargs='+', help="Identification for each BAM.")
+	parser.add_argument("--engine", default="plastid", choices=ENGINES,
+						help="Counting engine. Default: plastid.")
+	parser.add_argument("--mapping", default="center", choices=MAPPINGS,
+						help="Mapping rule from reads to counts. Default: center.")
+	parser.add_argument("--extension", type=int, default=0,
+						help="Extend reads from their 5' end to this fragment length \
+						(coverage mapping only). Default: 0 (no extension).")
+	parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. Default: 127.0.0.1.")
+	parser.add_argument("--port", type=int, default=8050, help="Port to listen on. Default: 8050.")
+	parser.add_argument("--cache", type=int, default=256,
+						help="Number of binned regions kept in the LRU cache. Default: 256.")
+	parser.add_argument("--max-region", type=int, default=5000000,
+						help="Largest region a request may ask for, in bp. Default: 5000000.")
+	args = parser.parse_args(args)
+
+	if args.bamfolder != None:
+		bamList = sorted(glob.glob(os.path.join(args.bamfolder, "*.bam")))
+	else:
+		bamList = args.bamfiles
+
+	error = countOptionsError(args.engine, args.mapping, args.extension)
+	if error:
+		parser.error(error)
+
+	countServer = CountServer(bamList, args.bamIDs, engine=args.engine, mapping=args.mapping,
+							  extension=args.extension, cacheSize=args.cache, maxRegion=args.max_region)
+	countServer.warm()
+	try:
+		asyncio.run(serve(countServer, args.host, args.port))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		print(countServer.pool.stats())
+		countServer.close()
+
+if __name__ == "__main__":
+	main()
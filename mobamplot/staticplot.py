@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Render mobamplot figures to png, jpeg, svg, webp or pdf without a browser or network.
+
+Static images from plotly need either a web browser (``plotly.offline.plot``
+with ``image=``) or the plotly cloud (``py.image.save_as``). This module
+draws the same figure with matplotlib's Agg backend instead: one subplot per
+BAM, a shared y-range rounded up to the nearest 0.5, the ROI start and end as
+x tick labels, and a 1kb scale bar in the upper right of every subplot.
+
+matplotlib is optional. It is only needed when this renderer is used.
+"""
+import math
+
+import numpy as np
+
+try:
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	from matplotlib.patches import Rectangle
+except ImportError:
+	Figure = None
+
+# image formats written by this renderer
+STATIC_FORMATS = ["png", "jpeg", "svg", "webp", "pdf"]
+
+# trace color, as in make_trace_hist and make_trace_line
+COLOR = "#0000ff"
+
+# margin drawn on either side of the ROI, in bp
+MARGIN = 300
+
+# length of the scale bar, in bp
+SCALE_BAR = 1000
+
+def available():
+	return Figure is not None
+
+# y-range maximum of all subplots, countsMax rounded up to the nearest 0.5
+def yRangeMax(countAvg):
+	countsMax = max([np.max(counts) if len(counts) else 0 for counts in countAvg] or [0])
+	return 0.5 * math.ceil(2 * countsMax)
+
+# render one ROI to path, the format is taken from the path's extension
+# countAvg = binned count values per BAM, one per bin of binsize from chromStart
+def renderROI(path, chrom, chromStart, chromEnd, bamIDs, countAvg, binsize, title,
+			  line=False, width=8, subplotHeight=1.5, dpi=100):
+	if not available():
+		raise ImportError("matplotlib is required for static image export")
+
+	# bin edges and centers, the last bin holds the remainder
+	bin_edges = np.append(np.arange(chromStart, chromEnd, binsize), chromEnd)
+	bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.0
+
+	y_range_max = yRangeMax(countAvg)
+	# a flat ROI still gets a visible y-range
+	y_top = y_range_max or 0.5
+
+	fig = Figure(figsize=(width, 1 + subplotHeight * len(bamIDs)), dpi=dpi)
+	FigureCanvasAgg(fig)
+	axes = fig.subplots(len(bamIDs), 1, sharex=True, squeeze=False)[:, 0]
+
+	for ax, BAM, counts in zip(axes, bamIDs, countAvg):
+		counts = np.asarray(counts, dtype=float)
+		if line:
+			# filled line through the bin centers
+			ax.fill_between(bin_centers, counts, color=COLOR, linewidth=1)
+		else:
+			# one filled step per bin, drawn as a single polygon
+			ax.fill_between(bin_edges, np.append(counts, counts[-1:]), step="post",
+							color=COLOR, linewidth=0)
+
+		ax.set_title(BAM, fontsize=10)
+		ax.set_xlim(chromStart - MARGIN, chromEnd + MARGIN)
+		ax.set_ylim(0, y_top)
+		ax.set_ylabel("Reads")
+		ax.set_yticks(np.linspace(0, y_top, 5))
+		ax.tick_params(direction="out")
+
+		# 1kb scale bar in the upper right corner
+		ax.add_patch(Rectangle((chromEnd - SCALE_BAR, y_top * 0.903), SCALE_BAR, y_top * 0.02,
+							   color="black", zorder=3))
+		ax.text(chromEnd - SCALE_BAR / 2.0, y_top * 0.923, "1kb", ha="center", va="bottom",
+				fontsize=8)
+
+	# ROI start & end coordinates as x tick labels
+	axes[-1].set_xticks([chromStart, chromEnd])
+	axes[-1].set_xticklabels([str(chrom) + ": " + str(chromStart), str(chrom) + ": " + str(chromEnd)])
+
+	# fixed margins, tight_layout costs more than drawing the figure
+	height = fig.get_figheight()
+	fig.subplots_adjust(left=0.1, right=0.9, bottom=0.6 / height, top=1 - 0.8 / height, hspace=0.4)
+	fig.suptitle("Gene: " + title, fontsize=14)
+	fig.savefig(path)
+	return path
+
+# render a metaplot to path: mean, median and quantile band per BAM
+# xTicks = (tick positions, tick labels), xRange = (left, right)
+def renderMeta(path, positions, bamIDs, mean, median, lower, upper, title, xTicks, xRange,
+			   width=8, subplotHeight=1.5, dpi=100):
+	if not available():
+		raise ImportError("matplotlib is required for static image export")
+
+	# bins without values count as 0 for the y-range
+	y_top = yRangeMax([np.nan_to_num(upper), np.nan_to_num(mean)]) or 0.5
+
+	fig = Figure(figsize=(width, 1 + subplotHeight * len(bamIDs)), dpi=dpi)
+	FigureCanvasAgg(fig)
+	axes = fig.subplots(len(bamIDs), 1, sharex=True, squeeze=False)[:, 0]
+
+	for index, (ax, BAM) in enumerate(zip(axes, bamIDs)):
+		ax.fill_between(positions, lower[index], upper[index], color=COLOR, alpha=0.2, linewidth=0)
+		ax.plot(positions, median[index], color=COLOR, linestyle="--", linewidth=1)
+		ax.plot(positions, mean[index], color=COLOR, linewidth=1)
+		ax.set_title(BAM, fontsize=10)
+		ax.set_xlim(*xRange)
+		ax.set_ylim(0, y_top)
+		ax.set_ylabel("Reads")
+		ax.tick_params(direction="out")
+
+	axes[-1].set_xticks(xTicks[0])
+	axes[-1].set_xticklabels(xTicks[1])
+
+	height = fig.get_figheight()
+	fig.subplots_adjust(left=0.1, right=0.9, bottom=0.6 / height, top=1 - 0.8 / height, hspace=0.4)
+	fig.suptitle(title, fontsize=14)
+	fig.savefig(path)
+	return path
+
+# render BAM x row x column heatmaps to path, one panel per BAM side by side, first row on top
+# xTicks = (tick positions, tick labels), xRange = (left, right) of the columns
+def renderHeatmap(path, heatmaps, bamIDs, zmax, title, xTicks, xRange, panelWidth=3, height=8, dpi=100):
+	if not available():
+		raise ImportError("matplotlib is required for static image export")
+
+	fig = Figure(figsize=(1 + panelWidth * len(bamIDs), height), dpi=dpi)
+	FigureCanvasAgg(fig)
+	axes = fig.subplots(1, len(bamIDs), sharey=True, squeeze=False)[0]
+
+	for ax, BAM, heatmap in zip(axes, bamIDs, heatmaps):
+		# white to blue, as the html heatmap
+		image = ax.imshow(heatmap, aspect="auto", interpolation="nearest", cmap="Blues", vmin=0, vmax=zmax,
+						  extent=(xRange[0], xRange[1], len(heatmap), 0))
+		ax.set_title(BAM, fontsize=10)
+		ax.set_xticks(xTicks[0])
+		ax.set_xticklabels(xTicks[1])
+		ax.set_yticks([])
+		ax.tick_params(direction="out")
+	axes[0].set_ylabel("ROIs")
+	fig.colorbar(image, ax=list(axes), fraction=0.03)
+
+	fig.subplots_adjust(left=0.05, right=0.85, bottom=0.08, top=0.9, wspace=0.25)
+	fig.suptitle(title, fontsize=14)
+	fig.savefig(path)
+	return path
@@ -5,10 +5,12 @@
 
 import pytest
 
-from click.testing import CliRunner
-
-from mobamplot import mobamplot
-from mobamplot import cli
+try:
+    from click.testing import CliRunner
+    from mobamplot import cli
+except ImportError:
+    # only the CLI test needs click, the other tests skip on their own dependencies
+    cli = None
 
 
 @pytest.fixture
@@ -29,6 +31,8 @@ def test_content(response):
 
 def test_command_line_interface():
     """Test the CLI."""
+    if cli is None:
+        pytest.skip("click is not installed")
     runner = CliRunner()
     result = runner.invoke(cli.main)
     assert result.exit_code == 0
@@ -36,3 +40,1056 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def _write_bam(path):
+    """Write a small indexed BAM with one forward and one spliced reverse read."""
+    pysam = pytest.importorskip("pysam")
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 1000}]}
+    with pysam.AlignmentFile(path, "wb", header=header) as bam:
+        for name, flag, start, cigar in [("fwd", 0, 100, "10M"),
+                                         ("rev", 16, 104, "5M2N5M")]:
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.query_sequence = "A" * 10
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigarstring = cigar
+            read.query_qualities = pysam.qualitystring_to_array("I" * 10)
+            bam.write(read)
+    pysam.index(path)
+    return pysam.AlignmentFile(path, "rb")
+
+
+def test_count_region_pysam_engine(tmpdir):
+    """The NumPy counting engine applies each mapping rule per nucleotide."""
+    pytest.importorskip("plastid")
+    import numpy as np
+    from mobamplot import getcountvectordata
+
+    bam = _write_bam(str(tmpdir.join("reads.bam")))
+    start, end = 95, 125
+
+    fiveprime = getcountvectordata.countRegion(bam, "chr1", start, end, mapping="fiveprime")
+    expected = np.zeros(end - start)
+    expected[[100 - start, 115 - start]] = 1
+    assert np.array_equal(fiveprime, expected)
+
+    coverage = getcountvectordata.countRegion(bam, "chr1", start, end, mapping="coverage")
+    expected = np.zeros(end - start)
+    expected[100 - start:110 - start] += 1
+    expected[104 - start:109 - start] += 1
+    expected[111 - start:116 - start] += 1
+    assert np.array_equal(coverage, expected)
+
+    center = getcountvectordata.countRegion(bam, "chr1", start, end, mapping="center")
+    assert np.allclose(center, expected / 10.0)
+
+    plus = getcountvectordata.countRegion(bam, "chr1", start, end, strand="+", mapping="coverage")
+    assert plus.sum() == 10
+
+    extended = getcountvectordata.countRegion(bam, "chr1", start, end, mapping="coverage", extension=20)
+    expected = np.zeros(end - start)
+    expected[100 - start:120 - start] += 1
+    expected[96 - start:116 - start] += 1
+    assert np.array_equal(extended, expected)
+
+
+def test_bam_handle_pool_opens_each_bam_once(tmpdir):
+    """A pool opens every BAM once however many ROIs it counts."""
+    pytest.importorskip("plastid")
+    from plastid.genomics.roitools import GenomicSegment, SegmentChain
+    from mobamplot import getcountvectordata
+
+    bamList = [str(tmpdir.join("reads{0}.bam".format(number))) for number in range(2)]
+    for bamfile in bamList:
+        _write_bam(bamfile).close()
+    segments = [SegmentChain(GenomicSegment("chr1", start, start + 50, "+")) for start in range(0, 500, 50)]
+
+    for engine in getcountvectordata.ENGINES:
+        with getcountvectordata.BAMHandlePool(bamList, engine=engine) as pool:
+            for segment in segments:
+                for bamfile in bamList:
+                    pool.getCounts(segment, bamfile)
+            assert pool.opens == len(bamList)
+            assert pool.reads == len(segments) * len(bamList)
+            assert "Opened 2 BAM file(s), read 20 count vector(s)." == pool.stats()
+
+
+def test_count_options_refused_before_counting(tmpdir):
+    """Mapping rules plastid cannot compute are refused with a usage error."""
+    pytest.importorskip("plastid")
+    from mobamplot import getcountvectordata
+
+    assert getcountvectordata.countOptionsError("pysam", "coverage", 200) is None
+    assert getcountvectordata.countOptionsError("plastid", "coverage") is not None
+    bedfile = str(tmpdir.join("rois.bed"))
+    for options in [["--validate-engine", "--mapping", "coverage"],
+                    ["--validate-engine", "--engine", "pysam", "--mapping", "center", "--extension", "200"],
+                    ["--mapping", "coverage"]]:
+        with pytest.raises(SystemExit) as error:
+            getcountvectordata.main([bedfile, "--bamfiles", "reads.bam", "--outfolder", str(tmpdir)] + options)
+        assert error.value.code == 2
+
+
+def test_sweep_matches_per_roi_counts(tmpdir):
+    """Counting merged super-regions gives the same vectors as counting each ROI."""
+    pytest.importorskip("plastid")
+    import numpy as np
+    from plastid.genomics.roitools import GenomicSegment, SegmentChain
+    from mobamplot import getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    segments = [SegmentChain(GenomicSegment("chr1", start, end, strand))
+                for start, end, strand in [(300, 310, "+"), (95, 110, "+"),
+                                           (105, 125, "+"), (90, 120, "-")]]
+
+    clusters = list(getcountvectordata._sweepClusters(enumerate(segments), 1000))
+    assert sorted([index for index, segment in cluster] for cluster in clusters) == [[0], [1, 2], [3]]
+
+    with getcountvectordata.BAMHandlePool([bamfile], engine="pysam", mapping="coverage") as pool:
+        for cluster in clusters:
+            merged = getcountvectordata._countCluster(pool, [seg for index, seg in cluster], bamfile)
+            for (index, segment), counts in zip(cluster, merged):
+                assert np.array_equal(counts, pool.getCounts(segment, bamfile))
+
+
+def _write_bed(path):
+    """Write a BED file of ROIs overlapping and around the reads of _write_bam."""
+    with open(path, "w") as bed:
+        for number, (start, end, strand) in enumerate([(90, 120, "+"), (95, 130, "-"), (300, 340, "+"),
+                                                       (100, 112, "+"), (0, 1000, "-")]):
+            bed.write("chr1\t{0}\t{1}\troi{2}\t0\t{3}\n".format(start, end, number, strand))
+    return path
+
+
+def test_parallel_counts_file_matches_serial(tmpdir):
+    """Counting in worker processes writes the same bytes as a serial run."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("h5py")
+    from mobamplot import getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    serial = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("serial")))
+    parallel = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("parallel")),
+                                           workers=2, chunksize=2)
+    assert open(serial, "rb").read() == open(parallel, "rb").read()
+
+
+def test_resume_recounts_incomplete_rois(tmpdir):
+    """A resumed run recounts deleted and unfinished ROIs to the data of a fresh run."""
+    pytest.importorskip("plastid")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    fresh = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("fresh")))
+    resumed = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("resumed")))
+
+    with h5py.File(resumed, "a") as f:
+        del f["roi1"]
+        f["roi3"].attrs["complete"] = False
+        # an interrupted write: column missing and no completion marker
+        del f["roi4"]["reads"]
+        f["roi4"].attrs["complete"] = False
+        assert countsfile.completedROIs(f, ["reads"]) == set(["roi0", "roi2"])
+    getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.join("resumed")), resume=True)
+
+    with h5py.File(fresh, "r") as expected, h5py.File(resumed, "r") as observed:
+        names = countsfile.roiNames(expected)
+        assert sorted(countsfile.roiNames(observed)) == sorted(names)
+        assert countsfile.completedROIs(observed, ["reads"]) == set(names)
+        for name in names:
+            assert countsfile.roiCoordinates(observed[name]) == countsfile.roiCoordinates(expected[name])
+            assert np.array_equal(countsfile.readColumns(observed[name])[0],
+                                  countsfile.readColumns(expected[name])[0])
+        assert countsfile.regionROIs(observed, "chr1", 0, 1000) == countsfile.regionROIs(expected, "chr1", 0, 1000)
+
+
+def test_resume_refuses_other_bams_or_options(tmpdir, monkeypatch):
+    """A resume with other BAMs or counting options is refused, and a failed run leaves the file closed."""
+    pytest.importorskip("plastid")
+    h5py = pytest.importorskip("h5py")
+    from mobamplot import countsfile, getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    outfolder = str(tmpdir.mkdir("out"))
+    hdf5 = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], outfolder, engine="pysam")
+    with h5py.File(hdf5, "r") as f:
+        assert getcountvectordata.readCountSettings(f) == getcountvectordata.countSettings("pysam")
+        assert sorted(getcountvectordata.readProvenance(f)) == ["reads"]
+
+    with pytest.raises(ValueError):
+        getcountvectordata.saveHDF5(bedfile, [bamfile], ["other"], outfolder, engine="pysam", resume=True)
+    with pytest.raises(ValueError):
+        getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], outfolder, engine="pysam",
+                                    mapping="coverage", resume=True)
+    getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], outfolder, engine="pysam", resume=True)
+
+    # counting fails after one ROI: the file is closed with that ROI written
+    def failing(*args, **kwargs):
+        for index, item in enumerate(iterCountVectorData(*args, **kwargs)):
+            if index == 1:
+                raise RuntimeError("BAM read failed")
+            yield item
+    iterCountVectorData = getcountvectordata.iterCountVectorData
+    monkeypatch.setattr(getcountvectordata, "iterCountVectorData", failing)
+    with pytest.raises(RuntimeError):
+        getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], outfolder, engine="pysam")
+    with h5py.File(hdf5, "r") as f:
+        assert len(countsfile.completedROIs(f, ["reads"])) == 1
+
+
+def _column_bytes(roi, bamID):
+    """Raw stored bytes of one BAM column, dense or run-length encoded."""
+    column = roi[bamID]
+    if hasattr(column, "keys"):
+        return column["ends"][()].tobytes() + column["values"][()].tobytes()
+    return column[()].tobytes()
+
+
+def test_append_bam_reuses_stored_count_options(tmpdir):
+    """Appended columns are counted like the existing ones and conflicting options are refused."""
+    pytest.importorskip("plastid")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, getcountvectordata
+
+    first, second = str(tmpdir.join("a.bam")), str(tmpdir.join("b.bam"))
+    _write_bam(first).close()
+    _write_bam(second).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    hdf5 = getcountvectordata.saveHDF5(bedfile, [first], ["a"], str(tmpdir), engine="pysam", mapping="coverage")
+
+    with pytest.raises(ValueError):
+        getcountvectordata.appendBAMs(hdf5, bedfile, [second], ["b"], mapping="center")
+    # no options given: the stored pysam coverage counting is used
+    getcountvectordata.appendBAMs(hdf5, bedfile, [second], ["b"])
+    with h5py.File(hdf5, "r") as f:
+        assert sorted(getcountvectordata.readProvenance(f)) == ["a", "b"]
+        assert getcountvectordata.staleBAMs(f) == []
+        for name in countsfile.roiNames(f):
+            assert countsfile.roiBamIDs(f[name]) == ["a", "b"]
+            a, b = countsfile.readColumns(f[name])
+            assert np.array_equal(a, b)
+
+
+def test_refresh_stale_recounts_only_changed_bam(tmpdir, monkeypatch):
+    """--refresh-stale recounts the column of a touched BAM and leaves the others byte-identical."""
+    pytest.importorskip("plastid")
+    h5py = pytest.importorskip("h5py")
+    import os
+    import numpy as np
+    from mobamplot import countsfile, getcountvectordata
+
+    first, second = str(tmpdir.join("a.bam")), str(tmpdir.join("b.bam"))
+    _write_bam(first).close()
+    _write_bam(second).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    outfolder = str(tmpdir.mkdir("out"))
+    getcountvectordata.main([bedfile, "--bamfiles", first, second, "--outfolder", outfolder, "--engine", "pysam"])
+    hdf5 = os.path.join(outfolder, "rois.hdf5")
+
+    with h5py.File(hdf5, "a") as f:
+        assert getcountvectordata.staleBAMs(f) == []
+        names = countsfile.roiNames(f)
+        # wrong values in b, the refresh must replace them
+        for name in names:
+            countsfile.addColumns(f[name], ["b"], [np.full(len(countsfile.readColumns(f[name], ["b"])[0]), 9.0)])
+        before = dict((name, _column_bytes(f[name], "a")) for name in names)
+        expected = dict((name, countsfile.readColumns(f[name], ["a"])[0]) for name in names)
+    os.utime(second, (os.path.getatime(second), os.path.getmtime(second) + 10))
+    with h5py.File(hdf5, "r") as f:
+        assert getcountvectordata.staleBAMs(f) == ["b"]
+
+    counted = []
+    def recording(bedfile, bamList, bamIDs, **countOptions):
+        counted.append((list(bamIDs), countOptions["engine"]))
+        return iterCountVectorData(bedfile, bamList, bamIDs, **countOptions)
+    iterCountVectorData = getcountvectordata.iterCountVectorData
+    monkeypatch.setattr(getcountvectordata, "iterCountVectorData", recording)
+    # no --engine: the stored pysam engine is reused
+    getcountvectordata.main([bedfile, "--outfolder", outfolder, "--refresh-stale"])
+    assert counted == [(["b"], "pysam")]
+
+    with h5py.File(hdf5, "r") as f:
+        assert getcountvectordata.staleBAMs(f) == []
+        for name in names:
+            assert _column_bytes(f[name], "a") == before[name]
+            assert np.array_equal(countsfile.readColumns(f[name], ["b"])[0], expected[name])
+
+    with pytest.raises(SystemExit):
+        getcountvectordata.main([bedfile, "--outfolder", outfolder, "--refresh-stale", "--engine", "plastid"])
+
+
+def test_sweep_writes_unsorted_bed_in_counting_order(tmpdir):
+    """A swept run writes the same ROIs as a plain run without restoring BED order."""
+    pytest.importorskip("plastid")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    swept = list(getcountvectordata.iterCountVectorData(bedfile, [bamfile], ["reads"], engine="pysam",
+                                                        sweep=True, ordered=False))
+    assert [str(segment.get_name()) for segment, counts in swept] != ["roi0", "roi1", "roi2", "roi3", "roi4"]
+
+    plain = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("plain")), engine="pysam")
+    sweep = getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir.mkdir("sweep")), engine="pysam",
+                                        sweep=True)
+    with h5py.File(plain, "r") as expected, h5py.File(sweep, "r") as observed:
+        for name in countsfile.roiNames(expected):
+            assert np.array_equal(countsfile.readColumns(observed[name])[0],
+                                  countsfile.readColumns(expected[name])[0])
+
+
+def test_counts_file_column_layout(tmpdir):
+    """ROIs are stored one dataset per BAM, and legacy files convert losslessly."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile
+
+    a = np.arange(10, dtype=float)
+    b = np.ones(10)
+    legacy = str(tmpdir.join("legacy.hdf5"))
+    with h5py.File(legacy, "w") as f:
+        dset = f.create_dataset("roi1", data=np.core.records.fromarrays([a, b], names=["a", "b"]))
+        dset.attrs["ID"] = np.string_("roi1")
+        dset.attrs["chrom"] = np.string_("chr1")
+        dset.attrs["chromStart"] = 100
+        dset.attrs["chromEnd"] = 110
+
+    columns = str(tmpdir.join("columns.hdf5"))
+    countsfile.convertLegacy(legacy, columns)
+    with h5py.File(columns, "a") as f:
+        assert countsfile.isColumnar(f)
+        roi = f["roi1"]
+        assert countsfile.roiCoordinates(roi) == ("chr1", 100, 110)
+        assert countsfile.roiBamIDs(roi) == ["a", "b"]
+        assert np.array_equal(countsfile.readColumns(roi, ["b"])[0], b)
+        assert countsfile.completedROIs(f, ["a", "b"]) == set(["roi1"])
+
+        countsfile.addColumns(roi, ["c"], [2 * a])
+        assert countsfile.roiBamIDs(roi) == ["a", "b", "c"]
+        assert np.array_equal(countsfile.readColumns(roi)[2], 2 * a)
+
+
+def test_storage_options_reach_datasets(tmpdir):
+    """Codec, level, shuffle and chunk length are applied to every count dataset."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile
+
+    counts = np.arange(1000.0)
+    with h5py.File(str(tmpdir.join("storage.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        gzip = countsfile.writeROI(f, "gzip", "chr1", 0, 1000, ["a"], [counts],
+                                   compression="gzip", compressionLevel=7, chunkLength=256, encoding="dense")["a"]
+        assert (gzip.compression, gzip.compression_opts, gzip.shuffle, gzip.chunks) == ("gzip", 7, True, (256,))
+
+        lzf = countsfile.writeROI(f, "lzf", "chr1", 0, 1000, ["a"], [counts],
+                                  compression="lzf", chunkLength=4096, encoding="dense")["a"]
+        assert (lzf.compression, lzf.shuffle, lzf.chunks) == ("lzf", True, (1000,))
+
+        plain = countsfile.writeROI(f, "none", "chr1", 0, 1000, ["a"], [counts],
+                                    compression="none", encoding="dense")["a"]
+        assert (plain.compression, plain.chunks) == (None, None)
+
+        rle = countsfile.writeROI(f, "rle", "chr1", 0, 1000, ["a"], [np.zeros(1000)],
+                                  compression="gzip", compressionLevel=2, encoding="rle")["a"]
+        assert rle["ends"].compression_opts == rle["values"].compression_opts == 2
+
+    with pytest.raises(ValueError):
+        countsfile.datasetOptions(1000, compression="zstd")
+    with pytest.raises(ValueError):
+        countsfile.datasetOptions(1000, compression="gzip", compressionLevel=12)
+
+
+def test_invalid_codec_refused_before_counting(tmpdir):
+    """saveHDF5 refuses an unknown codec without creating the counts file."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("h5py")
+    from mobamplot import getcountvectordata
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    bedfile = _write_bed(str(tmpdir.join("rois.bed")))
+    with pytest.raises(ValueError):
+        getcountvectordata.saveHDF5(bedfile, [bamfile], ["reads"], str(tmpdir), engine="pysam", compression="zstd")
+    assert not tmpdir.join("rois.hdf5").check()
+
+
+def test_compact_dtype_selection():
+    """Count columns are stored in the narrowest dtype that holds them."""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("h5py")
+    from mobamplot import countsfile
+
+    assert countsfile.compactDtype(np.array([0.0, 3.0, 255.0])) == np.uint8
+    assert countsfile.compactDtype(np.array([0.0, 256.0])) == np.uint16
+    assert countsfile.compactDtype(np.array([0.0, 70000.0])) == np.uint32
+    assert countsfile.compactDtype(np.array([0.0, 2.0 ** 40])) == np.float64
+    assert countsfile.compactDtype(np.array([0.5, 1.25])) == np.float32
+    assert countsfile.compactDtype(np.array([0.5]), dtype="float64") == np.float64
+
+
+def test_run_length_columns(tmpdir):
+    """Run-length encoded columns decode and bin to the dense values."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile
+
+    counts = np.zeros(1000)
+    counts[100:150] = 3
+    counts[400] = 7
+    ends, values = countsfile.runLengthEncode(counts)
+    assert len(ends) == 5
+    assert np.array_equal(countsfile.runLengthDecode(ends, values), counts)
+
+    with h5py.File(str(tmpdir.join("rle.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        roi = countsfile.writeROI(f, "roi1", "chr1", 0, 1000, ["sparse", "dense"],
+                                  [counts, np.arange(1000.0)])
+        assert isinstance(roi["sparse"], h5py.Group)
+        assert isinstance(roi["dense"], h5py.Dataset)
+        sparse, dense = countsfile.readColumns(roi)
+        assert np.array_equal(sparse, counts)
+        binned = countsfile.readBinnedColumns(roi, ["sparse", "dense"], 300)
+        assert np.allclose(binned[0], countsfile.binMeans(counts, 300))
+        assert np.allclose(binned[1], countsfile.binMeans(np.arange(1000.0), 300))
+
+
+def test_column_binner_reads_columns_once(tmpdir, monkeypatch):
+    """Binning a ROI at every slider step reads each column once."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile
+
+    counts = np.random.RandomState(0).poisson(2, 1000).astype(float)
+    sparse = np.zeros(1000)
+    sparse[200:260] = 4
+    reads = []
+    readColumn = countsfile.readColumn
+    monkeypatch.setattr(countsfile, "readColumn", lambda roi, bamID: reads.append(bamID) or readColumn(roi, bamID))
+    with h5py.File(str(tmpdir.join("binner.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        roi = countsfile.writeROI(f, "roi1", "chr1", 0, 1000, ["a", "b", "c"], [counts, 2 * counts, sparse])
+        binner = countsfile.columnBinner(roi, ["a", "b", "c"])
+        for binsize in range(10, 200, 10):
+            expected = countsfile.binMatrix(np.array([counts, 2 * counts, sparse]), binsize)
+            assert np.allclose(binner(binsize), expected)
+    assert sorted(reads) == ["a", "b"]
+
+
+def test_bin_pyramid_levels(tmpdir):
+    """Bins read from a coarser pyramid level match binning the raw counts."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile
+
+    counts = np.random.RandomState(0).poisson(2, 1000).astype(float)
+    with h5py.File(str(tmpdir.join("pyramid.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        roi = countsfile.writeROI(f, "roi1", "chr1", 0, 1000, ["a"], [counts], pyramid=[32])
+        assert countsfile.pyramidLevels(roi) == [32]
+
+        means = countsfile.readPyramidColumns(roi, ["a"], 96)[0]
+        assert np.allclose(means, countsfile.binMeans(counts, 96))
+        maxima = countsfile.readPyramidColumns(roi, ["a"], 96, statistic="max")[0]
+        assert np.array_equal(maxima, countsfile.binSummary(counts, 96)["max"])
+        assert countsfile.readPyramidColumns(roi, ["a"], 50) is None
+
+        # the default levels serve every slider step and the default bin sizes
+        roi = countsfile.writeROI(f, "roi2", "chr1", 0, 1000, ["a"], [counts], pyramid=countsfile.DEFAULT_LEVELS)
+        for binsize in list(range(10, 200, 10)) + [50, 200]:
+            assert np.allclose(countsfile.readPyramidColumns(roi, ["a"], binsize)[0],
+                               countsfile.binMeans(counts, binsize))
+
+
+def test_bin_matrix_ragged_last_bin():
+    """binMatrix bins every row at once, the last bin holding the remainder."""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("h5py")
+    from mobamplot import countsfile
+
+    matrix = np.array([[1.0, 2, 3, 4, 5, 6, 7],
+                       [0.0, 0, 9, 1, 1, 1, 2]])
+    assert np.allclose(countsfile.binMatrix(matrix, 3, "mean"), [[2, 5, 7], [3, 1, 2]])
+    assert np.allclose(countsfile.binMatrix(matrix, 3, "max"), [[3, 6, 7], [9, 1, 2]])
+    assert np.allclose(countsfile.binMatrix(matrix, 3, "sum"), [[6, 15, 7], [9, 3, 2]])
+    assert np.allclose(countsfile.binMatrix(matrix, 3, "median"), [[2, 5, 7], [0, 1, 2]])
+    assert np.allclose(countsfile.binMatrix(matrix[0], 7, "sum"), [28])
+    assert np.allclose(countsfile.binCenters(100, 107, 3), [101.5, 104.5, 106.5])
+
+
+def test_html_report_shares_plotlyjs(tmpdir):
+    """Shared and report output write plotly.js once and reference it."""
+    pytest.importorskip("plotly")
+    from mobamplot import htmlreport
+
+    outfolder = str(tmpdir)
+    fig = {"data": [{"type": "bar", "x": [1, 2], "y": [3, 4]}], "layout": {"title": "</script>"}}
+    htmlreport.writePlotlyJS(outfolder)
+    htmlreport.writePlotlyJS(outfolder)
+    assert tmpdir.listdir(lambda path: path.basename.endswith(".tmp")) == []
+
+    page = open(htmlreport.writeFigureHTML(fig, outfolder, "roi1.hist")).read()
+    assert '<script src="plotly.min.js">' in page
+    assert "<\\/script>" in page and len(page) < 10000
+
+    data = open(htmlreport.writeFigureData(fig, outfolder, "roi1.hist")).read()
+    assert data.startswith('mobamplotReport.add("roi1.hist", ')
+    report = open(htmlreport.writeReport(outfolder, ["roi1.hist"], pageSize=10)).read()
+    assert '["roi1.hist"]' in report and "IntersectionObserver" in report
+
+
+def test_static_renderer_writes_images(tmpdir):
+    """The matplotlib renderer writes png, svg and pdf without a display."""
+    pytest.importorskip("matplotlib")
+    np = pytest.importorskip("numpy")
+    from mobamplot import staticplot
+
+    countAvg = [np.array([0.0, 1.2, 3.0]), np.array([0.5, 0.0, 2.0])]
+    assert staticplot.yRangeMax(countAvg) == 3.0
+    assert staticplot.yRangeMax([np.zeros(3)]) == 0.0
+    for format, magic in [("png", b"\x89PNG"), ("svg", b"<?xml"), ("pdf", b"%PDF")]:
+        path = str(tmpdir.join("roi1." + format))
+        staticplot.renderROI(path, "chr1", 1000, 3500, ["a", "b"], countAvg, 1000, "roi1",
+                             line=(format == "svg"))
+        assert open(path, "rb").read(len(magic)) == magic
+
+
+def test_static_renderer_writes_metaplot_and_heatmap(tmpdir):
+    """Metaplots and heatmaps render headless, empty bins included."""
+    pytest.importorskip("matplotlib")
+    np = pytest.importorskip("numpy")
+    from mobamplot import staticplot
+
+    positions = np.arange(-150.0, 200.0, 100.0)
+    mean = np.array([[1.0, 2.0, 3.0, np.nan], [0.0, 1.0, 1.0, 0.5]])
+    path = str(tmpdir.join("metaplot.center.pdf"))
+    staticplot.renderMeta(path, positions, ["a", "b"], mean, mean, mean - 0.5, mean + 0.5, "Metaplot: 2 ROIs",
+                          ([-200, 0, 200], ["-200 bp", "center", "+200 bp"]), (-200, 200))
+    assert open(path, "rb").read(4) == b"%PDF"
+
+    heatmaps = np.random.RandomState(0).rand(2, 5, 4)
+    heatmaps[0, 0, 0] = np.nan
+    path = str(tmpdir.join("heatmap.scaled.png"))
+    staticplot.renderHeatmap(path, heatmaps, ["a", "b"], 1.0, "Heatmap: 5 ROIs",
+                             ([0, 100], ["start", "end"]), (0, 100))
+    assert open(path, "rb").read(4) == b"\x89PNG"
+
+
+def test_parallel_rendering_matches_serial(tmpdir, monkeypatch):
+    """--jobs 2 writes the same figure files as --jobs 1 and prints the timing summary."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    pytest.importorskip("matplotlib")
+    h5py = pytest.importorskip("h5py")
+    import os
+    import numpy as np
+    from mobamplot import countsfile, mobamplot
+
+    hdf5 = str(tmpdir.join("rois.hdf5"))
+    with h5py.File(hdf5, "w") as f:
+        countsfile.initLayout(f)
+        for number in range(4):
+            countsfile.writeROI(f, "roi{0}".format(number), "chr1", 1000 * number, 1000 * number + 800,
+                                ["a", "b"], [np.arange(800.0) % (number + 3), np.ones(800) * number])
+
+    messages = []
+    monkeypatch.setattr(mobamplot.printer, "write", messages.append)
+    folders = {}
+    for jobs in (1, 2):
+        folders[jobs] = str(tmpdir.mkdir("jobs{0}".format(jobs)))
+        del messages[:]
+        timings = mobamplot.plotData(hdf5, "png", folders[jobs], False, 100, jobs=jobs, renderer="matplotlib")
+        assert [timing[0] for timing in timings] == ["roi0", "roi1", "roi2", "roi3"]
+        assert any(message.startswith("Rendered 4 ROIs") for message in messages)
+
+    assert sorted(os.listdir(folders[1])) == sorted(os.listdir(folders[2]))
+    for name in os.listdir(folders[1]):
+        assert open(os.path.join(folders[1], name), "rb").read() == open(os.path.join(folders[2], name), "rb").read()
+
+
+def test_every_static_format_uses_matplotlib(tmpdir, monkeypatch):
+    """Static formats are drawn by matplotlib, and refused when it is missing."""
+    pytest.importorskip("plastid")
+    plotly = pytest.importorskip("plotly")
+    pytest.importorskip("matplotlib")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, mobamplot, staticplot
+
+    for format in ["png", "jpeg", "svg", "webp", "pdf"]:
+        assert mobamplot.outputOptions(format) == (format, "standalone", "matplotlib")
+
+    hdf5 = str(tmpdir.join("rois.hdf5"))
+    with h5py.File(hdf5, "w") as f:
+        countsfile.initLayout(f)
+        countsfile.writeROI(f, "roi1", "chr1", 0, 500, ["reads"], [np.arange(500.0)])
+
+    # plotly must not be asked for any image
+    def refuse(*args, **kwargs):
+        raise AssertionError("static image requested from plotly")
+    monkeypatch.setattr(plotly.offline, "plot", refuse)
+    for format, magic in [("jpeg", b"\xff\xd8\xff"), ("webp", b"RIFF"), ("svg", b"<?xml")]:
+        mobamplot.plotData(hdf5, format, str(tmpdir), False, 100, line=(format == "svg"))
+        name = mobamplot.figureFileName("roi1", format == "svg", 100, "matplotlib")
+        assert tmpdir.join(name + "." + format).read_binary()[:len(magic)] == magic
+
+    monkeypatch.setattr(staticplot, "available", lambda: False)
+    with pytest.raises(ImportError):
+        mobamplot.outputOptions("png")
+    with pytest.raises(SystemExit):
+        mobamplot.main(["--hdf5", hdf5, "--outfolder", str(tmpdir), "--plot", "--format", "svg"])
+
+
+def test_figure_names_do_not_collide(tmpdir):
+    """IDs that sanitize to the same file name still get one figure each."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    pytest.importorskip("matplotlib")
+    h5py = pytest.importorskip("h5py")
+    import os
+    import numpy as np
+    from mobamplot import countsfile, mobamplot
+
+    assert mobamplot.figureName("peak_12", ".hist") == "peak_12.hist"
+    IDs = ["a b", "a_b", "a/b", "_a_b_"]
+    assert len(set(mobamplot.figureName(ID, ".hist") for ID in IDs)) == len(IDs)
+
+    hdf5 = str(tmpdir.join("rois.hdf5"))
+    with h5py.File(hdf5, "w") as f:
+        countsfile.initLayout(f)
+        countsfile.writeROI(f, "a b", "chr1", 0, 500, ["reads"], [np.ones(500)])
+        countsfile.writeROI(f, "a_b", "chr1", 500, 1000, ["reads"], [np.zeros(500)])
+    outfolder = str(tmpdir.mkdir("figures"))
+    timings = mobamplot.plotData(hdf5, "png", outfolder, False, 100, renderer="matplotlib")
+    assert len(set(name for ID, name, seconds, digest in timings)) == 2
+    assert len([name for name in os.listdir(outfolder) if name.endswith(".png")]) == 2
+
+
+def test_metaplot_streaming_aggregate():
+    """Streaming metaplot statistics match the statistics of all profiles at once."""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("h5py")
+    from mobamplot import metaplot
+
+    assert np.allclose(metaplot.scaleProfile(np.arange(10.0), 5), [[0.5, 2.5, 4.5, 6.5, 8.5]])
+    assert np.allclose(metaplot.scaleProfile(np.ones(3), 7), np.ones((1, 7)))
+    center = metaplot.centerProfile(np.arange(6.0), 4, 2)
+    assert np.allclose(center, [[0, 1.5, 3.5, 5]])
+
+    profiles = np.random.RandomState(1).rand(300, 2, 4)
+    profiles[::5, 0, 1] = np.nan
+    meta = metaplot.MetaAggregate(2, 4, reservoir=1000)
+    for profile in profiles:
+        meta.add(profile)
+    assert meta.rois == 300
+    assert np.allclose(meta.mean, np.nanmean(profiles, axis=0))
+    assert np.allclose(meta.variance(), np.nanvar(profiles, axis=0, ddof=1))
+    assert np.allclose(meta.median(), np.nanmedian(profiles, axis=0))
+
+    sampled = metaplot.MetaAggregate(2, 4, reservoir=50)
+    for profile in profiles:
+        sampled.add(profile)
+    assert np.allclose(sampled.mean, meta.mean)
+    assert np.all(np.abs(sampled.median() - meta.median()) < 0.2)
+
+
+def test_center_profile_odd_and_even_lengths():
+    """The center bin starts at position length // 2 and positions match the bins."""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("h5py")
+    from mobamplot import metaplot
+
+    # odd: the middle nucleotide (2) is the first position right of 0
+    odd = metaplot.centerProfile(np.arange(5.0), 2, 1)
+    assert np.allclose(odd, [[0, 1, 2, 3]])
+    assert np.allclose(metaplot.profilePositions("center", flank=2, binsize=1), [-1.5, -0.5, 0.5, 1.5])
+
+    # even: three positions on either side of the midpoint
+    even = metaplot.centerProfile(np.arange(6.0), 3, 1)
+    assert np.allclose(even, [[0, 1, 2, 3, 4, 5]])
+    positions = metaplot.profilePositions("center", flank=3, binsize=1)
+    assert np.allclose(positions, -positions[::-1])
+
+    # short ROIs leave the outer bins empty on both sides alike
+    short = metaplot.centerProfile(np.arange(2.0), 2, 1)
+    assert np.isnan(short[0, 0]) and np.allclose(short[0, 1:3], [0, 1]) and np.isnan(short[0, 3])
+
+
+def test_heatmap_rows_sorted_and_downsampled(tmpdir):
+    """Heatmap rows are sorted by total signal and averaged down to the row limit."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, metaplot
+
+    with h5py.File(str(tmpdir.join("heatmap.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        for level in range(10):
+            countsfile.writeROI(f, "roi{0}".format(level), "chr1", 0, 50, ["a", "b"],
+                                [np.full(50, float(level)), np.zeros(50)])
+        IDs = countsfile.roiNames(f)
+        heatmaps, order, totals = metaplot.heatmapMatrix(f, IDs, ["a", "b"], columns=5, rows=4)
+
+    assert heatmaps.shape == (2, 4, 5)
+    assert order[:3] == ["roi9", "roi8", "roi7"]
+    assert list(totals[:2]) == [450.0, 400.0]
+    assert np.allclose(heatmaps[0, :, 0], [8.5, 6, 3.5, 1])
+    assert np.allclose(metaplot.downsample(np.array([[np.nan, 1, 2, np.nan]]), 2, axis=1), [[1, 2]])
+
+
+def test_heatmap_two_passes_match_full_matrix(tmpdir):
+    """Rows accumulated in a second pass equal downsampling every ROI's profile, at bin-center x."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, metaplot
+
+    random = np.random.RandomState(1)
+    with h5py.File(str(tmpdir.join("heatmap.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        for number in range(23):
+            length = random.randint(300, 3000)
+            countsfile.writeROI(f, "roi{0:02d}".format(number), "chr1", 0, length, ["a", "b"],
+                                [random.poisson(2, length).astype(float), random.poisson(1, length).astype(float)])
+        IDs = countsfile.roiNames(f)
+        heatmaps, order, totals = metaplot.heatmapMatrix(f, IDs, ["a", "b"], "center", columns=7, flank=1000,
+                                                         binsize=150, rows=5)
+
+        # one profile per ROI, sorted and downsampled afterwards
+        profiles = np.array([metaplot.downsample(metaplot.centerProfile(countsfile.readColumns(f[ID]), 1000, 150),
+                                                 7, axis=1) for ID in IDs])
+        expected = metaplot.downsample(profiles[np.argsort(-totals[np.argsort([IDs.index(ID) for ID in order])],
+                                                           kind="mergesort")], 5, axis=0)
+    assert heatmaps.shape == (2, 5, 7)
+    assert list(totals) == sorted(totals, reverse=True)
+    assert np.allclose(heatmaps, expected.transpose(1, 0, 2), equal_nan=True)
+
+    # 14 bins of 150 bp from -1000, merged into 7 columns of 2 bins
+    positions = metaplot.heatmapPositions("center", 7, 1000, 150)
+    assert np.allclose(positions, -1000 + 150 + 300 * np.arange(7))
+    assert np.allclose(metaplot.heatmapPositions("scaled", 4), [12.5, 37.5, 62.5, 87.5])
+
+
+def test_min_max_decimation_keeps_peaks():
+    """Decimated traces stay under the point cap and keep every extreme."""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("h5py")
+    from mobamplot import countsfile
+
+    values = np.random.RandomState(0).rand(100001)
+    values[54321], values[777] = 50.0, -3.0
+    kept = countsfile.minMaxIndices(values, 1000)
+    assert len(kept) <= 1000
+    assert np.all(np.diff(kept) >= 0)
+    assert values[kept].max() == 50.0 and values[kept].min() == -3.0
+    assert countsfile.minMaxIndices(np.vstack([values, -values]), 10).shape == (2, 10)
+    assert list(countsfile.minMaxIndices(np.arange(5.0), 10)) == [0, 1, 2, 3, 4]
+
+
+def test_manifest_tracks_roi_digests(tmpdir):
+    """Figure digests follow the ROI data and the manifest round-trips."""
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, manifest
+
+    with h5py.File(str(tmpdir.join("digest.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        first = countsfile.writeROI(f, "roi1", "chr1", 0, 100, ["a", "b"], [np.arange(100.0), np.zeros(100)])
+        second = countsfile.writeROI(f, "roi2", "chr1", 0, 100, ["a", "b"], [np.arange(100.0), np.ones(100)])
+        assert countsfile.roiDigest(first, ["a"]) == countsfile.roiDigest(second, ["a"])
+        assert countsfile.roiDigest(first) != countsfile.roiDigest(second)
+
+    options = manifest.optionsDigest({"binsize": 200, "line": False})
+    digest = manifest.figureDigest("data", options)
+    assert digest != manifest.figureDigest("data", manifest.optionsDigest({"binsize": 100, "line": False}))
+
+    outfolder = str(tmpdir)
+    assert manifest.load(outfolder) == {}
+    manifest.save(outfolder, {"roi1.hist": digest})
+    assert manifest.load(outfolder) == {"roi1.hist": digest}
+
+    figure = tmpdir.join("roi1.hist.html")
+    assert not manifest.upToDate(digest, digest, str(figure))
+    figure.write("")
+    assert manifest.upToDate(digest, digest, str(figure))
+    assert not manifest.upToDate("other", digest, str(figure))
+
+
+def test_rerun_renders_only_changed_figures(tmpdir):
+    """A rerun skips up-to-date figures and rebuilds deleted images, changed ROIs and new bin sizes."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    pytest.importorskip("matplotlib")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, mobamplot
+
+    hdf5 = str(tmpdir.join("rois.hdf5"))
+    with h5py.File(hdf5, "w") as f:
+        countsfile.initLayout(f)
+        for number in range(3):
+            countsfile.writeROI(f, "roi{0}".format(number), "chr1", 0, 600, ["a"], [np.full(600, float(number))])
+    outfolder = tmpdir.mkdir("figures")
+
+    def rendered(filetype, binsize, html="standalone"):
+        timings = mobamplot.plotData(hdf5, filetype, str(outfolder), False, binsize, html=html)
+        return sorted(ID for ID, name, seconds, digest in timings if seconds is not None)
+
+    assert rendered("png", 100) == ["roi0", "roi1", "roi2"]
+    assert rendered("png", 100) == []
+    outfolder.join(mobamplot.figureFileName("roi1", False, 100, "matplotlib") + ".png").remove()
+    assert rendered("png", 100) == ["roi1"]
+    assert rendered("png", 50) == ["roi0", "roi1", "roi2"]
+
+    with h5py.File(hdf5, "a") as f:
+        countsfile.writeROI(f, "roi2", "chr1", 0, 600, ["a"], [np.arange(600.0)])
+    assert rendered("png", 100) == ["roi2"]
+
+    # html histograms keep their name across bin sizes, the digest still changes
+    assert rendered(None, 100, "shared") == ["roi0", "roi1", "roi2"]
+    assert rendered(None, 100, "shared") == []
+    assert rendered(None, 50, "shared") == ["roi0", "roi1", "roi2"]
+
+
+def test_interval_index_region_lookup(tmpdir):
+    """Region lookups through the interval index match a scan of all ROIs."""
+    h5py = pytest.importorskip("h5py")
+    import random
+    import numpy as np
+    from mobamplot import countsfile
+
+    random.seed(0)
+    rois = []
+    with h5py.File(str(tmpdir.join("index.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        for number in range(200):
+            chrom = random.choice(["chr1", "chr2"])
+            start = random.randint(0, 50000)
+            end = start + random.randint(1, 5000)
+            countsfile.writeROI(f, "roi{0}".format(number), chrom, start, end, ["a"], [np.zeros(end - start)])
+            rois.append(("roi{0}".format(number), chrom, start, end))
+        scanned = countsfile.regionROIs(f, "chr2", 10000, 20000)
+
+        countsfile.writeIndex(f)
+        assert countsfile.regionROIs(f, "chr2", 10000, 20000) == scanned
+        for _ in range(50):
+            chrom = random.choice(["chr1", "chr2", "chr3"])
+            start = random.randint(0, 55000)
+            end = start + random.randint(1, 10000)
+            expected = set(name for name, roiChrom, roiStart, roiEnd in rois
+                           if roiChrom == chrom and roiStart < end and roiEnd > start)
+            assert set(countsfile.regionROIs(f, chrom, start, end)) == expected
+
+        countsfile.writeROI(f, "late", "chr1", 0, 10, ["a"], [np.zeros(10)])
+        assert not countsfile.hasIndex(f)
+
+    assert countsfile.parseRegion("chr1:1,000-2,000") == ("chr1", 1000, 2000)
+    with pytest.raises(ValueError):
+        countsfile.parseRegion("chr1:2000-1000")
+
+
+def test_bad_roi_or_region_is_a_usage_error(tmpdir, capsys):
+    """An unknown --roi or a malformed --region exits with a usage message, not a traceback."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    h5py = pytest.importorskip("h5py")
+    import numpy as np
+    from mobamplot import countsfile, mobamplot
+
+    hdf5 = str(tmpdir.join("rois.hdf5"))
+    with h5py.File(hdf5, "w") as f:
+        countsfile.initLayout(f)
+        countsfile.writeROI(f, "roi1", "chr1", 0, 100, ["a"], [np.ones(100)])
+
+    for selection, message in [(["--roi", "roi1", "roi9"], "ROIs not in"),
+                               (["--region", "chr1:100"], "chrom:start-end"),
+                               (["--region", "chr1:500-100"], "ends before it starts")]:
+        with pytest.raises(SystemExit) as exit:
+            mobamplot.main(["--hdf5", hdf5, "--outfolder", str(tmpdir.join("figures")), "--plot"] + selection)
+        assert exit.value.code == 2
+        assert message in capsys.readouterr().err
+    assert not tmpdir.join("figures").check()
+
+
+def test_region_cache_evicts_least_recently_used():
+    """The server's region cache keeps the most recently used entries."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    from mobamplot import server
+
+    cache = server.RegionCache(capacity=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2 and cache.hits == 3 and cache.misses == 1
+
+
+def test_pipeline_plots_counts_without_hdf5(tmpdir):
+    """Counted ROIs are plotted directly and optionally written to hdf5."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    pytest.importorskip("matplotlib")
+    h5py = pytest.importorskip("h5py")
+    np = pytest.importorskip("numpy")
+    from plastid.genomics.roitools import GenomicSegment, SegmentChain
+    from mobamplot import countsfile, mobamplot, pipeline
+
+    segment = SegmentChain(GenomicSegment("chr1", 1000, 3500, "+"), ID="roi 1")
+    counts = np.rec.fromarrays([np.arange(2500.0), np.ones(2500)], names=["a", "b"])
+    timings = pipeline.plotCountVectorData([(segment, counts)], str(tmpdir), binsize=100,
+                                           filetype="png", renderer="matplotlib")
+    assert [timing[:2] for timing in timings] == [("roi 1", mobamplot.figureName("roi 1", ".hist.bin100"))]
+    assert tmpdir.listdir(lambda path: path.ext == ".hdf5") == []
+
+    with h5py.File(str(tmpdir.join("counts.hdf5")), "w") as f:
+        countsfile.initLayout(f)
+        pipeline.plotCountVectorData([(segment, counts)], str(tmpdir), binsize=100, line=True,
+                                     filetype="png", renderer="matplotlib", f=f)
+        assert countsfile.roiCoordinates(f["roi 1"]) == ("chr1", 1000, 3500)
+        assert np.array_equal(countsfile.readColumns(f["roi 1"], ["a"])[0], np.arange(2500.0))
+    assert tmpdir.join(mobamplot.figureName("roi 1", ".line.bin100.png")).check()
+
+
+def test_server_refuses_invalid_count_options():
+    """Count options the pool cannot combine are usage errors, not tracebacks."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    from mobamplot import server
+
+    for options in [["--mapping", "coverage"], ["--engine", "pysam", "--extension", "200"]]:
+        with pytest.raises(SystemExit) as error:
+            server.main(["--bamfiles", "reads.bam"] + options)
+        assert error.value.code == 2
+
+
+def test_count_server_query_parsing(tmpdir):
+    """Region, bin size and statistic are checked before anything is counted."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    from mobamplot import server
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    countServer = server.CountServer([bamfile], engine="pysam", maxRegion=1000, maxBins=100)
+    try:
+        assert countServer.bamIDs == ["reads"]
+        assert countServer.parseQuery({"region": "chr1:1,00-300", "bin": "20", "statistic": "max"}) == \
+            ("chr1", 100, 300, 20, "max")
+        assert countServer.parseQuery({"region": "chr1:0-200"}) == ("chr1", 0, 200, 50, "mean")
+        for query in [{}, {"region": "chr1"}, {"region": "chr1:0-2000"}, {"region": "chr1:0-200", "bin": "x"},
+                      {"region": "chr1:0-200", "bin": "0"}, {"region": "chr1:0-1000", "bin": "1"},
+                      {"region": "chr1:0-200", "statistic": "mode"}]:
+            with pytest.raises(ValueError):
+                countServer.parseQuery(query)
+    finally:
+        countServer.close()
+
+
+def test_count_server_responses(tmpdir):
+    """/counts answers JSON or binary, /figure a plotly figure, and bad queries get a 400."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    import asyncio
+    import json
+    import numpy as np
+    from mobamplot import server
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    countServer = server.CountServer([bamfile], engine="pysam", maxRegion=1000)
+
+    def get(target, headers={}):
+        return asyncio.run(countServer.route("GET", target, headers))
+
+    try:
+        # both reads spread 1 count over their 10 aligned positions, all inside 100-150
+        status, body, contentType, headers = get("/counts?region=chr1:0-200&bin=50&statistic=sum")
+        assert (status, contentType) == (200, "application/json")
+        counts = json.loads(body.decode("utf-8"))
+        assert counts["bamIDs"] == ["reads"] and counts["centers"] == [25, 75, 125, 175]
+        assert np.allclose(counts["counts"], [[0, 0, 2, 0]])
+        assert countServer.cache.misses == 1
+
+        for target, accept in [("/counts?region=chr1:0-200&bin=50&statistic=sum&format=binary", ""),
+                               ("/counts?region=chr1:0-200&bin=50&statistic=sum", "application/octet-stream")]:
+            status, body, contentType, headers = get(target, {"accept": accept})
+            assert (status, contentType) == (200, "application/octet-stream")
+            assert headers["X-Shape"] == "1,4" and headers["X-Bin-Start"] == "0" and headers["X-Bin-Size"] == "50"
+            assert json.loads(headers["X-Bam-IDs"]) == ["reads"]
+            assert np.allclose(np.frombuffer(body, "<f4").reshape(1, 4), counts["counts"])
+        assert countServer.cache.misses == 1 and countServer.cache.hits == 2
+
+        for target in ["/counts?region=chr9:0-200", "/counts?region=chr1:0-5000", "/figure?region=chr1:200-100"]:
+            status, body, contentType, headers = get(target)
+            assert status == 400 and "error" in json.loads(body.decode("utf-8"))
+        assert get("/nothing")[0] == 404
+        assert asyncio.run(countServer.route("POST", "/counts", {}))[0] == 405
+
+        status, body, contentType, headers = get("/figure?region=chr1:0-200&bin=50")
+        assert (status, contentType) == (200, "application/json")
+        figure = json.loads(body.decode("utf-8"))
+        assert [trace["type"] for trace in figure["data"]] == ["bar"]
+        assert figure["layout"]["title"] == "Gene: chr1:0-200"
+        line = json.loads(get("/figure?region=chr1:0-200&bin=50&line=1")[1].decode("utf-8"))
+        assert [trace["type"] for trace in line["data"]] == ["scatter"]
+    finally:
+        countServer.close()
+
+
+def test_count_server_handles_http_request(tmpdir):
+    """handle reads a raw HTTP request from a stream and writes the whole response."""
+    pytest.importorskip("plastid")
+    pytest.importorskip("plotly")
+    import asyncio
+    from mobamplot import server
+
+    bamfile = str(tmpdir.join("reads.bam"))
+    _write_bam(bamfile).close()
+    countServer = server.CountServer([bamfile], engine="pysam")
+
+    class Writer(object):
+        def __init__(self):
+            self.data, self.closed = b"", False
+        def write(self, data):
+            self.data += data
+        async def drain(self):
+            pass
+        def close(self):
+            self.closed = True
+
+    async def request(raw):
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        writer = Writer()
+        await countServer.handle(reader, writer)
+        return writer
+
+    try:
+        writer = asyncio.run(request(b"GET /counts?region=chr1:0-200&bin=50&format=binary HTTP/1.1\r\n"
+                                     b"Host: localhost\r\n\r\n"))
+        head, _, body = writer.data.partition(b"\r\n\r\n")
+        assert head.startswith(b"HTTP/1.1 200 OK") and writer.closed
+        assert b"Content-Length: 16" in head and len(body) == 16
+        assert asyncio.run(request(b"garbage\r\n\r\n")).data.startswith(b"HTTP/1.1 400 Bad Request")
+    finally:
+        countServer.close()